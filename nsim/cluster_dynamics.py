@@ -59,6 +59,8 @@ class ClusterDynamics(dict):
         # members
         self._o2rate = None
         self._o3rate = None
+        self._nrn_cls = {}
+        self._snext = soffs
         self._soffs = soffs
         self._srate = None
 
@@ -111,12 +113,13 @@ class ClusterDynamics(dict):
 #                'neuron is not a Neuron, got %s' % neuron.__class__.__name__
 #            )
 
-        # if no cluster given -> singletons
+        # if no cluster given -> singletons, cluster ids are never released
+        # so the search starts after the last singleton
         if cls_idx is None:
-            skeys = filter(lambda x: x >= self.singleton_offset, sorted(self.keys()))
-            cls_idx = self.singleton_offset
-            while cls_idx in skeys:
+            cls_idx = max(self._snext, self.singleton_offset)
+            while cls_idx in self:
                 cls_idx += 1
+            self._snext = cls_idx + 1
 
         # new entry
         if cls_idx not in self:
@@ -124,6 +127,7 @@ class ClusterDynamics(dict):
 
         # append to cluster and return cls_idx
         self[cls_idx][id(neuron)] = [neuron, []]
+        self._nrn_cls[id(neuron)] = cls_idx
         return cls_idx
 
     def remove_neuron(self, key):
@@ -139,17 +143,24 @@ class ClusterDynamics(dict):
         rval = False
 
         # search
-        for cls in self:
+        cls = self._nrn_cls.pop(lookup, None)
+        if cls is not None:
             try:
                 self[cls].pop(lookup)
                 rval = True
-                break
             except:
-                continue
+                pass
 
         # return
         return rval
 
+    def clear(self):
+        """remove all clusters and neurons, and restart the singleton ids"""
+
+        super(ClusterDynamics, self).clear()
+        self._nrn_cls.clear()
+        self._snext = self._soffs
+
     # query methods
 
     def get_clusters(self):
@@ -163,11 +174,7 @@ class ClusterDynamics(dict):
     def get_cls_for_nrn(self, nrn):
         """returns the cluster id for a neuron object"""
 
-        rval = -1
-        for cls in self:
-            if id(nrn) in self[cls]:
-                rval = cls
-        return rval
+        return self._nrn_cls.get(id(nrn), -1)
 
     # run methods
 
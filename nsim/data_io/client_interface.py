@@ -117,7 +117,7 @@ class ChunkContainer(object):
             else:
                 appendlen, nchan = noise.shape
                 if self.noise is None:
-                    self.noise = N.empty((self.cnklen, nchan))
+                    self.noise = N.empty((self.cnklen, nchan), dtype=noise.dtype)
                 # normal append case
                 thislen = appendlen
                 if self.cnkptr + thislen >= self.cnklen:
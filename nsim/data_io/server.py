@@ -368,6 +368,8 @@ class SimIOManager(object):
         items are mapped by id:
             0   : sample_rate
             1   : frame_size
+            2   : frame dtype, as the size in bytes of the float type of
+                  noise and waveform data (4: float32, 8: float64)
             10  : neurons
             20  : recorders
         """
@@ -375,7 +377,8 @@ class SimIOManager(object):
         try:
             cont = [
                 [status['sample_rate'], 0],
-                [status['frame_size'], 1]
+                [status['frame_size'], 1],
+                [N.dtype(status.get('frame_dtype', N.float64)).itemsize, 2]
             ]
             if len(status['neurons']) > 0:
                 cont.extend([[item, 10] for item in status['neurons']])
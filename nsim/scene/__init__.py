@@ -33,7 +33,12 @@ __docformat__ = 'restructuredtext'
 
 ##---IMPORTS
 
-from neuron_data import NeuronData, NeuronDataContainer
+from neuron_data import (
+    ND_CACHE_DIR,
+    ND_PRECISION,
+    NeuronData,
+    NeuronDataContainer
+)
 from sim_object import SimObject
 from neuron import Neuron
 from recorder import Recorder, Tetrode
@@ -44,6 +49,8 @@ from recorder import Recorder, Tetrode
 __all__ = [
     'BadNeuronQuery',
     # from data
+    'ND_CACHE_DIR',
+    'ND_PRECISION',
     'NeuronData',
     'NeuronDataContainer',
     # from sim_object
@@ -34,10 +34,18 @@ __doctype__ = 'restructuredtext'
 import scipy as N
 # own packages
 from sim_object import SimObject
-from nsim.math import quaternion_matrix, vector_norm
+from nsim.math import quaternion_matrix
 from neuron_data import NeuronData
 
 
+##---CONSTANTS
+
+# levels of detail of the waveform per channel, see Neuron.query_for_recorder
+LOD_FULL = 0
+LOD_RADIAL = 1
+LOD_CULLED = 2
+
+
 ##---EXCEPTIONS
 
 class BadNeuronQuery(Exception):
@@ -84,6 +92,7 @@ class Neuron(SimObject):
         self._interval_overshoot = []
         self._interval_waveform = []
         self._firing_times = []
+        self._lod_levels = None
 
         # set from kwargs
         self.active = True
@@ -116,6 +125,22 @@ class Neuron(SimObject):
         return self._neuron_data.horizon
     horizon = property(get_horizon)
 
+    def get_neuron_data(self):
+        return self._neuron_data
+    def set_neuron_data(self, value):
+        if not isinstance(value, NeuronData):
+            raise ValueError('neuron_data is %s and not a subclass of '
+                             'NeuronData!' % value.__class__.__name__)
+        # waveform intervals of the old neuron data are void
+        self._neuron_data = value
+        self._interval_overshoot = []
+        self._interval_waveform = []
+    neuron_data = property(get_neuron_data, set_neuron_data)
+
+    def get_lod_levels(self):
+        return self._lod_levels
+    lod_levels = property(get_lod_levels)
+
     ## event slots
 
     def simulate(self, **kwargs):
@@ -186,47 +211,80 @@ class Neuron(SimObject):
 
     ## methods public
 
-    def query_for_recorder(self, positions):
+    def query_for_recorder(self, positions, dtype=None, lod=None):
         """return the multichanneled waveform and firing times for this neuron
         for the current frame. The multichanneled waveform is build from the
         positions passed, yielding a [positions, frame_size] matrix with one
         channel per column.
 
+        With levels of detail, the peak voltage a channel can see at its
+        position (see NeuronData.get_peak) selects the level per channel:
+        LOD_FULL for the waveform from the neuron data, LOD_RADIAL for the
+        radial approximation (see NeuronData.get_radial) and LOD_CULLED for
+        zeros. The levels of the last query are kept in lod_levels.
+
         :Parameters:
             positions : ndarray
                 3d coordinates of the components of the recorder. One coordinate
                 per row, as given by recorder.points.
+            dtype : dtype
+                Type of the waveform, float64 if None.
+                Default=None
+            lod : tuple
+                Peak voltages per channel, below which the channel is culled
+                and below which the radial approximation is used. If None, all
+                channels in the horizon get the full waveform.
+                Default=None
         :Returns:
             tuple : (waveform, interval_waveforms)
         :Raises:
-            BadNeuronQuery : if self._frame_size is None or the position is
-            beyond the neuron's horizon.
+            BadNeuronQuery : if self._frame_size is None, the position is
+            beyond the neuron's horizon or all channels are culled.
         """
 
         # check for any valid positions
         rel_pos = positions - self._position
-        rel_pos_valid = [
-            vector_norm(rel_pos[i]) < self._neuron_data.horizon
-            for  i in xrange(rel_pos.shape[0])
-        ]
+        dist = N.sqrt((rel_pos ** 2).sum(axis=1))
+        rel_pos_valid = dist < self._neuron_data.horizon
+        self._lod_levels = None
         if not N.any(rel_pos_valid):
             raise BadNeuronQuery('queried position(s) outside of sphere_radius')
         if len(self._firing_times) == 0:
             raise BadNeuronQuery('no events in current frame for the queried neuron')
 
-        # inits
-        wf = N.zeros((self._neuron_data.intra_v.size, rel_pos.shape[0]))
-
         # if we have orientation, rotate rel_pos accordingly
-        if self._orientation:
+        if self._orientation is not False:
             rel_pos = N.dot(
                 quaternion_matrix(self._orientation)[:3, :3],
                 rel_pos.T
             ).T
 
+        # levels of detail
+        levels = None
+        if lod is not None:
+            peak = abs(self._amplitude) * self._neuron_data.get_peak(rel_pos)
+            levels = N.empty(dist.size, dtype=int)
+            levels.fill(LOD_FULL)
+            levels[peak < lod[1]] = LOD_RADIAL
+            levels[(peak < lod[0]) | ~rel_pos_valid] = LOD_CULLED
+            rel_pos_valid = levels != LOD_CULLED
+            self._lod_levels = levels
+            if not N.any(rel_pos_valid):
+                raise BadNeuronQuery('waveform below the noise on all channels')
+
+        # inits
+        wf = N.zeros(
+            (self._neuron_data.intra_v.size, rel_pos.shape[0]),
+            dtype=dtype or N.float64
+        )
+
         # copy waveforms per position (resp. channel)
         for i in xrange(rel_pos.shape[0]):
-            if rel_pos_valid[i]:
+            if not rel_pos_valid[i]:
+                continue
+            if levels is not None and levels[i] == LOD_RADIAL:
+                wf[:, i] = self._neuron_data.get_radial(dist[i])
+            else:
                 wf[:, i] = self._neuron_data.get_data(rel_pos[i])
         # adjust for amplitude
         if self._amplitude != 1.0:
@@ -238,11 +296,97 @@ class Neuron(SimObject):
 
 ##---PACKAGE
 
-__all__ = ['BadNeuronQuery', 'Neuron']
+__all__ = ['BadNeuronQuery', 'LOD_CULLED', 'LOD_FULL', 'LOD_RADIAL', 'Neuron']
 
 
 ##---MAIN
 
 if __name__ == '__main__':
 
-    pass
+    import os.path as osp, shutil, tempfile, time
+    from tables import openFile
+    from neuron_data import SampledND
+
+    # inits, a synthetic archive with a field that is not radially symmetric
+    tmp_dir = tempfile.mkdtemp()
+    path = osp.join(tmp_dir, 'synthetic.h5')
+    gs, step, nsmpl = 41, 5.0, 64
+    grid = (N.arange(gs) - (gs - 1) / 2) * step
+    X, Y, Z = N.meshgrid(grid, grid, grid, indexing='ij')
+    dist = N.sqrt(X ** 2 + Y ** 2 + Z ** 2).ravel() + step
+    cos_z = Z.ravel() / dist
+    t = N.arange(nsmpl) / 16.0
+    wf1 = -N.exp(-(t - 0.8) ** 2 / 0.02)
+    wf2 = N.exp(-(t - 1.2) ** 2 / 0.08)
+    arc = openFile(path, 'w')
+    arc.createArray('/', 'soma_v', wf1)
+    arc.createArray('/', 'LFP', 4000.0 / dist[:, N.newaxis] ** 2 * (
+        wf1 + 0.5 * cos_z[:, N.newaxis] * wf2))
+    arc.createArray('/', 'el_pos_x', grid)
+    arc.createArray('/', 'el_pos_y', grid)
+    arc.createArray('/', 'el_pos_z', grid)
+    arc.createGroup('/', 'parameters')
+    arc.createArray('/parameters', 'timeres_python', 1000.0 / 16000.0)
+    arc.close()
+    nd = SampledND(path)
+    tic = time.time()
+    nd.get_peak(N.zeros(3))
+    t_peak = time.time() - tic
+    tic = time.time()
+    nd.get_radial(0.0)
+    t_profile = time.time() - tic
+
+    # neurons around a tetrode, all firing, with unit noise
+    nnrn = 2000
+    points = N.array([[0, 0, 0], [-10, -5.8, -17.3], [10, -5.8, -17.3],
+                      [0, 11.5, -17.3]])
+    pos = N.random.standard_normal((nnrn, 3))
+    pos *= (110.0 * N.random.random_sample(nnrn) ** (1.0 / 3.0) /
+            N.sqrt((pos ** 2).sum(axis=1)))[:, N.newaxis]
+    nlist = []
+    for p in pos:
+        nrn = Neuron(neuron_data=nd, position=p, orientation=True)
+        nrn.simulate(frame_size=1024, firing_times=[100])
+        nlist.append(nrn)
+    noise_std = N.ones(points.shape[0])
+    print
+    print '## NEURON LOD ## %d neurons within 110 um of a tetrode' % nnrn
+    print 'peak map: %.3f s, radial profile: %.3f s' % (t_peak, t_profile)
+
+    # full detail as reference
+    def query_all(lod):
+        rval, levels = {}, N.zeros(3, dtype=int)
+        tic = time.time()
+        for nrn in nlist:
+            try:
+                rval[id(nrn)] = nrn.query_for_recorder(points, lod=lod)[1]
+            except BadNeuronQuery:
+                pass
+            if nrn.lod_levels is not None:
+                levels += N.bincount(nrn.lod_levels, minlength=3)
+        return rval, levels, time.time() - tic
+    ref, levels, t_ref = query_all(None)
+    print 'lod          time     full  radial  culled  payload  ' \
+        'max err/noise radial  culled'
+    print '%-12s %.3f s  %5d  %6d  %6d  %4d kB' % (
+        'None', t_ref, len(ref) * 4, 0, 0,
+        sum([wf.nbytes for wf in ref.values()]) / 1024)
+    for lod in [(0.5, 0.0), (1.0, 0.0), (2.0, 0.0), (0.5, 2.0), (1.0, 4.0)]:
+        rval, levels, t_lod = query_all((lod[0] * noise_std,
+                                         lod[1] * noise_std))
+        err = N.zeros(3)
+        for nrn in nlist:
+            if id(nrn) not in ref:
+                continue
+            wf = rval.get(id(nrn), N.zeros_like(ref[id(nrn)]))
+            e = abs(wf - ref[id(nrn)]).max(axis=0)
+            lev = nrn.lod_levels
+            if lev is None:
+                lev = N.zeros(4, dtype=int) + LOD_CULLED
+            for l in [LOD_RADIAL, LOD_CULLED]:
+                if (lev == l).any():
+                    err[l] = max(err[l], e[lev == l].max())
+        print '%-12s %.3f s  %5d  %6d  %6d  %4d kB  %20.3f  %6.3f' % (
+            lod, t_lod, levels[0], levels[1], levels[2],
+            sum([wf.nbytes for wf in rval.values()]) / 1024, err[1], err[2])
+    shutil.rmtree(tmp_dir)
@@ -30,18 +30,55 @@ __docformat__ = 'restructuredtext'
 
 ##---IMPORTS
 
-from neuron_data import NeuronData, NeuronDataContainer
-from nd_sampled import SampledND
+from neuron_data import (
+    ND_CACHE_DIR,
+    ND_PRECISION,
+    ND_SHM_DIR,
+    NeuronData,
+    NeuronDataContainer,
+    nd_archive_key,
+    nd_resample_matrix,
+    nd_shm_attach,
+    nd_shm_clear,
+    nd_shm_release,
+    nd_storage
+)
+from nd_sampled import (
+    SampledND,
+    VoxelBlockCache,
+    sampled_nd_chunked,
+    sampled_nd_sidecar
+)
+from nd_compressed import CompressedND, compressed_nd_convert
+from nd_octree import OctreeND, octree_nd_convert
 from nd_waveform import ScalingWaveformND, WaveformND
 
 ##---PACKAGE
 
 __all__ = [
     # neuron data interface
+    'ND_CACHE_DIR',
+    'ND_PRECISION',
+    'ND_SHM_DIR',
     'NeuronData',
     'NeuronDataContainer',
+    'nd_archive_key',
+    'nd_resample_matrix',
+    'nd_shm_attach',
+    'nd_shm_clear',
+    'nd_shm_release',
+    'nd_storage',
     # sampled neuron data
     'SampledND',
+    'VoxelBlockCache',
+    'sampled_nd_chunked',
+    'sampled_nd_sidecar',
+    # compressed neuron data
+    'CompressedND',
+    'compressed_nd_convert',
+    # octree neuron data
+    'OctreeND',
+    'octree_nd_convert',
     # waveform neuron data
     'ScalingWaveformND',
     'WaveformND',
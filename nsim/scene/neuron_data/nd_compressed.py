@@ -0,0 +1,352 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/neuron_data/nd_compressed.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-13
+#
+
+"""NeuronData implementation based on a compressed voxel grid"""
+__docformat__ = 'restructuredtext'
+
+
+##---IMPORTS
+
+import os.path as osp
+from tables import openFile
+import scipy as N
+from scipy import linalg as NL
+from neuron_data import NeuronData
+from nd_sampled import SampledND
+from nsim.math import lerp3
+
+
+##---CONSTANTS
+
+# voxel offsets of the interpolation cube, in lerp3 order
+_CUBE = N.array([
+    [0., 0., 0.],
+    [1., 0., 0.],
+    [0., 1., 0.],
+    [1., 1., 0.],
+    [0., 0., 1.],
+    [1., 0., 1.],
+    [0., 1., 1.],
+    [1., 1., 1.],
+])
+
+
+##---CLASSES
+
+class CompressedND(NeuronData):
+    """data container for voxel grid data compressed with a temporal basis
+
+    The waveforms of a voxel grid (see SampledND) are represented by k temporal
+    basis functions, shared by all voxels, and k coefficients per voxel. The
+    interpolation runs on the coefficients of the 8 surrounding voxels, the
+    waveform is reconstructed with one (k, len(phase)) matrix product.
+
+    The voxel data is not held as extra_v, see basis and coeffs.
+    """
+
+    ## class members
+
+    SHARED_MEMBERS = ['intra_v', 'basis', 'coeffs']
+    RESAMPLED_MEMBERS = ['basis']
+
+    ## constructor
+
+    def __init__(self,
+                 basis,
+                 coeffs,
+                 intra_v,
+                 horizon,
+                 grid_step,
+                 sample_rate=16000.0,
+                 **kwargs):
+        """
+        :Parameters:
+            basis : ndarray
+                The temporal basis functions on the rows, shape (k, nsample).
+            coeffs : ndarray
+                The coefficients per voxel, shape (nvoxel, k). The voxels are
+                ordered as in SampledND.
+            intra_v : ndarray
+                The intracellular waveform.
+            horizon : float
+                The horizon of the voxel grid.
+            grid_step : float
+                The distance of neighbouring voxels.
+            sample_rate : float
+                Sample rate of the waveforms in Hz.
+                Default=16000.0
+        :Keywords:
+            see NeuronData
+        :Exceptions:
+            ValueError:
+                Error for inconsistent shapes of basis and coeffs.
+            see NeuronData
+        """
+
+        # checks
+        if basis.ndim != 2 or coeffs.ndim != 2 or \
+        basis.shape[0] != coeffs.shape[1]:
+            raise ValueError('basis and coeffs dont fit each other')
+
+        # super
+        super(CompressedND, self).__init__(**kwargs)
+
+        # interface members
+        self.intra_v = intra_v
+        self.horizon = horizon
+        self.sample_rate = sample_rate
+
+        # compressed voxel data
+        self.basis = basis
+        self.coeffs = coeffs
+        self.grid_step = grid_step
+        self.grid_size = int(round(coeffs.shape[0] ** (1.0 / 3.0)))
+
+    ## interface methods - implementation
+
+    def _get_data(self, pos, phase):
+        """return voltage data for a position in the grid and phase
+
+        Will interpolate the coefficients of the surrounding 8 voxel positions
+        """
+
+        # find the reference position (closer to origin from real position)
+        grid_pos = pos / self.grid_step
+        ref_pos = N.floor(grid_pos)
+        alpha = grid_pos - ref_pos
+
+        # coefficients of the 8 voxels, in lerp3 order
+        c = [
+            self.coeffs[SampledND.pos_kernel(ref_pos + d, self.grid_size)]
+            for d in _CUBE
+        ]
+
+        # interpolate and reconstruct
+        return N.dot(
+            lerp3(alpha[0], alpha[1], alpha[2], *c),
+            self.basis[:, phase]
+        )
+
+    def _get_peak_voxels(self):
+        """grid step and peak absolute voltage per voxel, see NeuronData"""
+
+        rval = N.concatenate([
+            abs(N.dot(self.coeffs[i:i + 4096], self.basis)).max(axis=1)
+            for i in xrange(0, self.coeffs.shape[0], 4096)
+        ])
+        return self.grid_step, rval.reshape((self.grid_size,) * 3)
+
+    ## methods public
+
+    def save(self, path):
+        """save to an archive that can be loaded with from_file
+
+        :Parameters:
+            path : str
+                Path to the archive.
+        """
+
+        arc = openFile(path, 'w')
+        try:
+            arc.createArray('/', '#TYPE', 'NeuronData')
+            arc.createArray('/', '#CLASS', self.__class__.__name__)
+            arc.createArray('/', 'description', self.description)
+            arc.createArray('/', 'basis', self.basis)
+            arc.createArray('/', 'coeffs', self.coeffs)
+            arc.createArray('/', 'intra_v', self.intra_v)
+            arc.createArray('/', 'horizon', self.horizon)
+            arc.createArray('/', 'grid_step', self.grid_step)
+            arc.createArray('/', 'sample_rate', self.sample_rate)
+        finally:
+            arc.close()
+
+    ## class methods
+
+    @classmethod
+    def from_file(cls, path, rootUEP='/', **kwargs):
+        """factory to create a CompressedND from an archive
+
+        :Parameters:
+            path : str
+                Path to the archive to load from
+            rootUEP : str
+                root in the archive used as the user entry path (UEP).
+                Default='/'
+        :Keywords:
+            Load options for other NeuronData subclasses, ignored.
+        :Return:
+            CompressedND : if successfully loaded from the file
+            None : on any error
+        """
+
+        try:
+            arc = openFile(path, 'r', rootUEP=rootUEP)
+            return cls(
+                arc.getNode('/basis').read(),
+                arc.getNode('/coeffs').read(),
+                arc.getNode('/intra_v').read(),
+                float(arc.getNode('/horizon').read()),
+                float(arc.getNode('/grid_step').read()),
+                sample_rate=float(arc.getNode('/sample_rate').read()),
+                description=str(arc.getNode('/description').read())
+            )
+        except:
+            return None
+        finally:
+            try:
+                arc.close()
+                del arc
+            except:
+                pass
+
+    @classmethod
+    def from_sampled(cls, ndata, k=None, tol=1e-3, block_rows=4096):
+        """compress a SampledND
+
+        The basis is found from the eigen decomposition of the (nsample,
+        nsample) gram matrix of the voxel data, which is accumulated in blocks
+        of voxels (see SampledND.iter_voxels), so lazy SampledND instances are
+        compressed without loading the voxel data as a whole.
+
+        :Parameters:
+            ndata : SampledND
+                The neuron data to compress.
+            k : int
+                Number of basis functions. If None, the smallest k is chosen
+                that meets tol.
+                Default=None
+            tol : float
+                Relative reconstruction error (frobenius norm) to meet when
+                choosing k.
+                Default=1e-3
+            block_rows : int
+                Number of voxels to process at once.
+                Default=4096
+        :Returns:
+            tuple : CompressedND, relative reconstruction error
+        """
+
+        # gram matrix
+        nvox, nsmpl = ndata.extra_v.shape
+        G = N.zeros((nsmpl, nsmpl))
+        for i, block in ndata.iter_voxels(block_rows):
+            G += N.dot(block.T, block)
+
+        # basis and rank
+        lam, V = NL.eigh(G)
+        lam = N.maximum(lam[::-1], 0.0)
+        V = V[:, ::-1]
+        residual = N.sqrt(N.maximum(lam.sum() - lam.cumsum(), 0.0) /
+                          max(lam.sum(), 1e-300))
+        if k is None:
+            k = int((residual > tol).sum()) + 1
+        k = int(min(max(k, 1), lam.size))
+        basis = V[:, :k].T.copy()
+
+        # coefficients
+        coeffs = N.empty((nvox, k))
+        for i, block in ndata.iter_voxels(block_rows):
+            coeffs[i:i + block.shape[0]] = N.dot(block, basis.T)
+
+        # return
+        rval = cls(
+            basis,
+            coeffs,
+            N.asarray(ndata.intra_v),
+            ndata.horizon,
+            ndata.grid_step,
+            sample_rate=ndata.sample_rate,
+            description='%s::k=%d' % (ndata.description, k)
+        )
+        return rval, residual[k - 1]
+
+
+##---FUNCTIONS
+
+def compressed_nd_convert(path, path_out, k=None, tol=1e-3, verbose=True):
+    """convert a SampledND archive to a CompressedND archive
+
+    :Parameters:
+        path : str
+            Path to the SampledND archive.
+        path_out : str
+            Path to the CompressedND archive.
+        k : int
+            see CompressedND.from_sampled
+        tol : float
+            see CompressedND.from_sampled
+        verbose : bool
+            If True, print the reconstruction error and compression ratio.
+            Default=True
+    :Returns:
+        tuple : CompressedND, relative reconstruction error, max absolute
+            reconstruction error
+    """
+
+    # compress
+    ndata = SampledND(path, lazy=True)
+    rval, err_rel = CompressedND.from_sampled(ndata, k, tol)
+    rval.save(path_out)
+
+    # max absolute reconstruction error and data maximum, blockwise
+    err_max = 0.0
+    data_max = 0.0
+    for i, block in ndata.iter_voxels():
+        recon = N.dot(rval.coeffs[i:i + block.shape[0]], rval.basis)
+        err_max = max(err_max, abs(block - recon).max())
+        data_max = max(data_max, abs(block).max())
+
+    # report
+    if verbose is True:
+        ratio = ndata.extra_v.shape[0] * ndata.extra_v.shape[1] / float(
+            rval.coeffs.size + rval.basis.size)
+        print '%s -> %s' % (osp.basename(path), osp.basename(path_out))
+        print '  k=%d, compression %.1fx' % (rval.basis.shape[0], ratio)
+        print '  relative error %.2e, max abs error %.2e (data max %.2e)' % (
+            err_rel, err_max, data_max)
+    return rval, err_rel, err_max
+
+
+##---PACKAGE
+
+__all__ = ['CompressedND', 'compressed_nd_convert']
+
+
+##---MAIN
+
+if __name__ == '__main__':
+
+    import sys
+
+    # usage: nd_compressed.py <sampled archive> <compressed archive> [k]
+    if len(sys.argv) < 3:
+        print 'usage: %s <sampled archive> <compressed archive> [k]' % (
+            osp.basename(sys.argv[0]))
+        sys.exit(1)
+    k = None
+    if len(sys.argv) > 3:
+        k = int(sys.argv[3])
+    compressed_nd_convert(sys.argv[1], sys.argv[2], k)
@@ -0,0 +1,458 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/neuron_data/nd_octree.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-13
+#
+
+"""NeuronData implementation based on an adaptive (octree) voxel grid"""
+__docformat__ = 'restructuredtext'
+
+
+##---IMPORTS
+
+import os.path as osp
+from tables import openFile
+import scipy as N
+from neuron_data import NeuronData
+from nd_sampled import SampledND
+from nsim.math import lerp3
+
+
+##---CONSTANTS
+
+# vertex offsets of the interpolation cube, in lerp3 order
+_CUBE = [
+    (0, 0, 0),
+    (1, 0, 0),
+    (0, 1, 0),
+    (1, 1, 0),
+    (0, 0, 1),
+    (1, 0, 1),
+    (0, 1, 1),
+    (1, 1, 1),
+]
+
+
+##---CLASSES
+
+class OctreeND(NeuronData):
+    """data container for voxel grid data on an adaptive octree of bricks
+
+    The cubic volume of a uniform voxel grid (see SampledND) is covered by an
+    octree of bricks. A brick at level l holds (brick + 1)**3 voxels with a
+    spacing of 2**(levels - l) grid steps, so level 0 is one coarse brick for
+    the whole volume and the last level has the spacing of the uniform grid.
+    Only the leaves of the octree hold data, so bricks are fine near the cell
+    and coarse in the far field, where the field is smooth.
+
+    Per level, a dense table maps the brick coordinates to the leaf index, or
+    -1 for bricks that are refined further. Point location walks these tables
+    from the root, for all query positions at once.
+
+    The voxel data is not held as extra_v, see data.
+    """
+
+    ## class members
+
+    SHARED_MEMBERS = ['intra_v', 'data']
+    RESAMPLED_MEMBERS = ['data']
+
+    ## constructor
+
+    def __init__(self,
+                 data,
+                 tables,
+                 brick,
+                 grid_step,
+                 intra_v,
+                 horizon,
+                 sample_rate=16000.0,
+                 **kwargs):
+        """
+        :Parameters:
+            data : ndarray
+                The voxel data of all leaves, (brick + 1)**3 consecutive rows
+                per leaf, one column per sample.
+            tables : list
+                The brick tables per level, table l has the shape (2**l,) * 3.
+            brick : int
+                Number of voxel cells per brick side.
+            grid_step : float
+                The distance of neighbouring voxels on the last level.
+            intra_v : ndarray
+                The intracellular waveform.
+            horizon : float
+                The horizon of the voxel grid.
+            sample_rate : float
+                Sample rate of the waveforms in Hz.
+                Default=16000.0
+        :Keywords:
+            see NeuronData
+        :Exceptions:
+            see NeuronData
+        """
+
+        # super
+        super(OctreeND, self).__init__(**kwargs)
+
+        # interface members
+        self.intra_v = intra_v
+        self.horizon = horizon
+        self.sample_rate = sample_rate
+
+        # octree
+        self.data = data
+        self.tables = [N.asarray(t, dtype=N.int64) for t in tables]
+        self.brick = int(brick)
+        self.levels = len(self.tables) - 1
+        self.grid_step = grid_step
+        self.grid_size = self.brick * 2 ** self.levels + 1
+
+    ## interface methods - implementation
+
+    def _get_data(self, pos, phase):
+        """return voltage data for a position in the grid and phase"""
+
+        return self.interpolate(N.atleast_2d(pos), phase)[0]
+
+    def _get_peak_voxels(self):
+        """grid step and peak absolute voltage per voxel, see NeuronData
+
+        The bricks are interpolated on the voxel grid of the last level, one
+        plane at a time.
+        """
+
+        coords = (N.arange(self.grid_size) - 0.5 * (self.grid_size - 1)) * \
+            self.grid_step
+        plane = N.empty((self.grid_size ** 2, 3))
+        plane[:, 1] = N.repeat(coords, self.grid_size)
+        plane[:, 2] = N.tile(coords, self.grid_size)
+        rval = N.empty((self.grid_size,) * 3)
+        for i in xrange(self.grid_size):
+            plane[:, 0] = coords[i]
+            rval[i] = abs(self.interpolate(plane)).max(axis=1).reshape(
+                self.grid_size, self.grid_size)
+        return self.grid_step, rval
+
+    ## methods public
+
+    def locate(self, pos):
+        """find the leaves holding the positions
+
+        :Parameters:
+            pos : ndarray
+                Relative positions, one per row.
+        :Returns:
+            tuple : leaf index, level and brick coordinates per position, and
+                the positions in voxel coordinates of the last level
+        """
+
+        # voxel coordinates, origin at the grid corner
+        u = N.atleast_2d(pos) / self.grid_step + 0.5 * (self.grid_size - 1)
+        u = N.clip(u, 0.0, self.grid_size - 1.0)
+        n = u.shape[0]
+        leaf = -N.ones(n, dtype=N.int64)
+        level = N.zeros(n, dtype=N.int64)
+        cell = N.zeros((n, 3), dtype=N.int64)
+
+        # descend
+        for l in xrange(self.levels + 1):
+            ext = self.brick * 2 ** (self.levels - l)
+            c = N.minimum((u // ext).astype(N.int64), 2 ** l - 1)
+            ids = self.tables[l][c[:, 0], c[:, 1], c[:, 2]]
+            new = (leaf < 0) & (ids >= 0)
+            leaf[new] = ids[new]
+            level[new] = l
+            cell[new] = c[new]
+            if (leaf >= 0).all():
+                break
+
+        # return
+        return leaf, level, cell, u
+
+    def interpolate(self, pos, phase=None):
+        """return voltage data for many positions at once
+
+        :Parameters:
+            pos : ndarray
+                Relative positions, one per row.
+            phase : sequence
+                see NeuronData.get_data
+                Default=None
+        :Returns:
+            ndarray : one waveform per row
+        """
+
+        # inits
+        if phase is None:
+            phase = xrange(self.intra_v.size)
+        phase = N.asarray(phase)
+        leaf, level, cell, u = self.locate(pos)
+
+        # position in the leaf brick
+        stride = (2 ** (self.levels - level))[:, N.newaxis]
+        v = (u - cell * self.brick * stride) / stride
+        f = N.minimum(N.floor(v), self.brick - 1).astype(N.int64)
+        alpha = v - f
+
+        # gather the 8 vertices of the cell
+        side = self.brick + 1
+        base = leaf * side ** 3
+        vals = [
+            self.data[
+                base + ((f[:, 0] + dx) * side + f[:, 1] + dy) * side +
+                f[:, 2] + dz
+            ][:, phase]
+            for dx, dy, dz in _CUBE
+        ]
+
+        # return interpolated voltage traces
+        return lerp3(
+            alpha[:, 0:1], alpha[:, 1:2], alpha[:, 2:3],
+            *vals
+        )
+
+    def save(self, path):
+        """save to an archive that can be loaded with from_file
+
+        :Parameters:
+            path : str
+                Path to the archive.
+        """
+
+        arc = openFile(path, 'w')
+        try:
+            arc.createArray('/', '#TYPE', 'NeuronData')
+            arc.createArray('/', '#CLASS', self.__class__.__name__)
+            arc.createArray('/', 'description', self.description)
+            arc.createArray('/', 'data', self.data)
+            arc.createGroup('/', 'tables')
+            for l, table in enumerate(self.tables):
+                arc.createArray('/tables', 'level%02d' % l, table)
+            arc.createArray('/', 'brick', self.brick)
+            arc.createArray('/', 'grid_step', self.grid_step)
+            arc.createArray('/', 'intra_v', self.intra_v)
+            arc.createArray('/', 'horizon', self.horizon)
+            arc.createArray('/', 'sample_rate', self.sample_rate)
+        finally:
+            arc.close()
+
+    ## class methods
+
+    @classmethod
+    def from_file(cls, path, rootUEP='/', **kwargs):
+        """factory to create an OctreeND from an archive
+
+        :Parameters:
+            path : str
+                Path to the archive to load from
+            rootUEP : str
+                root in the archive used as the user entry path (UEP).
+                Default='/'
+        :Keywords:
+            Load options for other NeuronData subclasses, ignored.
+        :Return:
+            OctreeND : if successfully loaded from the file
+            None : on any error
+        """
+
+        try:
+            arc = openFile(path, 'r', rootUEP=rootUEP)
+            nlevels = len(arc.getNode('/tables')._v_children)
+            return cls(
+                arc.getNode('/data').read(),
+                [arc.getNode('/tables/level%02d' % l).read()
+                 for l in xrange(nlevels)],
+                int(arc.getNode('/brick').read()),
+                float(arc.getNode('/grid_step').read()),
+                arc.getNode('/intra_v').read(),
+                float(arc.getNode('/horizon').read()),
+                sample_rate=float(arc.getNode('/sample_rate').read()),
+                description=str(arc.getNode('/description').read())
+            )
+        except:
+            return None
+        finally:
+            try:
+                arc.close()
+                del arc
+            except:
+                pass
+
+    @classmethod
+    def from_sampled(cls, ndata, budget=1e-2, levels=3):
+        """build an octree for a SampledND within an error budget
+
+        Starting from the root, a brick is refined if trilinear interpolation
+        of its voxels misses the uniform grid data inside the brick by more
+        than the budget. The voxel data is read at full amplitude, see
+        SampledND.iter_voxels.
+
+        :Parameters:
+            ndata : SampledND
+                The neuron data to convert.
+            budget : float
+                Maximal absolute interpolation error at the voxels of the
+                uniform grid, relative to the maximal absolute value of the
+                data.
+                Default=1e-2
+            levels : int
+                Number of refinement levels. The grid size minus one has to be
+                divisible by 2**levels, else less levels are used.
+                Default=3
+        :Returns:
+            OctreeND : the converted neuron data
+        """
+
+        # inits
+        gs = int(round(ndata.grid_size))
+        while levels > 0 and (gs - 1) % 2 ** levels != 0:
+            levels -= 1
+        brick = (gs - 1) / 2 ** levels
+        grid = N.concatenate([block for i, block in ndata.iter_voxels()])
+        grid = grid.reshape((gs, gs, gs, -1))
+        tol = budget * abs(grid).max()
+        tables = [-N.ones((2 ** l,) * 3, dtype=N.int64)
+                  for l in xrange(levels + 1)]
+        leaves = []
+
+        # refine, level by level
+        todo = [(0, 0, 0)]
+        for l in xrange(levels + 1):
+            stride = 2 ** (levels - l)
+            ext = brick * stride
+            M = _octree_nd_upsampler(brick, stride)
+            refine = []
+            for i, j, k in todo:
+                sub = grid[i * ext:(i + 1) * ext + 1,
+                           j * ext:(j + 1) * ext + 1,
+                           k * ext:(k + 1) * ext + 1]
+                vox = sub[::stride, ::stride, ::stride]
+                if l < levels:
+                    err = abs(_octree_nd_upsample(vox, M) - sub).max()
+                    if err > tol:
+                        refine.append((i, j, k))
+                        continue
+                tables[l][i, j, k] = len(leaves)
+                leaves.append(vox.reshape((-1, grid.shape[-1])))
+            todo = [(2 * i + di, 2 * j + dj, 2 * k + dk)
+                    for i, j, k in refine
+                    for di, dj, dk in _CUBE]
+
+        # return
+        return cls(
+            N.concatenate(leaves),
+            tables,
+            brick,
+            ndata.grid_step,
+            N.asarray(ndata.intra_v),
+            ndata.horizon,
+            sample_rate=ndata.sample_rate,
+            description='%s::octree' % ndata.description
+        )
+
+
+##---FUNCTIONS
+
+def _octree_nd_upsampler(brick, stride):
+    """linear interpolation matrix from brick + 1 to brick * stride + 1 points"""
+
+    v = N.arange(brick * stride + 1) / float(stride)
+    f = N.minimum(N.floor(v), brick - 1).astype(int)
+    a = v - f
+    rval = N.zeros((v.size, brick + 1))
+    rval[N.arange(v.size), f] = 1.0 - a
+    rval[N.arange(v.size), f + 1] += a
+    return rval
+
+
+def _octree_nd_upsample(vox, M):
+    """trilinear upsampling of a brick of voxels (x, y, z, sample)"""
+
+    rval = N.tensordot(M, vox, axes=(1, 0))
+    rval = N.tensordot(M, rval, axes=(1, 1)).swapaxes(0, 1)
+    rval = N.tensordot(M, rval, axes=(1, 2)).transpose(1, 2, 0, 3)
+    return rval
+
+
+def octree_nd_convert(path, path_out, budget=1e-2, levels=3, verbose=True):
+    """convert a SampledND archive to an OctreeND archive
+
+    :Parameters:
+        path : str
+            Path to the SampledND archive.
+        path_out : str
+            Path to the OctreeND archive.
+        budget : float
+            see OctreeND.from_sampled
+        levels : int
+            see OctreeND.from_sampled
+        verbose : bool
+            If True, print the octree layout, the memory ratio and the error.
+            Default=True
+    :Returns:
+        tuple : OctreeND, max absolute error relative to the data maximum
+    """
+
+    # convert
+    ndata = SampledND(path)
+    rval = OctreeND.from_sampled(ndata, budget, levels)
+    rval.save(path_out)
+
+    # error at all voxels of the uniform grid
+    gs = rval.grid_size
+    idx = N.arange(gs) - 0.5 * (gs - 1)
+    pos = N.asarray([[x, y, z] for x in idx for y in idx for z in idx])
+    err = abs(rval.interpolate(pos * rval.grid_step) - ndata.extra_v).max()
+    err /= abs(ndata.extra_v).max()
+
+    # report
+    if verbose is True:
+        print '%s -> %s' % (osp.basename(path), osp.basename(path_out))
+        print '  leaves per level: %s' % ', '.join([
+            str((t >= 0).sum()) for t in rval.tables])
+        print '  memory ratio %.1fx, relative max error %.2e (budget %.2e)' % (
+            ndata.extra_v.size / float(rval.data.size), err, budget)
+    return rval, err
+
+
+##---PACKAGE
+
+__all__ = ['OctreeND', 'octree_nd_convert']
+
+
+##---MAIN
+
+if __name__ == '__main__':
+
+    import sys
+
+    # usage: nd_octree.py <sampled archive> <octree archive> [budget]
+    if len(sys.argv) < 3:
+        print 'usage: %s <sampled archive> <octree archive> [budget]' % (
+            osp.basename(sys.argv[0]))
+        sys.exit(1)
+    budget = 1e-2
+    if len(sys.argv) > 3:
+        budget = float(sys.argv[3])
+    octree_nd_convert(sys.argv[1], sys.argv[2], budget)
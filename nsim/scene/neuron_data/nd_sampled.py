@@ -30,11 +30,14 @@ __docformat__ = 'restructuredtext'
 
 ##---IMPORTS
 
+import os
 import os.path as osp
-from tables import openFile
+from collections import OrderedDict
+from hashlib import sha1
+from tables import openFile, Float64Atom
 import scipy as N
 from scipy.special import cbrt
-from neuron_data import NeuronData
+from neuron_data import NeuronData, nd_archive_key, nd_storage
 from nsim.math import lerp3
 
 
@@ -55,17 +58,47 @@ class SampledND(NeuronData):
     sampled temporally for the duration of one action potential temporally (from
     the very beginning of the intracellular hyper-polarization until the resting
     potential is re-established.
+
+    In lazy mode the voxel data stays in the archive and is read on demand in
+    blocks of voxels, through a bounded cache (see VoxelBlockCache).
+
+    The voxel data can be stored in reduced precision (see nd_storage), the
+    interpolation is computed in the accumulation type.
+
+    With a cache directory, the preprocessed data is written to a sidecar on
+    the first load (see sampled_nd_sidecar). Later loads memory-map the voxel
+    data from the sidecar and do not open the archive at all. The sidecar is
+    keyed by the size and modification time of the archive, so a changed
+    archive is preprocessed again.
     """
 
     ## constructor
 
-    def __init__(self, path_to_arc, rootUEP='/', **kwargs):
+    def __init__(self, path_to_arc, rootUEP='/', lazy=False, cache_blocks=256,
+                 dtype=None, acc_dtype=None, cache_dir=None, **kwargs):
         """
         :Parameters:
             path_to_arc : path
                 Path to the HDF5 archive.
             rootUEP : str
                 root in the archive used as the user entry path (UEP).
+            lazy : bool
+                If True, do not load the voxel data, but read it on demand.
+                Default=False
+            cache_blocks : int
+                Lazy mode only, number of voxel blocks to cache.
+                Default=256
+            dtype : dtype
+                Storage type of the voxel data, as in the archive if None.
+                Default=None
+            acc_dtype : dtype
+                Type to compute the interpolation in, float64 if None.
+                Default=None
+            cache_dir : str
+                Directory of the preprocessed sidecars, no sidecar is used if
+                None. Sidecars are written in eager mode only, but are used in
+                both modes.
+                Default=None
         :Keywords:
             see NeuronData
         :Exceptions:
@@ -78,6 +111,19 @@ class SampledND(NeuronData):
 
         # super
         super(SampledND, self).__init__(**kwargs)
+        self.acc_dtype = N.dtype(acc_dtype or N.float64)
+        self.description = 'Einevoll::%s' % osp.basename(path_to_arc)
+
+        # read the preprocessed sidecar
+        sidecar = None
+        if cache_dir is not None:
+            sidecar = sampled_nd_sidecar(
+                path_to_arc, cache_dir,
+                rootUEP=rootUEP,
+                dtype=None if dtype is None else N.dtype(dtype).str
+            )
+            if self._sidecar_read(sidecar) is True:
+                return
 
         # read in data - may raise IOError or NoSuchNodeError
         arc = openFile(path_to_arc, mode='r', rootUEP=rootUEP)
@@ -86,7 +132,19 @@ class SampledND(NeuronData):
 #        ap_phase = xrange(*get_eap_range(soma_v))
         self.intra_v = arc.getNode('/soma_v').read()[..., ap_phase]
 #        self.extra_v = arc.getNode('/LFP').read().T[..., ap_phase]
-        self.extra_v = arc.getNode('/LFP').read()[..., ap_phase]
+        if lazy is True:
+            # float16 blocks are scaled per block, see VoxelBlockCache
+            self.extra_v = VoxelBlockCache(
+                arc.getNode('/LFP'),
+                max_blocks=cache_blocks,
+                dtype=dtype
+            )
+            self.scale = self.extra_v.scale
+        else:
+            self.extra_v, self.scale = nd_storage(
+                arc.getNode('/LFP').read()[..., ap_phase],
+                dtype
+            )
         # read temporary data
         x_pos = arc.getNode('/el_pos_x').read()
         y_pos = arc.getNode('/el_pos_y').read()
@@ -94,9 +152,12 @@ class SampledND(NeuronData):
         params = {}
         for item in arc.getNode('/parameters'):
             params[item.name] = item.read()
-        # close and delete archive
-        arc.close()
-        del arc
+        # close and delete archive, lazy mode keeps it open
+        if lazy is True:
+            self._arc = arc
+        else:
+            arc.close()
+            del arc
         # horizon calculation
         if not (
             abs(x_pos.min()) ==
@@ -116,8 +177,49 @@ class SampledND(NeuronData):
         # spatial info - spatial resolution: x > y > z
         self.grid_step = abs(z_pos[1] - z_pos[0])
         self.grid_size = cbrt(self.extra_v.shape[0])
-        # filename stuff
-        self.description = 'Einevoll::%s' % osp.basename(path_to_arc)
+
+        # write the preprocessed sidecar
+        if sidecar is not None and lazy is False:
+            self._sidecar_write(sidecar)
+
+    ## properties
+
+    def get_cache_hit_rate(self):
+        if isinstance(self.extra_v, VoxelBlockCache):
+            return self.extra_v.hit_rate
+        return None
+    cache_hit_rate = property(get_cache_hit_rate)
+
+    ## public methods
+
+    def iter_voxels(self, block_rows=4096):
+        """iterate over the voxel data in blocks, at full amplitude
+
+        The storage scale is applied. In lazy mode, the blocks are read from
+        the archive, bypassing the block cache.
+
+        :Parameters:
+            block_rows : int
+                Number of voxels per block.
+                Default=4096
+        :Returns:
+            generator : tuples of the index of the first voxel and the block,
+                a float64 ndarray with a row per voxel
+        """
+
+        resample = None
+        if isinstance(self.extra_v, VoxelBlockCache):
+            data, scale = self.extra_v.node, 1.0
+            resample = self.extra_v.resample
+        else:
+            data, scale = self.extra_v, self.scale
+        for i in xrange(0, data.shape[0], block_rows):
+            block = N.asarray(data[i:i + block_rows], dtype=N.float64)
+            if resample is not None:
+                block = N.dot(block, resample.T)
+            if scale != 1.0:
+                block *= scale
+            yield i, block
 
     ## interface methods - implementation
 
@@ -145,14 +247,16 @@ class SampledND(NeuronData):
         ]) + ref_pos
 
         # interpolation values
-        v = N.zeros((8, len(phase)))
+        v = N.zeros((8, len(phase)), dtype=self.acc_dtype)
         for i in xrange(8):
             v[i, :] = self.extra_v[
                 SampledND.pos_kernel(interp_cube[i], self.grid_size),
                 phase
             ]
+        if self.scale != 1.0:
+            v *= self.scale
         # interpolation parameters
-        alpha = grid_pos - ref_pos
+        alpha = (grid_pos - ref_pos).astype(self.acc_dtype)
 
         # return interpolated voltage trace
         return lerp3(
@@ -161,22 +265,110 @@ class SampledND(NeuronData):
             v[4], v[5], v[6], v[7]
         )
 
+    ## private methods
+
+    def _get_peak_voxels(self):
+        """grid step and peak absolute voltage per voxel, see NeuronData
+
+        The voxel data is read in blocks, see iter_voxels.
+        """
+
+        rval = N.concatenate([
+            abs(block).max(axis=1) for i, block in self.iter_voxels()
+        ])
+        return self.grid_step, rval.reshape((int(round(self.grid_size)),) * 3)
+
+    def _resample_member(self, name, R, prefix=None):
+        """resample an array member, see NeuronData.resampled
+
+        In lazy mode, the voxel data is resampled block by block as it is read
+        into a new block cache.
+        """
+
+        if name == 'extra_v' and isinstance(self.extra_v, VoxelBlockCache):
+            return VoxelBlockCache(
+                self.extra_v.node,
+                block_rows=self.extra_v.block_rows,
+                max_blocks=self.extra_v.max_blocks,
+                dtype=self.extra_v.dtype,
+                scale=None if self.extra_v.block_scale else self.extra_v.scale,
+                resample=R
+            )
+        return super(SampledND, self)._resample_member(name, R, prefix)
+
+    def _sidecar_read(self, sidecar):
+        """load the preprocessed data from a sidecar, see sampled_nd_sidecar
+
+        :Returns:
+            bool : True on success, False if the sidecar is missing or broken
+        """
+
+        try:
+            meta = N.load('%s.npz' % sidecar)
+            extra_v = N.load('%s.npy' % sidecar, mmap_mode='r')
+            self.intra_v = meta['intra_v']
+            self.horizon = float(meta['horizon'])
+            self.grid_step = float(meta['grid_step'])
+            self.grid_size = float(meta['grid_size'])
+            self.scale = float(meta['scale'])
+            if meta['sample_rate'].size == 1:
+                self.sample_rate = float(meta['sample_rate'])
+        except:
+            return False
+        self.extra_v = extra_v
+        return True
+
+    def _sidecar_write(self, sidecar):
+        """write the preprocessed data to a sidecar, see sampled_nd_sidecar
+
+        Sidecars of older versions of the archive are removed. Errors are
+        ignored, the sidecar is an optimisation only.
+        """
+
+        try:
+            cache_dir, prefix = osp.split(sidecar)
+            prefix = prefix.split('_')[0]
+            if not osp.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            for fname in os.listdir(cache_dir):
+                if fname.startswith(prefix):
+                    os.remove(osp.join(cache_dir, fname))
+            tmp = '%s.%d.tmp' % (sidecar, os.getpid())
+            N.save('%s.npy' % tmp, N.ascontiguousarray(self.extra_v))
+            N.savez(
+                '%s.npz' % tmp,
+                intra_v=self.intra_v,
+                horizon=self.horizon,
+                grid_step=self.grid_step,
+                grid_size=self.grid_size,
+                scale=self.scale,
+                sample_rate=N.asarray(
+                    [] if self.sample_rate is None else [self.sample_rate]
+                )
+            )
+            os.rename('%s.npy' % tmp, '%s.npy' % sidecar)
+            os.rename('%s.npz' % tmp, '%s.npz' % sidecar)
+        except:
+            pass
+
     ## static methods
 
     @classmethod
-    def from_file(cls, path):
+    def from_file(cls, path, **kwargs):
         """factory to create an SampledND from an archive
         
         :Parameters:
             path : str
                 Path to the archive to load from
+        :Keywords:
+            see SampledND
         :Return:
             SampledND : if successfully loaded from the file
             None : on any error
         """
 
         try:
-            return cls(path)
+            return cls(path, **kwargs)
         except:
             return None
 
@@ -193,11 +385,143 @@ class SampledND(NeuronData):
         """
 
         offset = (grid_size - 1) / 2
-        return (
+        return int(round(
             grid_size ** 2 * (pos[0] + offset) +
             grid_size * (pos[1] + offset) +
             (pos[2] + offset)
-        )
+        ))
+
+    ## special methods
+
+    def __del__(self):
+        try:
+            self._arc.close()
+        except:
+            pass
+
+
+class VoxelBlockCache(object):
+    """read access to voxel data in an archive through a cache of voxel blocks
+
+    The voxel data node (voxels on the rows, samples on the columns) is read in
+    blocks of consecutive rows, the least recently used blocks are dropped when
+    the cache is full. If the node is chunked, blocks are aligned to the
+    chunks. Blocks are cached in the storage type (see nd_storage). Indexing
+    supports data[row] and data[row, phase].
+
+    float16 blocks without a given scale factor are scaled per block, as they
+    are read, so no pass over the whole node is needed. Indexing returns their
+    rows at full amplitude, in float64, and scale is 1.0.
+    """
+
+    ## constructor
+
+    def __init__(self, node, block_rows=None, max_blocks=256, dtype=None,
+                 scale=None, resample=None):
+        """
+        :Parameters:
+            node : tables.Array
+                The voxel data node.
+            block_rows : int
+                Number of rows per block. If None, the chunk size of the node
+                is used, or 64 for nodes that are not chunked.
+                Default=None
+            max_blocks : int
+                Maximal number of blocks in the cache.
+                Default=256
+            dtype : dtype
+                Storage type of the cached blocks, as in the node if None.
+                Default=None
+            scale : float
+                Scale factor for float16 storage, see nd_storage. If None,
+                float16 blocks are scaled per block. Ignored for other storage
+                types.
+                Default=None
+            resample : ndarray
+                Resampling matrix applied to the rows of each block as it is
+                read, see nd_resample_matrix.
+                Default=None
+        """
+
+        # block size
+        if block_rows is None:
+            block_rows = 64
+            if getattr(node, 'chunkshape', None) is not None:
+                block_rows = node.chunkshape[0]
+
+        # members
+        self.node = node
+        self.shape = node.shape
+        self.resample = resample
+        if resample is not None:
+            self.shape = (node.shape[0], resample.shape[0])
+        self.dtype = N.dtype(dtype or node.dtype)
+        self.scale = 1.0
+        self.block_scale = False
+        if self.dtype == N.float16:
+            if scale is None:
+                self.block_scale = True
+            else:
+                self.scale = scale
+        self.block_rows = int(block_rows)
+        self.max_blocks = int(max(max_blocks, 1))
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._scales = {}
+
+    ## properties
+
+    def get_hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return self.hits / float(self.hits + self.misses)
+    hit_rate = property(get_hit_rate)
+
+    ## methods public
+
+    def get_block(self, idx):
+        """return the block with index idx, reading it on a cache miss"""
+
+        if idx in self._blocks:
+            self.hits += 1
+            block = self._blocks.pop(idx)
+        else:
+            self.misses += 1
+            block = self.node[idx * self.block_rows:(idx + 1) * self.block_rows]
+            if self.resample is not None:
+                block = N.dot(block, self.resample.T)
+            if self.block_scale is True:
+                block, self._scales[idx] = nd_storage(block, self.dtype)
+            else:
+                block = nd_storage(block, self.dtype, self.scale)[0]
+            if len(self._blocks) >= self.max_blocks:
+                self._scales.pop(self._blocks.popitem(last=False)[0], None)
+        self._blocks[idx] = block
+        return block
+
+    def clear(self):
+        """drop all cached blocks and reset the statistics"""
+
+        self._blocks.clear()
+        self._scales.clear()
+        self.hits = self.misses = 0
+
+    ## special methods
+
+    def __getitem__(self, key):
+        phase = slice(None)
+        if isinstance(key, tuple):
+            key, phase = key
+        row = int(key)
+        idx = row // self.block_rows
+        block = self.get_block(idx)
+        if self.block_scale is True:
+            return (block[row % self.block_rows][phase].astype(N.float64) *
+                    self._scales[idx])
+        return block[row % self.block_rows][phase]
+    def __len__(self):
+        return self.shape[0]
 
 
 ##---FUNCTIONS
@@ -222,12 +546,166 @@ def get_eap_range(iap_v):
     return start, stop
 
 
+def sampled_nd_chunked(path, path_out, chunk_rows=64):
+    """copy a SampledND archive, storing the voxel data in chunks of rows
+
+    Chunked voxel data is read block by block in lazy mode, without touching
+    the rest of the archive.
+
+    :Parameters:
+        path : str
+            Path to the archive.
+        path_out : str
+            Path to the new archive.
+        chunk_rows : int
+            Number of voxels per chunk.
+            Default=64
+    """
+
+    src = openFile(path, 'r')
+    dst = openFile(path_out, 'w')
+    try:
+        for node in src.listNodes('/'):
+            if node._v_pathname != '/LFP':
+                node._f_copy(dst.root, recursive=True)
+        lfp = src.getNode('/LFP')
+        chunk_rows = int(min(chunk_rows, lfp.shape[0]))
+        rval = dst.createCArray(
+            '/', 'LFP',
+            Float64Atom(),
+            lfp.shape,
+            chunkshape=(chunk_rows, lfp.shape[1])
+        )
+        for i in xrange(0, lfp.shape[0], chunk_rows):
+            rval[i:i + chunk_rows] = lfp[i:i + chunk_rows]
+    finally:
+        src.close()
+        dst.close()
+
+
+def sampled_nd_sidecar(path, cache_dir, **kwargs):
+    """base path of the preprocessed sidecar of a SampledND archive
+
+    The sidecar consists of <base>.npy, the voxel data in the storage type to
+    be memory-mapped, and <base>.npz, the remaining data and the grid
+    parameters. The base name is '<path hash>_<archive key>', see
+    nd_archive_key, so the sidecar of a changed archive has a new name and
+    older sidecars of the same archive and load options can be found by the
+    path hash.
+
+    :Parameters:
+        path : str
+            Path to the archive.
+        cache_dir : str
+            Directory of the sidecars.
+    :Keywords:
+        Load options that change the preprocessed data, e.g. rootUEP and dtype.
+    """
+
+    prefix = sha1(osp.realpath(path))
+    for k in sorted(kwargs):
+        prefix.update('%s=%r' % (k, kwargs[k]))
+    prefix = prefix.hexdigest()[:16]
+    return osp.join(cache_dir, '%s_%s' % (prefix,
+                                          nd_archive_key(path, **kwargs)))
+
+
 ##---PACKAGE
 
-__all__ = ['SampledND', 'get_eap_range']
+__all__ = [
+    'SampledND',
+    'VoxelBlockCache',
+    'get_eap_range',
+    'sampled_nd_chunked',
+    'sampled_nd_sidecar',
+]
 
 
 ##---MAIN
 
 if __name__ == '__main__':
-    pass
+
+    import os, shutil, tempfile, time
+
+    # bounds for the error relative to the data maximum, per storage and
+    # accumulation type. float16 rounds to half an ulp of the block maximum,
+    # 2**-11, float32 to 2**-24 per value plus the rounding of the sums.
+    REL_ERROR_MAX = {
+        ('float64', 'float64'): 1e-12,
+        ('float32', 'float64'): 1e-6,
+        ('float32', 'float32'): 1e-6,
+        ('float16', 'float64'): 1e-3,
+    }
+
+    # inits, a synthetic archive with a field decaying from the soma
+    tmp_dir = tempfile.mkdtemp()
+    path = osp.join(tmp_dir, 'synthetic.h5')
+    path_chunked = osp.join(tmp_dir, 'synthetic_chunked.h5')
+    gs, step, nsmpl = 41, 5.0, 128
+    grid = (N.arange(gs) - (gs - 1) / 2) * step
+    X, Y, Z = N.meshgrid(grid, grid, grid, indexing='ij')
+    dist = N.sqrt(X ** 2 + Y ** 2 + Z ** 2).ravel() + step
+    wf = N.sin(N.linspace(0, 2 * N.pi, nsmpl)) * N.exp(-N.arange(nsmpl) / 20.)
+    arc = openFile(path, 'w')
+    arc.createArray('/', 'soma_v', wf)
+    arc.createArray('/', 'LFP', N.outer(1000.0 / dist ** 2, wf))
+    arc.createArray('/', 'el_pos_x', grid)
+    arc.createArray('/', 'el_pos_y', grid)
+    arc.createArray('/', 'el_pos_z', grid)
+    arc.createGroup('/', 'parameters')
+    arc.createArray('/parameters', 'timeres_python', 1000.0 / 16000.0)
+    arc.close()
+    sampled_nd_chunked(path, path_chunked)
+    print
+    print '## SAMPLED ND ## %d voxels of %d samples, %.1f MB' % (
+        gs ** 3, nsmpl, gs ** 3 * nsmpl * 8 / 2. ** 20)
+
+    # a neuron drifting past a tetrode, 4 channels per frame
+    pos = N.array([-60.0, 10.0, 5.0])
+    pts = N.array([[0, 0, 0], [8, 0, 0], [0, 8, 0], [0, 0, 8]], dtype=float)
+    track = [pos + N.array([0.05 * i, 0.0, 0.0]) + p
+             for i in xrange(2000) for p in pts]
+    print 'lazy  archive                storage acc      load     query' \
+        '    hit rate  rel. error'
+    for lazy, arc_path, dtype, acc_dtype in [
+        (False, path, None, None),
+        (True, path, None, None),
+        (True, path_chunked, None, None),
+        (False, path, N.float32, None),
+        (False, path, N.float32, N.float32),
+        (False, path, N.float16, None),
+        (True, path_chunked, N.float16, None),
+    ]:
+        tic = time.time()
+        nd = SampledND(arc_path, lazy=lazy, dtype=dtype, acc_dtype=acc_dtype)
+        t_load = time.time() - tic
+        tic = time.time()
+        rval = N.asarray([nd.get_data(p) for p in track])
+        t_query = time.time() - tic
+        if lazy is False and dtype is None:
+            ref = rval
+        key = (N.dtype(dtype or N.float64).name, nd.acc_dtype.name)
+        rel_err = abs(rval - ref).max() / abs(ref).max()
+        print '%-5s %-22s %-7s %-7s %.3f s  %.3f s  %-8s  %.2e' % (
+            lazy, osp.basename(arc_path), key[0][5:], key[1][5:],
+            t_load, t_query,
+            nd.cache_hit_rate and '%.4f' % nd.cache_hit_rate, rel_err)
+        assert rel_err < REL_ERROR_MAX[key], \
+            'relative error for %s storage, %s accumulation exceeds %.0e' % (
+                key + (REL_ERROR_MAX[key],))
+        del nd
+
+    # preprocessed sidecar, the first load writes it, later loads map it
+    cache_dir = osp.join(tmp_dir, 'cache')
+    for run in ['write', 'map']:
+        tic = time.time()
+        nd = SampledND(path, cache_dir=cache_dir)
+        t_load = time.time() - tic
+        rval = N.asarray([nd.get_data(p) for p in track])
+        rel_err = abs(rval - ref).max() / abs(ref).max()
+        print 'sidecar %-5s load %.3f s  rel. error %.2e' % (
+            run, t_load, rel_err)
+        assert rel_err < REL_ERROR_MAX['float64', 'float64'], \
+            'sidecar %s changes the data' % run
+        del nd
+    shutil.rmtree(tmp_dir)
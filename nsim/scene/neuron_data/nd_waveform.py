@@ -32,7 +32,7 @@ __docformat__ = 'restructuredtext'
 
 from tables import openFile
 import scipy as N
-from neuron_data import NeuronData
+from neuron_data import NeuronData, nd_storage
 from nsim.math import vector_norm
 
 
@@ -51,6 +51,8 @@ class WaveformND(NeuronData):
                  waveform=N.ones(32),
                  sample_rate=16000.0,
                  horizon=100.0,
+                 dtype=None,
+                 acc_dtype=None,
                  **kwargs):
         """
         :Parameters:
@@ -60,6 +62,15 @@ class WaveformND(NeuronData):
             sample_rate : float
                 Sample rate of the waveform in Hz.
                 Default=16000.0
+            horizon : float
+                The horizon in µm.
+                Default=100.0
+            dtype : dtype
+                Storage type of the waveform, see nd_storage.
+                Default=None
+            acc_dtype : dtype
+                Type of the returned data, float64 if None.
+                Default=None
         :Keywords:
             see NeuronData
         :Exceptions:
@@ -71,7 +82,8 @@ class WaveformND(NeuronData):
 
         # interface members
         self.intra_v = waveform.copy()
-        self.extra_v = waveform.copy()
+        self.extra_v, self.scale = nd_storage(waveform.copy(), dtype)
+        self.acc_dtype = N.dtype(acc_dtype or N.float64)
         self.horizon = horizon
         self.sample_rate = sample_rate
 
@@ -83,13 +95,16 @@ class WaveformND(NeuronData):
         Will scale the waveform with a distant dependent kernel.
         """
 
-        return WaveformND.kernel(pos) * self.extra_v[phase]
+        rval = self.extra_v[phase].astype(self.acc_dtype)
+        if self.scale != 1.0:
+            rval *= self.scale
+        return WaveformND.kernel(pos) * rval
 
 
     ## class methods
 
     @classmethod
-    def from_file(cls, path_to_arc, rootUEP='/'):
+    def from_file(cls, path_to_arc, rootUEP='/', **kwargs):
         """factory to create an SampledND from an archive
         
         :Parameters:
@@ -97,6 +112,12 @@ class WaveformND(NeuronData):
                 Path to the archive to load from
             rootUEP : str
                 user entry path
+        :Keywords:
+            dtype : dtype
+                see WaveformND
+            acc_dtype : dtype
+                see WaveformND
+            Other load options are ignored.
         :Return:
             WaveformND : if successfully loaded from the file
             None : on any error
@@ -104,7 +125,7 @@ class WaveformND(NeuronData):
 
         try:
             # are we good to go ?
-            arc = openFile(path_to_arc, mode='r', rootUEP='/')
+            arc = openFile(path_to_arc, mode='r', rootUEP=rootUEP)
             TYPE = arc.getNode('/__TYPE__').read()
             assert TYPE == 'NeuronData'
             CLASS = arc.getNode('/__CLASS__').read()
@@ -122,7 +143,9 @@ class WaveformND(NeuronData):
                waveform=param_waveform,
                horizon=param_horizon,
                sample_rate=param_sample_rate,
-               description=param_description
+               description=param_description,
+               dtype=kwargs.get('dtype', None),
+               acc_dtype=kwargs.get('acc_dtype', None)
             )
         except:
             return None
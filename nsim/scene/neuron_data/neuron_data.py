@@ -30,13 +30,415 @@ __docformat__ = 'restructuredtext'
 
 ##---IMPORTS
 
+import copy
+import cPickle
+import errno
+import os
+import os.path as osp
+import tempfile
+import time
+from fractions import Fraction
+from hashlib import sha1
+from multiprocessing import Pool, cpu_count
 import scipy as N
+from scipy.signal import firwin
 from tables import openFile
 from nsim.math import vector_norm
 
 # import all known NeuronData subclasses
 
 
+##---CONSTANTS
+
+# storage types by precision in bits, see [NUMERICS] in simulation.cfg
+ND_PRECISION = {
+    16: N.float16,
+    32: N.float32,
+    64: N.float64,
+}
+
+# directory for shared neuron data segments, tmpfs where available
+if osp.isdir('/dev/shm'):
+    ND_SHM_DIR = '/dev/shm/nsim'
+else:
+    ND_SHM_DIR = osp.join(tempfile.gettempdir(), 'nsim_shm')
+
+# directory for preprocessed neuron data sidecars
+ND_CACHE_DIR = osp.join(osp.expanduser('~'), '.nsim', 'nd_cache')
+
+
+##---FUNCTIONS
+
+def nd_storage(data, dtype=None, scale=None):
+    """cast voxel or waveform data to a storage type
+
+    float16 has a small range, so float16 data is scaled: the maximal absolute
+    value is mapped to 2**14, small values keep their relative precision down
+    to 1e-9 of the maximum. The data is restored with stored * scale.
+
+    :Parameters:
+        data : ndarray
+            The data in full precision.
+        dtype : dtype
+            The storage type, no cast if None.
+            Default=None
+        scale : float
+            The scale factor for float16. If None, it is derived from data.
+            Default=None
+    :Returns:
+        tuple : data in the storage type, scale factor
+    """
+
+    if dtype is None or N.dtype(dtype) == data.dtype:
+        return data, 1.0
+    if N.dtype(dtype) == N.float16:
+        if scale is None:
+            scale = max(abs(data).max(), 1e-300) / 2.0 ** 14
+        return (data / scale).astype(N.float16), scale
+    return data.astype(dtype), 1.0
+
+
+def nd_resample_matrix(rate_in, rate_out, size, half_taps=8, beta=5.0):
+    """polyphase resampling of a waveform, as a matrix
+
+    The ratio of the sample rates is approximated by a fraction up / down. The
+    waveform is upsampled by up, lowpass filtered with a Kaiser windowed FIR
+    filter and downsampled by down. Only the polyphase branch of the filter
+    that contributes to an output sample is evaluated, which gives a matrix of
+    shape (ceil(size * up / down), size) mapping a waveform (or the last axis
+    of voxel data) to the new sample rate.
+
+    :Parameters:
+        rate_in : float
+            Sample rate of the waveform.
+        rate_out : float
+            Sample rate to resample to.
+        size : int
+            Length of the waveform in samples.
+        half_taps : int
+            Half length of the filter per polyphase branch.
+            Default=8
+        beta : float
+            Kaiser window parameter.
+            Default=5.0
+    :Returns:
+        ndarray : the resampling matrix
+    """
+
+    ratio = Fraction(float(rate_out) / float(rate_in)).limit_denominator(100)
+    up, down = ratio.numerator, ratio.denominator
+    n = max(up, down)
+    h = firwin(2 * half_taps * n + 1, 1.0 / n, window=('kaiser', beta)) * up
+    nout = (size * up + down - 1) // down
+    idx = (N.arange(nout)[:, N.newaxis] * down -
+           N.arange(size)[N.newaxis, :] * up + half_taps * n)
+    valid = (idx >= 0) & (idx < h.size)
+    rval = N.zeros((nout, size))
+    rval[valid] = h[idx[valid]]
+    return rval
+
+
+def nd_archive_key(path, **kwargs):
+    """key for an archive and load options
+
+    The key is build from the real path, size and modification time of the
+    archive, so it changes when the archive changes, without reading it.
+
+    :Parameters:
+        path : str
+            Path to the archive.
+    :Keywords:
+        Load options, see NeuronDataContainer.
+    """
+
+    path = osp.realpath(path)
+    st = os.stat(path)
+    rval = sha1()
+    rval.update(path)
+    rval.update('%d:%d' % (st.st_size, st.st_mtime))
+    for k in sorted(kwargs):
+        rval.update('%s=%r' % (k, kwargs[k]))
+    return rval.hexdigest()
+
+
+def nd_shm_attach(key, name, data, shm_dir=None):
+    """publish an array as a shared segment, or attach to a published one
+
+    Segments are .npy files in shm_dir, memory-mapped read-only. The first
+    process publishes the data, later processes attach to the segment, so all
+    processes on a host share one copy in the page cache.
+
+    :Parameters:
+        key : str
+            Key of the archive, see nd_archive_key.
+        name : str
+            Name of the array.
+        data : ndarray
+            The array to publish, if the segment does not exist yet.
+        shm_dir : str
+            Directory of the segments, ND_SHM_DIR if None.
+            Default=None
+    :Returns:
+        ndarray : the read-only, memory-mapped segment, or data if publishing
+            failed
+    """
+
+    path = _nd_shm_path(key, name, shm_dir)
+    try:
+        rval = N.load(path, mmap_mode='r')
+        if rval.shape == data.shape and rval.dtype == data.dtype:
+            return rval
+    except:
+        pass
+    try:
+        if not osp.isdir(osp.dirname(path)):
+            os.makedirs(osp.dirname(path))
+        tmp_path = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+        N.save(tmp_path, N.ascontiguousarray(data))
+        os.rename(tmp_path, path)
+        return N.load(path, mmap_mode='r')
+    except:
+        return data
+
+
+def nd_shm_release(key, shm_dir=None):
+    """release the segments of key held by this process
+
+    Processes that publish or attach to segments register as holders (see
+    NeuronDataContainer). The segments and the published object are removed
+    with the last live holder, holders of processes that ended without
+    releasing are ignored.
+
+    :Parameters:
+        key : str
+            Key of the segments, see nd_shm_attach.
+        shm_dir : str
+            Directory of the segments, ND_SHM_DIR if None.
+            Default=None
+    :Returns:
+        int : count of removed segments
+    """
+
+    shm_dir = shm_dir or ND_SHM_DIR
+    try:
+        os.remove(_nd_shm_holder_path(key, os.getpid(), shm_dir))
+    except OSError:
+        pass
+    prefix = '%s_' % key
+    try:
+        fnames = [fname for fname in os.listdir(shm_dir)
+                  if fname.startswith(prefix)]
+    except OSError:
+        return 0
+    for fname in fnames:
+        if fname.startswith(prefix + 'holder.'):
+            if _nd_pid_alive(int(fname.split('.')[-2])):
+                return 0
+    rval = 0
+    for fname in fnames:
+        try:
+            os.remove(osp.join(shm_dir, fname))
+            if fname.endswith('.npy'):
+                rval += 1
+        except OSError:
+            pass
+    return rval
+
+
+def nd_shm_clear(shm_dir=None):
+    """remove all shared segments and published objects
+
+    :Parameters:
+        shm_dir : str
+            Directory of the segments, ND_SHM_DIR if None.
+            Default=None
+    :Returns:
+        int : count of removed segments
+    """
+
+    shm_dir = shm_dir or ND_SHM_DIR
+    if not osp.isdir(shm_dir):
+        return 0
+    rval = 0
+    for fname in os.listdir(shm_dir):
+        if fname.endswith('.npy') or fname.endswith('.pkl'):
+            try:
+                os.remove(osp.join(shm_dir, fname))
+                rval += 1
+            except OSError:
+                pass
+        elif fname.endswith('.pid'):
+            try:
+                os.remove(osp.join(shm_dir, fname))
+            except OSError:
+                pass
+    return rval
+
+
+def _nd_shm_path(key, name, shm_dir=None, ext='.npy'):
+    """path of a shared segment, see nd_shm_attach"""
+
+    return osp.join(shm_dir or ND_SHM_DIR, '%s_%s%s' % (key, name, ext))
+
+
+def _nd_shm_holder_path(key, pid, shm_dir=None):
+    """path of the holder file of a process for the segments of key"""
+
+    return _nd_shm_path(key, 'holder.%d' % pid, shm_dir, '.pid')
+
+
+def _nd_shm_hold(key, shm_dir=None):
+    """register this process as a holder of the segments of key, see
+    nd_shm_release"""
+
+    try:
+        open(_nd_shm_holder_path(key, os.getpid(), shm_dir), 'w').close()
+    except IOError:
+        pass
+
+
+def _nd_pid_alive(pid):
+    """True if a process with this pid exists"""
+
+    try:
+        os.kill(pid, 0)
+    except OSError, ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+def _nd_shm_key(path, **kwargs):
+    """segment key of an archive and load options
+
+    The key is the archive key (see nd_archive_key), prefixed with a tag of
+    the real path, so the segments of older versions of the same archive can
+    be found, see _nd_shm_drop_stale.
+    """
+
+    tag = sha1(osp.realpath(path)).hexdigest()[:16]
+    return '%s-%s' % (tag, nd_archive_key(path, **kwargs))
+
+
+def _nd_shm_publish(key, ndata, names, shm_dir=None):
+    """publish a NeuronData object whose arrays names are shared segments
+
+    The object is pickled without these arrays, next to the segments. The
+    object file is written last, so its presence means all segments exist.
+    Objects that can not be pickled (e.g. lazy, with an open archive) are
+    not published.
+    """
+
+    # the state, not a copy: a copy would close the archive of ndata on
+    # deletion (see SampledND.__del__)
+    state = dict(ndata.__dict__)
+    for name in names:
+        state[name] = None
+    path = _nd_shm_path(key, 'object', shm_dir, '.pkl')
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        f = open(tmp_path, 'wb')
+        try:
+            cPickle.dump((ndata.__class__, state, names), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _nd_shm_load(key, shm_dir=None):
+    """attach to a published NeuronData object, see _nd_shm_publish
+
+    :Returns:
+        NeuronData : the object with its arrays attached as segments, or None
+            if the object is not published
+    """
+
+    path = _nd_shm_path(key, 'object', shm_dir, '.pkl')
+    try:
+        # only trust objects published by this user
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        f = open(path, 'rb')
+        try:
+            cls, state, names = cPickle.load(f)
+        finally:
+            f.close()
+        ndata = cls.__new__(cls)
+        ndata.__dict__.update(state)
+        for name in names:
+            setattr(ndata, name, N.load(_nd_shm_path(key, name, shm_dir),
+                                        mmap_mode='r'))
+    except:
+        return None
+    return ndata
+
+
+def _nd_shm_drop_stale(key, shm_dir=None):
+    """remove the segments of other keys for the archive of key
+
+    Segments of an archive that changed on disk, or that was loaded with
+    other load options, are not attached to again and would hold their copy
+    of the data in memory until nd_shm_clear.
+
+    :Returns:
+        int : count of removed files
+    """
+
+    shm_dir = shm_dir or ND_SHM_DIR
+    tag = key.split('-')[0] + '-'
+    rval = 0
+    try:
+        fnames = os.listdir(shm_dir)
+    except OSError:
+        return 0
+    for fname in fnames:
+        if fname.startswith(tag) and not fname.startswith(key + '_'):
+            try:
+                os.remove(osp.join(shm_dir, fname))
+                rval += 1
+            except OSError:
+                pass
+    return rval
+
+
+def _nd_load(args):
+    """load a NeuronData subclass from an archive in a worker process
+
+    With a segment key, the arrays of the NeuronData object are published as
+    shared segments (see nd_shm_attach) and removed from the object, so they
+    are not pickled on the way back to the calling process.
+
+    :Parameters:
+        args : tuple
+            The NeuronData subclass, the path, the load options, the segment
+            key or None and the segment directory.
+    :Returns:
+        tuple : NeuronData or None, names of the published arrays, load time
+            in seconds
+    """
+
+    cls, path, kwargs, key, shm_dir = args
+    tic = time.time()
+    names = []
+    try:
+        ndata = cls.from_file(path, **kwargs)
+    except:
+        ndata = None
+    if ndata is not None and key is not None:
+        for name in ndata.SHARED_MEMBERS:
+            value = getattr(ndata, name, None)
+            if isinstance(value, N.ndarray):
+                if isinstance(nd_shm_attach(key, name, value, shm_dir),
+                              N.memmap):
+                    setattr(ndata, name, None)
+                    names.append(name)
+    return ndata, names, time.time() - tic
+
 
 ##---CLASSES
 
@@ -66,6 +468,20 @@ class NeuronData(object):
     description string is also used to compare NeuronData instances.  
     """
 
+    ## class members
+
+    # array members that can be placed in shared memory
+    SHARED_MEMBERS = ['intra_v', 'extra_v']
+
+    # number of radii of the radial profile, see get_radial
+    RADIAL_SIZE = 32
+
+    # number of cells per axis of the peak map, see get_peak
+    PEAK_GRID = 16
+
+    # array members with the samples on the last axis, see resampled
+    RESAMPLED_MEMBERS = ['extra_v']
+
     ## constructor
 
     def __init__(self, description=None, **kwargs):
@@ -94,6 +510,14 @@ class NeuronData(object):
         # the temporal sample rate [scalar in Hz]
         self.sample_rate = None
 
+        # radial profile and peak map, built on first use
+        self._radial = None
+        self._peak_map = None
+
+        # copies at other sample rates, see resampled
+        self._resampled = {}
+        self._source = None
+
     ## interface methods - public
 
     def get_data(self, pos, phase=None):
@@ -126,6 +550,215 @@ class NeuronData(object):
         # call get_data implementation
         return self._get_data(pos, phase)
 
+    def get_radial(self, dist):
+        """return the radial approximation of the waveform at a distance
+
+        The radial profile holds the waveform averaged over 26 directions (the
+        faces, edges and corners of a cube) at RADIAL_SIZE radii up to the
+        horizon. It is built from get_data on first use, the approximation is
+        interpolated linearly between two radii.
+
+        :Parameters:
+            dist : float
+                Distance from the neuron.
+        """
+
+        radii, waveforms = self._get_radial_profile()
+        idx = N.clip(N.searchsorted(radii, dist) - 1, 0, radii.size - 2)
+        alpha = N.clip((dist - radii[idx]) / (radii[idx + 1] - radii[idx]),
+                       0.0, 1.0)
+        return waveforms[idx] + alpha * (waveforms[idx + 1] - waveforms[idx])
+
+    def get_peak(self, pos):
+        """return a bound of the peak absolute voltage at relative positions
+
+        The bound is read from the peak map, a grid of PEAK_GRID cells per axis
+        over the cube around the horizon. A cell holds the maximal absolute
+        voltage of the voxels in the cell and their direct neighbours, so it
+        bounds the trilinear interpolation anywhere in the cell. The map is
+        built once, on first use (see _get_peak_voxels).
+
+        :Parameters:
+            pos : ndarray
+                Relative positions, one per row.
+        """
+
+        peaks, cell = self._get_peak_map()
+        idx = ((N.atleast_2d(pos) + self.horizon) / cell).astype(int)
+        idx = N.clip(idx, 0, peaks.shape[0] - 1)
+        return peaks[idx[:, 0], idx[:, 1], idx[:, 2]]
+
+    def _get_peak_map(self):
+        """peak map and its cell size, see get_peak"""
+
+        if self._peak_map is None:
+
+            # dilate the voxel peaks by one voxel
+            step, peaks = self._get_peak_voxels()
+            m = peaks.shape[0]
+            pad = N.zeros((m + 2,) * 3)
+            pad[1:-1, 1:-1, 1:-1] = peaks
+            for i in xrange(3):
+                for j in xrange(3):
+                    for k in xrange(3):
+                        peaks = N.maximum(peaks, pad[i:i + m, j:j + m, k:k + m])
+
+            # maximum per cell
+            ncells = min(self.PEAK_GRID, m - 1)
+            cell = 2.0 * self.horizon / ncells
+            coords = (N.arange(m) - 0.5 * (m - 1)) * step
+            idx = N.clip(((coords + self.horizon) / cell).astype(int),
+                         0, ncells - 1)
+            starts = N.nonzero(N.diff(N.concatenate(([-1], idx))))[0]
+            for axis in xrange(3):
+                peaks = N.maximum.reduceat(peaks, starts, axis=axis)
+            self._peak_map = peaks, cell
+        return self._peak_map
+
+    def _get_peak_voxels(self):
+        """grid step and peak absolute voltage per voxel, shape (m, m, m)
+
+        Subclasses with voxel data should compute this from their data. This
+        implementation evaluates _get_data on the voxel grid, or on a grid of
+        33 points per axis for data without voxel grid.
+        """
+
+        size = getattr(self, 'grid_size', None)
+        step = getattr(self, 'grid_step', None)
+        if size is None or step is None:
+            size, step = 33, self.horizon / 16.0
+        size = int(size)
+        coords = (N.arange(size) - 0.5 * (size - 1)) * step
+        coords[-1] -= 1e-6 * step
+        phase = xrange(self.intra_v.size)
+        rval = N.empty((size,) * 3)
+        for i in xrange(size):
+            for j in xrange(size):
+                for k in xrange(size):
+                    try:
+                        rval[i, j, k] = abs(self._get_data(
+                            N.asarray([coords[i], coords[j], coords[k]]),
+                            phase
+                        )).max()
+                    except (ArithmeticError, IndexError):
+                        rval[i, j, k] = N.inf
+        return step, rval
+
+    def _get_radial_profile(self):
+        """radii and waveforms of the radial profile"""
+
+        if self._radial is None:
+            dirs = N.asarray([
+                (i, j, k)
+                for i in xrange(-1, 2) for j in xrange(-1, 2)
+                for k in xrange(-1, 2) if (i, j, k) != (0, 0, 0)
+            ], dtype=float)
+            dirs /= N.sqrt((dirs ** 2).sum(axis=1))[:, N.newaxis]
+            radii = N.linspace(0.0, 0.999 * self.horizon,
+                               self.RADIAL_SIZE + 1)[1:]
+            waveforms = N.empty((radii.size, self.intra_v.size))
+            for i in xrange(radii.size):
+                waveforms[i] = N.mean([self.get_data(radii[i] * u)
+                                       for u in dirs], axis=0)
+            self._radial = radii, waveforms
+        return self._radial
+
+    def resampled(self, sample_rate, cache_dir=None):
+        """return this neuron data at another sample rate
+
+        The copy holds intra_v and the RESAMPLED_MEMBERS resampled once (see
+        nd_resample_matrix), so queries never resample. Copies are kept per
+        sample rate. With a cache directory, the resampled arrays of neuron
+        data loaded from an archive are stored there and memory-mapped by later
+        calls, in this or any other process.
+
+        :Parameters:
+            sample_rate : float
+                The sample rate to resample to.
+            cache_dir : str
+                Directory to store the resampled arrays in, None for no disk
+                cache.
+                Default=None
+        :Returns:
+            NeuronData : the copy, or the original neuron data if the sample
+                rates match or either is unknown
+        """
+
+        src = self._source or self
+        if sample_rate is None or src.sample_rate is None or \
+        abs(sample_rate - src.sample_rate) < 1e-6 * src.sample_rate:
+            return src
+        key = float(sample_rate)
+        if key not in src._resampled:
+            src._resampled[key] = src._make_resampled(key, cache_dir)
+        return src._resampled[key]
+
+    def _make_resampled(self, sample_rate, cache_dir):
+        """build the copy at sample_rate, see resampled"""
+
+        # prefix of the cached arrays
+        prefix = None
+        if cache_dir is not None and getattr(self, 'filename', None):
+            key = sha1(nd_archive_key(self.filename))
+            key.update('%s:%s:%r:%r' % (self.__class__.__name__,
+                                        self.description, self.sample_rate,
+                                        sample_rate))
+            prefix = osp.join(cache_dir, 'rs_%s' % key.hexdigest()[:16])
+
+        # copy, sharing all but the resampled arrays
+        R = nd_resample_matrix(self.sample_rate, sample_rate,
+                               self.intra_v.size)
+        rval = copy.copy(self)
+        rval.__dict__.pop('_arc', None)
+        rval.sample_rate = sample_rate
+        rval._radial = None
+        rval._peak_map = None
+        rval._resampled = {}
+        rval._source = self
+        for name in ['intra_v'] + self.RESAMPLED_MEMBERS:
+            setattr(rval, name, self._resample_member(name, R, prefix))
+        return rval
+
+    def _resample_member(self, name, R, prefix=None):
+        """resample an array member in its storage type, see resampled"""
+
+        # from the disk cache
+        value = getattr(self, name)
+        path = None
+        if prefix is not None:
+            path = '%s_%s_%s.npy' % (prefix, name, value.dtype.name)
+            try:
+                rval = N.load(path, mmap_mode='r')
+                if rval.shape == value.shape[:-1] + (R.shape[0],):
+                    return rval
+            except:
+                pass
+
+        # resample in blocks
+        if value.ndim == 1:
+            rval = N.dot(R, N.asarray(value, dtype=N.float64))
+            rval = rval.astype(value.dtype)
+        else:
+            rval = N.empty((value.shape[0], R.shape[0]), dtype=value.dtype)
+            for i in xrange(0, value.shape[0], 4096):
+                rval[i:i + 4096] = N.dot(
+                    N.asarray(value[i:i + 4096], dtype=N.float64),
+                    R.T
+                )
+
+        # to the disk cache
+        if path is not None:
+            try:
+                if not osp.isdir(osp.dirname(path)):
+                    os.makedirs(osp.dirname(path))
+                tmp_path = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+                N.save(tmp_path, rval)
+                os.rename(tmp_path, path)
+                rval = N.load(path, mmap_mode='r')
+            except:
+                pass
+        return rval
+
     @classmethod
     def from_file(cls, path):
         """abstract factory method to create an instance from an archive"""
@@ -157,17 +790,99 @@ class NeuronDataContainer(dict):
     
     The NeuronDataContainer will assert the uniqueness of its contents, using
     the description string of the NeuronData objects.
+
+    Archives are resolved by path: the container remembers every archive it
+    has probed or loaded, keyed by real path, size and modification time (see
+    nd_archive_key), so each archive is read at most once per process. An
+    archive that changes on disk is loaded again.
+
+    In shared mode, the arrays of NeuronData objects loaded from archives are
+    placed in shared memory segments keyed by the archive and the load options
+    (see nd_shm_attach), so processes loading the same archive share one copy.
+    The object itself is published with the segments, and later processes
+    attach to it without reading the archive. Publishing a new key for an
+    archive removes the segments of its older keys. The container holds the
+    segments it publishes or attaches to until close, the last process to
+    release them removes them (see nd_shm_release).
+
+    The container holds the neuron data at the sample rate of the archives.
+    With a sample rate set, resampled returns the copy at that rate (see
+    NeuronData.resampled). Copies are built for all contents when the sample
+    rate is set, and stored with the sidecars if the load options hold a
+    cache_dir.
     """
 
     ## constructor
 
-    def __init__(self):
+    def __init__(self, shared=False, shm_dir=None, **kwargs):
+        """
+        :Parameters:
+            shared : bool
+                If True, share the arrays of loaded NeuronData objects across
+                processes.
+                Default=False
+            shm_dir : str
+                Directory of the shared segments, ND_SHM_DIR if None.
+                Default=None
+        :Keywords:
+            Load options, passed to the from_file factory of the NeuronData
+            subclasses when loading from archives (e.g. lazy for SampledND,
+            dtype and acc_dtype for the storage and computation types of
+            SampledND and WaveformND).
+        """
 
         # super
         super(NeuronDataContainer, self).__init__()
 
+        # members
+        self.load_kwargs = kwargs
+        self.shared = bool(shared)
+        self.shm_dir = shm_dir
+        self._archives = {}
+        self._sample_rate = None
+        self._shm_keys = set()
+
+    ## properties
+
+    def get_paths(self):
+        rval = []
+        for ndata in self._archives.values():
+            if ndata is None:
+                continue
+            path = osp.dirname(ndata.filename)
+            if path not in rval:
+                rval.append(path)
+        return rval
+    paths = property(get_paths)
+
+    def get_sample_rate(self):
+        return self._sample_rate
+    def set_sample_rate(self, value):
+        if value is not None:
+            value = float(value)
+        self._sample_rate = value
+        for ndata in self.values():
+            self.resampled(ndata)
+    sample_rate = property(get_sample_rate, set_sample_rate)
+
     ## public methods
 
+    def resampled(self, ndata):
+        """return neuron data at the sample rate of the container
+
+        :Parameters:
+            ndata : NeuronData
+                The neuron data, at any sample rate.
+        :Returns:
+            NeuronData : the copy at the sample rate, or ndata if no sample
+                rate is set
+        """
+
+        if self._sample_rate is None:
+            return ndata
+        return ndata.resampled(self._sample_rate,
+                               self.load_kwargs.get('cache_dir', None))
+
     def insert(self, ndata_list):
         """insert a list of NeuronData objects
 
@@ -202,6 +917,154 @@ class NeuronDataContainer(dict):
         # return the count of inserted NeuronData objects
         return rval
 
+    def close(self):
+        """release the shared segments and drop all contents
+
+        Segments are removed if no other live process holds them, see
+        nd_shm_release. Archives are loaded again on the next resolve.
+
+        :Returns:
+            int : count of removed segments
+        """
+
+        rval = 0
+        for key in self._shm_keys:
+            rval += nd_shm_release(key, self.shm_dir)
+        self._shm_keys.clear()
+        self._archives.clear()
+        self.clear()
+        return rval
+
+    def preload(self, path_lists, processes=None):
+        """load a set of archives concurrently
+        
+        The archives are loaded in a pool of worker processes and inserted like
+        archives loaded with resolve, so later calls to resolve or insert for
+        these archives do not read them again. The workers pass the arrays
+        back as segments in shm_dir, which are removed again unless the
+        container is shared. Lazy archives keep their file open and are loaded
+        in this process, as are all archives on a single cpu. In shared mode,
+        archives published by another process are attached to, not loaded.
+
+        :Parameters:
+            path_lists : list
+                A list of candidate path lists, one per archive, see resolve.
+            processes : int
+                Number of worker processes, the number of cpus if None.
+                Default=None
+        :Returns:
+            list : (path, seconds) for all loaded archives, seconds is None if
+                loading failed.
+        """
+
+        # collect the distinct archives to load, attach to published ones
+        jobs = {}
+        attached = []
+        for path_list in path_lists:
+            if not isinstance(path_list, list):
+                path_list = [path_list]
+            for path in path_list:
+                try:
+                    key = nd_archive_key(path)
+                except OSError:
+                    continue
+                if key in self._archives or key in jobs:
+                    break
+                if self.shared is True:
+                    tic = time.time()
+                    seg_key = _nd_shm_key(path, **self.load_kwargs)
+                    ndata = _nd_shm_load(seg_key, self.shm_dir)
+                    if ndata is not None:
+                        self._shm_hold(seg_key)
+                        ndata.filename = osp.realpath(path)
+                        self.__setitem__(ndata.description, ndata)
+                        self._archives[key] = ndata
+                        attached.append((path, time.time() - tic))
+                        break
+                cls = self._probe(path)
+                if cls is None:
+                    self._archives[key] = None
+                    continue
+                jobs[key] = (cls, path)
+                break
+        if len(jobs) == 0:
+            return attached
+
+        # load in the pool, the arrays are passed back as segments
+        keys = sorted(jobs)
+        processes = min(processes or cpu_count(), len(keys))
+        results = None
+        if processes > 1 and self.load_kwargs.get('lazy', False) is False:
+            args = []
+            for key in keys:
+                cls, path = jobs[key]
+                if self.shared is True:
+                    seg_key = _nd_shm_key(path, **self.load_kwargs)
+                else:
+                    seg_key = '%s.%d.load' % (key, os.getpid())
+                args.append((cls, path, self.load_kwargs, seg_key,
+                             self.shm_dir))
+            try:
+                pool = Pool(processes)
+                try:
+                    results = pool.map(_nd_load, args)
+                finally:
+                    pool.close()
+                    pool.join()
+            except:
+                results = None
+
+        # load in this process
+        if results is None:
+            args = [(jobs[key][0], jobs[key][1], self.load_kwargs, None, None)
+                    for key in keys]
+            results = map(_nd_load, args)
+
+        # record
+        rval = attached
+        for key, arg, (ndata, names, dt) in zip(keys, args, results):
+            path, seg_key = arg[1], arg[3]
+            for name in names:
+                seg_path = _nd_shm_path(seg_key, name, self.shm_dir)
+                value = N.load(seg_path, mmap_mode='r')
+                if self.shared is False:
+                    value = N.array(value)
+                    os.remove(seg_path)
+                setattr(ndata, name, value)
+            if ndata is not None:
+                ndata.filename = osp.realpath(path)
+                if self.shared is True:
+                    self._share(ndata, _nd_shm_key(path, **self.load_kwargs))
+                self.__setitem__(ndata.description, ndata)
+            else:
+                dt = None
+            self._archives[key] = ndata
+            rval.append((path, dt))
+        return rval
+
+    def resolve(self, path_list):
+        """return the NeuronData object for the first loadable archive
+        
+        Archives are loaded and inserted on first use only, later calls for the
+        same archive return the NeuronData object from the container.
+
+        :Parameters:
+            path_list : list
+                A list of candidate paths to the archive.
+        :Returns:
+            NeuronData : The NeuronData object in the container.
+            None : If none of the paths is a loadable archive.
+        """
+
+        if not isinstance(path_list, list):
+            path_list = [path_list]
+        for path in path_list:
+            ndata = self._ndata_from_file(path)
+            if ndata is not None:
+                self.__setitem__(ndata.description, ndata)
+                return ndata
+        return None
+
     ## private methods
 
     def _insert(self, ndata_item):
@@ -225,6 +1088,39 @@ class NeuronDataContainer(dict):
         else:
             return False
 
+    def _share(self, ndata, key):
+        """replace the array members of ndata with shared segments
+
+        If all array members are shared, ndata is published for later loads
+        (see _nd_shm_publish). Segments of older keys of the archive are
+        removed.
+        """
+
+        names = []
+        published = True
+        for name in ndata.SHARED_MEMBERS:
+            value = getattr(ndata, name, None)
+            if isinstance(value, N.ndarray):
+                value = nd_shm_attach(key, name, value, self.shm_dir)
+                setattr(ndata, name, value)
+                if isinstance(value, N.memmap):
+                    names.append(name)
+                else:
+                    published = False
+            elif value is not None:
+                published = False
+        if published is True and len(names) > 0:
+            _nd_shm_publish(key, ndata, names, self.shm_dir)
+        if len(names) > 0:
+            self._shm_hold(key)
+        _nd_shm_drop_stale(key, self.shm_dir)
+
+    def _shm_hold(self, key):
+        """hold the segments of key until close, see nd_shm_release"""
+
+        _nd_shm_hold(key, self.shm_dir)
+        self._shm_keys.add(key)
+
     def _ndata_from_file(self, path):
         """try to load a NeuronData subclass from a file
         
@@ -234,6 +1130,9 @@ class NeuronDataContainer(dict):
         where '#TYPE' defaults to 'NeuronData' and '#CLASS' must hold the class
         name as given by the __class__ attribute of a subclass of NeuronData.
         Else loading of the archive will fail! 
+
+        The result is cached per archive, for archives that were loaded as well
+        as for archives that failed the header probe or the loading.
         
         :Parameters:
             path : str
@@ -245,6 +1144,51 @@ class NeuronDataContainer(dict):
                 loaded as a subclass of NeuronData.  
         """
 
+        # resolve
+        try:
+            key = nd_archive_key(path)
+        except OSError:
+            return None
+        if key in self._archives:
+            return self._archives[key]
+
+        # attach to the published object, without reading the archive
+        ndata = None
+        seg_key = None
+        if self.shared is True:
+            seg_key = _nd_shm_key(path, **self.load_kwargs)
+            ndata = _nd_shm_load(seg_key, self.shm_dir)
+            if ndata is not None:
+                self._shm_hold(seg_key)
+                ndata.filename = osp.realpath(path)
+                self._archives[key] = ndata
+                return ndata
+
+        # probe and load
+        cls = self._probe(path)
+        if cls is not None:
+            try:
+                ndata = cls.from_file(path, **self.load_kwargs)
+            except:
+                ndata = None
+        if ndata is not None:
+            ndata.filename = osp.realpath(path)
+            if seg_key is not None:
+                self._share(ndata, seg_key)
+        self._archives[key] = ndata
+        return ndata
+
+    def _probe(self, path):
+        """read the '#TYPE' and '#CLASS' header of an archive
+        
+        :Parameters:
+            path : str
+                The path to the file.
+        :Return:
+            class : The NeuronData subclass to load the archive with.
+            None : If the archive has no valid NeuronData header.
+        """
+
         # get class function
         def get_class(kls):
             parts = kls.split('.')
@@ -259,9 +1203,7 @@ class NeuronDataContainer(dict):
             TYPE = str(arc.getNode('/#TYPE').read())
             assert TYPE == 'NeuronData'
             CLASS = str(arc.getNode('/#CLASS').read())
-            cls = get_class('nsim.scene.neuron_data.%s' % CLASS)
-            ndata = cls.from_file(path)
-            return ndata
+            return get_class('nsim.scene.neuron_data.%s' % CLASS)
         except:
             return None
         finally:
@@ -274,9 +1216,71 @@ class NeuronDataContainer(dict):
 
 ##---MAIN
 
-__all__ = ['NeuronData', 'NeuronDataContainer']
+__all__ = [
+    'ND_CACHE_DIR',
+    'ND_PRECISION',
+    'ND_SHM_DIR',
+    'NeuronData',
+    'NeuronDataContainer',
+    'nd_archive_key',
+    'nd_resample_matrix',
+    'nd_shm_attach',
+    'nd_shm_clear',
+    'nd_shm_release',
+    'nd_storage',
+]
 
 if __name__ == '__main__':
 
-    CONTI = NeuronDataContainer()
-    print CONTI.insert('/home/phil/Data/Einevoll/LFP-20100516_225124.h5')
+    from nd_waveform import ScalingWaveformND
+
+    # bounds of the resampling: max error for sines in the passband, up to
+    # half the lower nyquist frequency, and error of the realised rate, from
+    # the rate ratio limited to a denominator of 100
+    PASSBAND = 0.5
+    PASSBAND_ERROR_MAX = 3e-3
+    RATE_ERROR_MAX = 1e-3
+
+    # accuracy, sines resampled and compared to the sines sampled at the
+    # realised rate, away from the edges
+    print
+    print '## RESAMPLING ## sines up to %.1f nyquist, 256 samples' % PASSBAND
+    print 'rate in -> out    samples  rate error  max error'
+    for rate_in, rate_out in [(16000.0, 32000.0), (32000.0, 16000.0),
+                              (16000.0, 44100.0), (44100.0, 16000.0),
+                              (24000.0, 16000.0)]:
+        R = nd_resample_matrix(rate_in, rate_out, 256)
+        ratio = Fraction(rate_out / rate_in).limit_denominator(100)
+        rate_real = rate_in * ratio.numerator / ratio.denominator
+        nyquist = min(rate_in, rate_out) / 2.0
+        mid = slice(R.shape[0] / 8, R.shape[0] - R.shape[0] / 8)
+        err = 0.0
+        for freq in N.linspace(0.05, PASSBAND, 10) * nyquist:
+            wf = N.dot(R, N.sin(2 * N.pi * freq * N.arange(256) / rate_in))
+            ref = N.sin(2 * N.pi * freq * N.arange(R.shape[0]) / rate_real)
+            err = max(err, abs(wf[mid] - ref[mid]).max())
+        rate_err = abs(rate_real / rate_out - 1.0)
+        print '%5d -> %5d Hz  %7d  %10.1e  %9.1e' % (
+            rate_in, rate_out, R.shape[0], rate_err, err)
+        assert err < PASSBAND_ERROR_MAX, \
+            'passband error of %s -> %s Hz exceeds %.0e' % (
+                rate_in, rate_out, PASSBAND_ERROR_MAX)
+        assert rate_err < RATE_ERROR_MAX, \
+            'realised rate of %s -> %s Hz is off by %.1e' % (
+                rate_in, rate_out, rate_err)
+
+    # the copy is built once, queries cost the same as at the native rate
+    nd = ScalingWaveformND(waveform=N.sin(N.arange(64) / 4.0))
+    tic = time.time()
+    nd32 = nd.resampled(32000.0)
+    print 'build copy at 32 kHz  : %.2f ms' % ((time.time() - tic) * 1e3)
+    tic = time.time()
+    assert nd.resampled(32000.0) is nd32, 'copy is not cached'
+    print 'second call (cached)  : %.3f ms' % ((time.time() - tic) * 1e3)
+    assert nd32.resampled(16000.0) is nd, 'copy does not resolve its source'
+    pos = N.asarray([10.0, 0.0, 0.0])
+    for name, ndata in [('16 kHz', nd), ('32 kHz', nd32)]:
+        tic = time.time()
+        for i in xrange(10000):
+            ndata.get_data(pos)
+        print '10000 queries %s  : %.3f s' % (name, time.time() - tic)
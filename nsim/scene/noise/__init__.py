@@ -33,6 +33,12 @@ __docformat__ = "restructuredtext"
 # packages
 from noise_gen import *
 from ar_model import *
+from spectral import *
+from lowrank import *
+from producer import *
+from bank import *
+from library import *
+from background import *
 
 
 ##---MAIN
@@ -30,16 +30,22 @@ __docformat__ = "restructuredtext"
 
 ##---IMPORTS
 
+# builtins
+import os
+import os.path as osp
+from collections import deque
+from hashlib import sha1
 # packages
 import scipy as N
 from scipy import linalg as NL, random as NR
-from collections import deque
 from noise_gen import NoiseGen
 
 
 ##---CONSTANTS
 
 EPS = N.finfo(N.float64).eps
+AR_CACHE_DIR = osp.join(osp.expanduser('~'), '.nsim', 'ar_cache')
+_AR_FIT_CACHE = {}
 
 
 ##---FUNCTIONS
@@ -75,6 +81,111 @@ def ar_fit(p_data, p_or_plist=range(100), selector='sbc'):
         raise ValueError('time series to short!')
     R = _ar_model_qr(data, p_max)
 
+    # return
+    return _ar_model_build(R, m, ne, p_or_plist, selector)
+
+
+def ar_fit_cached(p_data, p_or_plist=range(100), selector='sbc',
+                  cache_dir=None):
+    """fits a (multivariate) AR model to data, reusing earlier fits
+
+    Fits are cached in memory and as .npz files in cache_dir, keyed by a hash
+    of the data and the fit parameters. Cache io errors are ignored and the
+    model is fitted as if no cache was present.
+
+    :Parameters:
+        p_data : ndarray
+            Data with observations on the rows and variables on the columns
+        p_or_plist : list
+            see ar_fit
+        selector : str
+            see ar_fit
+        cache_dir : str
+            Directory for the persistent cache. If None, AR_CACHE_DIR is used
+            and if that is None as well, the cache is kept in memory only.
+            Default=None
+    :Returns:
+        tuple : A, C, crit as returned by ar_fit
+    """
+
+    # build key
+    if not isinstance(p_data, N.ndarray):
+        raise ValueError('p_data is not an ndarray')
+    if not isinstance(p_or_plist, list):
+        p_or_plist = [p_or_plist]
+    key = _ar_model_hash(p_data, N.asarray(p_or_plist), selector)
+
+    # memory lookup
+    if key in _AR_FIT_CACHE:
+        return _AR_FIT_CACHE[key]
+
+    # disk lookup
+    rval = None
+    cache_file = None
+    if cache_dir is None:
+        cache_dir = AR_CACHE_DIR
+    if cache_dir is not None:
+        cache_file = osp.join(cache_dir, '%s.npz' % key)
+        try:
+            arc = N.load(cache_file)
+            rval = arc['A'], arc['C'], arc['crit']
+            arc.close()
+        except:
+            rval = None
+
+    # fit and save
+    if rval is None:
+        rval = ar_fit(p_data, p_or_plist, selector)
+        if cache_file is not None:
+            try:
+                if not osp.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_file = '%s.%d.tmp.npz' % (cache_file[:-4], os.getpid())
+                N.savez(tmp_file, A=rval[0], C=rval[1], crit=rval[2])
+                os.rename(tmp_file, cache_file)
+            except:
+                pass
+
+    # return
+    _AR_FIT_CACHE[key] = rval
+    return rval
+
+
+def _ar_model_hash(*args):
+    """hex digest over ndarrays and strings, used as cache key"""
+
+    rval = sha1()
+    for item in args:
+        if isinstance(item, N.ndarray):
+            item = N.ascontiguousarray(item)
+            rval.update('%s%s' % (item.dtype.str, item.shape))
+            rval.update(item.tostring())
+        else:
+            rval.update(str(item))
+    return rval.hexdigest()
+
+
+def _ar_model_build(R, m, ne, p_or_plist, selector):
+    """select the model order and build the model from the triangular factor
+
+    :Parameters:
+        R : ndarray
+            upper triangular mx from QR for the maximal model order
+        m : int
+            state vector dimension
+        ne : int
+            number of bock equations of size m used in the estimation
+        p_or_plist : list
+            list of model orders to select from
+        selector : str
+            one of 'sbc' or 'fpe'
+    :Returns:
+        tuple : A, C, crit
+    """
+
+    # inits
+    npmax = m * max(p_or_plist)
+
     # model order selection
     if len(p_or_plist) > 1:
         sbc, fpe, ldp, np = _ar_model_select(R, m, ne, p_or_plist)
@@ -84,7 +195,7 @@ def ar_fit(p_data, p_or_plist=range(100), selector='sbc'):
             crit = fpe
     else:
         crit = N.zeros(1)
-    p_opt = crit.argmin()
+    p_opt = p_or_plist[crit.argmin()]
     np = m * p_opt
 
     # get lower right triangle of R
@@ -102,7 +213,7 @@ def ar_fit(p_data, p_or_plist=range(100), selector='sbc'):
     C = N.dot(R22.T, R22) / (ne - np)
 
     # return
-    del R, R11, R12, R22
+    del R11, R12, R22
     return A, C, crit
 
 
@@ -128,7 +239,7 @@ def _ar_model_select(R, m, ne, p_range):
     fpe = N.zeros(p_len)
     ldp = N.zeros(p_len)
 
-    np = N.zeros(p_len)
+    np = N.zeros(p_len, dtype=int)
     np[-1] = m * p_max
 
     # get lower right triangle of R
@@ -142,7 +253,7 @@ def _ar_model_select(R, m, ne, p_range):
     Mp = N.dot(invR22, invR22.T)
 
     # model selection
-    ldp[-1] = 2.0 * N.log(NL.det(R22))
+    ldp[-1] = 2.0 * N.log(N.absolute(NL.det(R22)))
     for i in reversed(xrange(p_len)):
         np[i] = m * p_range[i]
         if p_range[i] < p_max:
@@ -176,24 +287,17 @@ def _ar_model_qr(data, p=1):
     """
 
     # inits
-    n, m = data.shape            # observations, channels
-    ne = n - p                   # number of block equations of size m
+    m = data.shape[1]            # channels
     np = m * p                   # number of parameter vectors of size m
-    K = N.zeros((ne, np + m))  # the lag shifted data matrix
-
-    # compute predictors
-    for i in xrange(p):
-        K[:, m * i:m * (i + 1)] = data[p - i - 1:n - i - 1, :]
-    K[:, np:np + m] = data[p:n, :]
+    K = _ar_model_lagged(data, p)
 
     # contition the matrix and factorize
     scale = N.sqrt(((np + m) ** 2 + np + m + 1) * EPS)
-    R = NL.qr(
+    R = _ar_model_qr_r(
         N.concatenate((
             K,
             scale * N.diag([NL.norm(K[:, i]) for i in xrange(K.shape[1])])
-        )),
-        mode='r'
+        ))
     )
 
     # return
@@ -201,6 +305,40 @@ def _ar_model_qr(data, p=1):
     return R
 
 
+def _ar_model_lagged(data, p):
+    """lag shifted data matrix for a (multivariate) AR model
+
+    :Parameters:
+        data : ndarray
+            data with observations on the rows and variables on the columns
+        p : int
+            the model order, how many samples to regress over
+    """
+
+    # inits
+    n, m = data.shape            # observations, channels
+    ne = n - p                   # number of block equations of size m
+    np = m * p                   # number of parameter vectors of size m
+    K = N.zeros((ne, np + m))    # the lag shifted data matrix
+
+    # compute predictors
+    for i in xrange(p):
+        K[:, m * i:m * (i + 1)] = data[p - i - 1:n - i - 1, :]
+    K[:, np:np + m] = data[p:n, :]
+
+    # return
+    return K
+
+
+def _ar_model_qr_r(X):
+    """square upper triangular factor of the QR factorization of X"""
+
+    R = NL.qr(X, mode='r')
+    if isinstance(R, tuple):
+        R = R[0]
+    return R[:X.shape[1]]
+
+
 def _ar_model_sim(A, C, n=1, n_discard=0, mean=None, check=False):
     """simulates data for a VARMA model
 
@@ -255,30 +393,90 @@ def ar_model_check_stable(A):
             The coefficient matrix of the model
     """
 
+    # check for stable model
+    A1 = _ar_model_companion(A)
+    lambdas = NL.eigvals(A1)
+    rval = True
+    if (N.absolute(lambdas) > 1).any():
+        rval = False
+    del A1, lambdas
+    return rval
+
+
+def ar_model_stationary_cov(A, C, tol=1e-12, max_iter=64):
+    """covariance of the stationary distribution of the AR state vector
+
+    The state vector is the stacked history [x(t-1), x(t-2), .., x(t-p)] of
+    the process. Its stationary covariance P solves the discrete Lyapunov
+    equation P = F * P * F.T + Q, where F is the companion matrix of the model
+    and Q holds C in the upper left block. The equation is solved with the
+    doubling algorithm, which converges quadratically for stable models.
+
+    :Parameters:
+        A : ndarray
+            The coefficient matrix of the model
+        C : ndarray
+            Noise covariance matrix
+        tol : float
+            Convergence tolerance relative to the norm of the solution.
+            Default=1e-12
+        max_iter : int
+            Maximum number of doubling steps.
+            Default=64
+    :Returns:
+        ndarray : the (m*p, m*p) state covariance matrix
+    """
+
+    # inits
+    F = _ar_model_companion(A)
+    m = C.shape[0]
+    P = N.zeros_like(F)
+    P[:m, :m] = C
+
+    # doubling iteration
+    for _ in xrange(max_iter):
+        dP = N.dot(N.dot(F, P), F.T)
+        P = P + dP
+        if NL.norm(dP) <= tol * NL.norm(P):
+            break
+        F = N.dot(F, F)
+    else:
+        raise ValueError('lyapunov iteration did not converge, model unstable?')
+
+    # return symmetrized
+    return 0.5 * (P + P.T)
+
+
+def _ar_model_companion(A):
+    """companion matrix for the (multivariate) AR model
+
+    :Parameters:
+        A : ndarray
+            The coefficient matrix of the model
+    """
+
     # inits and checks
     m, p = A.shape
     p /= m
     if p != round(p):
         raise ValueError('bad inputs!')
 
-    # check for stable model
-    A1 = N.concatenate((
+    # build companion
+    return N.concatenate((
         A,
         N.concatenate((
             N.eye((p - 1) * m),
             N.zeros(((p - 1) * m, m))
         ), axis=1)
     ))
-    lambdas = NL.eigvals(A1)
-    rval = True
-    if (N.absolute(lambdas) > 1).any():
-        rval = False
-    del A1, lambdas
-    return rval
 
 
 def get_noise_sample(idx=None, size=None, filename=None):
-    """get some noise from a recording of maquaque prefrontal cortex"""
+    """get some noise from a recording of maquaque prefrontal cortex
+
+    If filename is a directory, it is read as a NoiseLibrary and the sample is
+    taken from its first recording, without loading the recording as a whole.
+    """
 
     # inits and checks
     if filename is None:
@@ -287,8 +485,12 @@ def get_noise_sample(idx=None, size=None, filename=None):
         size = 10000
 
     # load data
-    from common.datafile import XpdFile
-    data = XpdFile(filename).get_data(item=15)
+    if osp.isdir(filename):
+        from library import NoiseLibrary
+        data = NoiseLibrary.get(filename).sources[0]
+    else:
+        from common.datafile import XpdFile
+        data = XpdFile(filename).get_data(item=15)
 
     # return
     if size >= data.shape[0]:
@@ -301,6 +503,176 @@ def get_noise_sample(idx=None, size=None, filename=None):
 
 ##---CLASSES
 
+class ArFitter(object):
+    """incremental (multivariate) AR model fit for long recordings
+
+    The data is consumed in blocks of arbitrary size. Per block the lag shifted
+    data matrix is build and merged into a running upper triangular factor with
+    one QR step (TSQR), so memory and cost per block do not depend on the
+    length of the recording. The last p samples of each block are carried over
+    to the next block, the result equals ar_fit on the concatenated data.
+    """
+
+    ## constructor
+
+    def __init__(self, p_or_plist=range(100), selector='sbc'):
+        """
+        :Parameters:
+            p_or_plist : list
+                see ar_fit
+            selector : str
+                see ar_fit
+        """
+
+        # checks
+        if selector not in ['sbc', 'fpe']:
+            raise ValueError('selector has to be one of: "sbc" or "fpe"!')
+        if not isinstance(p_or_plist, list):
+            p_or_plist = [p_or_plist]
+
+        # members
+        self.p_or_plist = p_or_plist
+        self.p_max = max(p_or_plist)
+        self.selector = selector
+        self.nvar = None
+        self.ne = 0
+        self._R = None
+        self._colnorm = None
+        self._tail = None
+
+    ## methods public
+
+    def update(self, data):
+        """merge a block of data into the factorization
+
+        :Parameters:
+            data : ndarray
+                Data with observations on the rows and variables on the
+                columns. Blocks have to be passed in temporal order.
+        """
+
+        # checks and inits
+        if not isinstance(data, N.ndarray) or data.ndim != 2:
+            raise ValueError('data is not a 2d ndarray')
+        if self.nvar is None:
+            self.nvar = data.shape[1]
+        elif data.shape[1] != self.nvar:
+            raise ValueError('data has %d variables, expected %d' %
+                             (data.shape[1], self.nvar))
+        if self._tail is not None:
+            data = N.concatenate((self._tail, data))
+        data = N.asarray(data, dtype=N.float64)
+        self._tail = data[-self.p_max:].copy() if self.p_max > 0 else data[:0]
+        if data.shape[0] <= self.p_max:
+            return
+
+        # merge into the triangular factor
+        K = _ar_model_lagged(data, self.p_max)
+        self.ne += K.shape[0]
+        if self._R is None:
+            self._R = _ar_model_qr_r(K)
+            self._colnorm = (K * K).sum(axis=0)
+        else:
+            self._R = _ar_model_qr_r(N.concatenate((self._R, K)))
+            self._colnorm += (K * K).sum(axis=0)
+        del K
+
+    def get_model(self):
+        """select the model order and build the model from the current state
+
+        :Returns:
+            tuple : A, C, crit as returned by ar_fit
+        """
+
+        # checks
+        if self._R is None or self.ne <= self.nvar * self.p_max:
+            raise ValueError('time series to short!')
+
+        # contition the factor like _ar_model_qr
+        ncol = self._R.shape[1]
+        scale = N.sqrt((ncol ** 2 + ncol + 1) * EPS)
+        R = _ar_model_qr_r(
+            N.concatenate((
+                self._R,
+                scale * N.diag(N.sqrt(self._colnorm))
+            ))
+        )
+
+        # return
+        return _ar_model_build(
+            R,
+            self.nvar,
+            self.ne,
+            self.p_or_plist,
+            self.selector
+        )
+
+
+class ArModel(object):
+    """validated multivariate AR model
+
+    Instances are immutable and shared: use ArModel.get to retrieve the model
+    for a set of parameters, so that all noise generators built from the same
+    parameters validate the model only once and reference the same arrays.
+    """
+
+    ## class members
+
+    _registry = {}
+
+    ## constructor
+
+    def __init__(self, A, C):
+        """
+        :Parameters:
+            A : ndarray
+                AR coefficient matrix
+            C : ndarray
+                Noise covariance matrix
+        :Exceptions:
+            ValueError:
+                Error for inconsistent or unstable models.
+        """
+
+        # check model
+        if A.shape[0] != C.shape[0] != C.shape[1]:
+            raise ValueError('A and C matrix dont fit each other. %s and %s' %
+                (str(A.shape), str(C.shape)))
+        if ar_model_check_stable(A) is False:
+            raise ValueError('estimated model is not stable')
+
+        # members
+        self.A = N.array(A, dtype=N.float64)
+        self.C = N.array(C, dtype=N.float64)
+        self.nvar = self.C.shape[0]
+        self.norder = self.A.shape[1] / float(self.nvar)
+        if self.norder != round(self.norder):
+            raise ValueError('invalid model order (not integer?)')
+        self.norder = int(self.norder)
+        self.coeffs = self.A.T.copy()
+        self.state_cov = ar_model_stationary_cov(self.A, self.C)
+        for item in [self.A, self.C, self.coeffs, self.state_cov]:
+            item.setflags(write=False)
+
+    ## class methods
+
+    @classmethod
+    def get(cls, A, C):
+        """return the shared model instance for A and C
+
+        :Parameters:
+            A : ndarray
+                AR coefficient matrix
+            C : ndarray
+                Noise covariance matrix
+        """
+
+        key = _ar_model_hash(A, C)
+        if key not in cls._registry:
+            cls._registry[key] = cls(A, C)
+        return cls._registry[key]
+
+
 class ArNoiseGen(NoiseGen):
     """multivariate noise process from an autoregressive model
 
@@ -324,7 +696,7 @@ class ArNoiseGen(NoiseGen):
         if len(noise_params) == 1:
             if not issubclass(noise_params[0].__class__, N.ndarray):
                 raise ValueError('noise strip should be ndarray')
-            A, C = ar_fit(noise_params[0])[:2]
+            A, C = ar_fit_cached(noise_params[0])[:2]
         elif len(noise_params) == 2:
             if not issubclass(noise_params[0].__class__, N.ndarray) or \
             not issubclass(noise_params[1].__class__, N.ndarray):
@@ -333,52 +705,59 @@ class ArNoiseGen(NoiseGen):
         else:
             raise ValueError('noise_params not tuple/list of len 1 or 2')
 
-        # check model
-        if A.shape[0] != C.shape[0] != C.shape[1]:
-            raise ValueError('A and C matrix dont fit each other. %s and %s' %
-                (str(A.shape), str(C.shape)))
-        if ar_model_check_stable(A) is False:
-            raise ValueError('estimated model is not stable')
+        # shared and validated model
+        self.model = ArModel.get(A, C)
 
         # super [zeros mean, multichannel white noise with covariance C]
-        super(ArNoiseGen, self).__init__(mu=N.zeros(C.shape[0]), sigma=C)
+        super(ArNoiseGen, self).__init__(
+            mu=N.zeros(self.model.nvar),
+            sigma=self.model.C
+        )
 
         # members
-        self.coeffs = A.T
-        self.norder = self.coeffs.shape[0] / float(self.nvar)
-        if self.norder != round(self.norder):
-            raise ValueError('invalid model order (not integer?)')
-        self.norder = int(self.norder)
+        self.coeffs = self.model.coeffs
+        self.norder = self.model.norder
         mem_size = self.norder * self.nvar
-        self.coeffs_mem = deque([0] * mem_size, maxlen=mem_size)
 
-        # run simulation for 5k samples to overcome initial oscillations
-        self.query(5000)
+        # start from the stationary distribution to avoid initial oscillations
+        mem_init = NR.multivariate_normal(
+            N.zeros(mem_size),
+            self.model.state_cov
+        )
+        self.coeffs_mem = deque(mem_init, maxlen=mem_size)
 
-    def query(self, size=1):
+    def query(self, size=1, dtype=None, out=None):
         """return noise samples
 
         :Parameters:
             size : int
                 Number of samples to produce.
                 Default=1
+            dtype : dtype
+                see NoiseGen.query
+            out : ndarray
+                see NoiseGen.query
         """
 
-        # super
-        rval = super(ArNoiseGen, self).query(size=size)
+        # innovations
+        rval = self._draw(size, out)
 
         # generate noise
         for k in xrange(size):
             rval[k] += N.dot(self.coeffs_mem, self.coeffs)
             self.coeffs_mem.extendleft(rval[k, ::-1])
-        return rval
+        return self._output(rval, dtype, out)
 
 
 ##---MAIN
 
 __all__ = [
     'ar_fit',
+    'ar_fit_cached',
     'ar_model_check_stable',
+    'ar_model_stationary_cov',
+    'ArFitter',
+    'ArModel',
     'ArNoiseGen',
 ]
 
@@ -0,0 +1,362 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/noise/background.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-20
+#
+
+"""background activity of a distant neuron population"""
+__docformat__ = "restructuredtext"
+
+
+##---IMPORTS
+
+# packages
+import scipy as N
+from scipy import random as NR
+from numpy.fft import irfft, rfft
+from noise_gen import NoiseGen, _noise_gen_factor
+
+
+##---CLASSES
+
+class BackgroundNoiseGen(NoiseGen):
+    """summed activity of a distant neuron population, the background "hash"
+
+    The population fills a spherical shell around the recorder, between r_min
+    and r_max, with a uniform density. All neurons fire as Poisson processes
+    and share one waveform, that is scaled with a distance kernel per channel.
+    The sum of their contributions is a shot noise process: a train of
+    impulses with the rate of the whole population, convolved with the
+    waveform. The impulse train is drawn sparse, with the channel amplitudes
+    of randomly placed neurons per impulse. If there are more than gauss_limit
+    impulses per sample, the impulse train is drawn from a Gaussian with the
+    moments of the compound Poisson process instead. The convolution is done
+    by FFT with overlap-add across frames. So the cost per frame does not grow
+    with the number of modelled neurons, beyond gauss_limit impulses per
+    sample.
+
+    The output has zero mean. The mean of the shot noise (Campbell's theorem)
+    is a DC offset that the high-pass filter of a recording removes, it is
+    kept as dc. sigma is the covariance of the output (Campbell's theorem).
+    """
+
+    # constructor
+    def __init__(self, points, waveform, kernel=None, density=1e5,
+                 r_min=100.0, r_max=1000.0, rate_of_fire=5.0, amplitude=1.0,
+                 sample_rate=16000.0, gauss_limit=4.0):
+        """
+        :Parameters:
+            points : ndarray
+                Positions of the recorder channels relative to the recorder,
+                one per row.
+            waveform : ndarray
+                The single-channel waveform of the population.
+            kernel : callable
+                Distance kernel on a relative position, see
+                ScalingWaveformND.kernel. The kernel is assumed to be radial.
+                If None, the kernel of ScalingWaveformND is used.
+                Default=None
+            density : float
+                Neurons per mm³.
+                Default=1e5
+            r_min : float
+                Inner radius of the population shell in µm, usually the horizon
+                of the explicitly simulated neurons.
+                Default=100.0
+            r_max : float
+                Outer radius of the population shell in µm.
+                Default=1000.0
+            rate_of_fire : float
+                Mean rate of fire per neuron in Hz.
+                Default=5.0
+            amplitude : float
+                Amplitude of the waveform.
+                Default=1.0
+            sample_rate : float
+                Sample rate of the waveform in Hz.
+                Default=16000.0
+            gauss_limit : float
+                Impulses per sample from which on the impulse train is drawn
+                from a Gaussian.
+                Default=4.0
+        :Exceptions:
+            ValueError:
+                Error if the shell intersects the recorder.
+        """
+
+        # checks and inits
+        if kernel is None:
+            from nsim.scene.neuron_data import ScalingWaveformND
+            kernel = ScalingWaveformND.kernel
+        points = N.atleast_2d(N.asarray(points, dtype=float))
+        waveform = N.asarray(waveform, dtype=float).ravel()
+        extent = N.sqrt((points ** 2).sum(axis=1)).max()
+        if not extent < r_min < r_max:
+            raise ValueError('need %s < r_min < r_max, got %s, %s' %
+                             (extent, r_min, r_max))
+
+        # members
+        self.points = points
+        self.waveform = waveform
+        self.sample_rate = float(sample_rate)
+        self.amplitude = float(amplitude)
+        self.r_min = float(r_min)
+        self.r_max = float(r_max)
+        self.nneurons = density * 4.0 / 3.0 * N.pi * (
+            self.r_max ** 3 - self.r_min ** 3) * 1e-9
+        self.rate = self.nneurons * rate_of_fire / float(sample_rate)
+        self.gauss_limit = float(gauss_limit)
+        self._r = N.linspace(self.r_min - extent, self.r_max + extent, 4096)
+        self._k = N.asarray([kernel(N.asarray([0.0, 0.0, r]))
+                             for r in self._r])
+        self._wf_fft = {}
+        self._tail = N.zeros((waveform.size - 1, points.shape[0]))
+        self._kwargs = {
+            'kernel': kernel,
+            'density': density,
+            'r_min': r_min,
+            'r_max': r_max,
+            'rate_of_fire': rate_of_fire,
+            'amplitude': amplitude,
+            'gauss_limit': gauss_limit,
+        }
+        self._source = None
+
+        # moments of the impulses, compound poisson
+        amps = self._draw_amplitudes(65536)
+        imp_mu = self.rate * amps.mean(axis=0)
+        imp_sigma = self.rate * N.dot(amps.T, amps) / amps.shape[0]
+        self._imp_mu = imp_mu
+        self._imp_factor = _noise_gen_factor(imp_sigma)
+        self.dc = imp_mu * waveform.sum()
+
+        # super [moments of the output, zero mean]
+        super(BackgroundNoiseGen, self).__init__(
+            mu=N.zeros(points.shape[0]),
+            sigma=imp_sigma * (waveform ** 2).sum()
+        )
+
+        # start in the stationary state
+        self.query(waveform.size)
+
+    ## class methods
+
+    @classmethod
+    def from_neuron_data(cls, points, ndata, **kwargs):
+        """build the background of a population of neurons like ndata
+
+        The waveform and kernel of WaveformND objects are used as is. For other
+        NeuronData, the waveform at the horizon is used, with an inverse square
+        kernel continuing it beyond the horizon.
+
+        :Parameters:
+            points : ndarray
+                see BackgroundNoiseGen
+            ndata : NeuronData
+                The neuron data of the population.
+        :Keywords:
+            see BackgroundNoiseGen, r_min defaults to the horizon and
+            sample_rate to the sample rate of ndata.
+        """
+
+        kwargs.setdefault('r_min', ndata.horizon)
+        kwargs.setdefault('sample_rate', ndata.sample_rate or 16000.0)
+        if hasattr(ndata, 'kernel'):
+            waveform = ndata.extra_v[:] * ndata.scale
+            kernel = ndata.kernel
+        else:
+            h = 0.999 * ndata.horizon
+            waveform = ndata.get_data(N.asarray([0.0, 0.0, h]))
+            kernel = lambda pos: h ** 2 / (pos ** 2).sum()
+        return cls(points, waveform, kernel, **kwargs)
+
+    ## methods private
+
+    def _draw_amplitudes(self, size):
+        """channel amplitudes of size neurons placed at random in the shell"""
+
+        pos = NR.standard_normal((size, 3))
+        pos *= (N.power(
+            self.r_min ** 3 +
+            NR.random_sample(size) * (self.r_max ** 3 - self.r_min ** 3),
+            1.0 / 3.0
+        ) / N.sqrt((pos ** 2).sum(axis=1)))[:, N.newaxis]
+        rval = N.empty((size, self.points.shape[0]))
+        for c in xrange(self.points.shape[0]):
+            dist = N.sqrt(((pos - self.points[c]) ** 2).sum(axis=1))
+            rval[:, c] = N.interp(dist, self._r, self._k)
+        rval *= self.amplitude
+        return rval
+
+    def _draw_impulses(self, size):
+        """the impulse train of size samples, without its mean"""
+
+        # gaussian
+        if self.rate > self.gauss_limit:
+            rval = NR.standard_normal((size, self.nvar))
+            if self._imp_factor is not None:
+                rval = N.dot(rval, self._imp_factor.T)
+            return rval
+
+        # sparse
+        counts = NR.poisson(self.rate, size)
+        idx = N.repeat(N.arange(size), counts)
+        amps = self._draw_amplitudes(idx.size)
+        rval = N.empty((size, self.nvar))
+        for c in xrange(self.nvar):
+            rval[:, c] = N.bincount(idx, amps[:, c], minlength=size)
+        rval -= self._imp_mu
+        return rval
+
+    ## methods public
+
+    def resampled(self, sample_rate):
+        """return the background of the same population at another sample rate
+
+        The waveform is resampled (see nd_resample_matrix) from the generator
+        this one was first built as, so repeated changes of the sample rate do
+        not accumulate filter losses.
+
+        :Parameters:
+            sample_rate : float
+                The sample rate to resample to.
+        :Returns:
+            BackgroundNoiseGen : the generator at sample_rate, this generator
+                or the one it was built from if their sample rate matches
+        """
+
+        from nsim.scene.neuron_data import nd_resample_matrix
+
+        sample_rate = float(sample_rate)
+        src = self._source or self
+        for rval in [self, src]:
+            if abs(sample_rate - rval.sample_rate) < 1e-6 * rval.sample_rate:
+                return rval
+        R = nd_resample_matrix(src.sample_rate, sample_rate, src.waveform.size)
+        rval = BackgroundNoiseGen(self.points, N.dot(R, src.waveform),
+                                  sample_rate=sample_rate, **src._kwargs)
+        rval._source = src
+        return rval
+
+    def query(self, size=1, dtype=None, out=None):
+        """return background samples
+
+        :Parameters:
+            size : int
+                Number of samples to produce.
+                Default=1
+            dtype : dtype
+                see NoiseGen.query
+            out : ndarray
+                see NoiseGen.query
+        """
+
+        # fft size and waveform spectrum
+        nconv = size + self.waveform.size - 1
+        nfft = 1
+        while nfft < nconv:
+            nfft *= 2
+        if nfft not in self._wf_fft:
+            self._wf_fft[nfft] = rfft(self.waveform, nfft)[:, N.newaxis]
+
+        # convolve and overlap-add
+        rval = irfft(
+            rfft(self._draw_impulses(size), nfft, axis=0) * self._wf_fft[nfft],
+            nfft,
+            axis=0
+        )[:nconv]
+        rval[:self._tail.shape[0]] += self._tail
+        self._tail = rval[size:].copy()
+        return self._output(rval[:size], dtype, out)
+
+
+##---MAIN
+
+__all__ = ['BackgroundNoiseGen']
+
+if __name__ == '__main__':
+
+    import time
+    from nsim.scene.neuron_data import ScalingWaveformND
+
+    # inits, a tetrode and a biphasic spike
+    points = N.array([[0, 0, 0], [-10, -5.8, -17.3], [10, -5.8, -17.3],
+                      [0, 11.5, -17.3]])
+    t = N.arange(48) / 16.0
+    waveform = -N.exp(-(t - 0.5) ** 2 / 0.02) + 0.4 * N.exp(-(t - 1.0) / 0.5) \
+        * (t > 1.0)
+    ndata = ScalingWaveformND(waveform=waveform * 1e5, horizon=100.0)
+    nframes, frame_size = 100, 1024
+    print
+    print '## BACKGROUND NOISE GEN ## tetrode, shell %d-%d um' % (100, 1000)
+
+    # cost per frame and output variance against campbell's theorem
+    print 'density/mm3  neurons  imp/sample  mode    per frame  var/theory'
+    for density in [1e2, 1e3, 1e4, 1e5, 1e6]:
+        bgen = BackgroundNoiseGen.from_neuron_data(points, ndata,
+                                                   density=density)
+        tic = time.time()
+        data = N.concatenate([bgen.query(frame_size)
+                              for i in xrange(nframes)])
+        dt = (time.time() - tic) / nframes
+        print '%10.0e  %7d  %10.2f  %-6s  %6.2f ms  %s' % (
+            density, bgen.nneurons, bgen.rate,
+            bgen.rate > bgen.gauss_limit and 'gauss' or 'sparse', 1e3 * dt,
+            ' '.join(['%.2f' % v for v in data.var(axis=0) /
+                      N.diag(bgen.sigma)]))
+
+    # the gaussian against the sparse impulse train at the same rate
+    bgen = BackgroundNoiseGen.from_neuron_data(points, ndata, density=1e5)
+    bgen.gauss_limit = N.inf
+    data = N.concatenate([bgen.query(frame_size) for i in xrange(nframes)])
+    print 'density 1e+05 sparse: var/theory %s, channel corr %.3f' % (
+        ' '.join(['%.2f' % v for v in data.var(axis=0) /
+                  N.diag(bgen.sigma)]), N.corrcoef(data.T)[0, 1])
+    bgen.gauss_limit = 4.0
+    data = N.concatenate([bgen.query(frame_size) for i in xrange(nframes)])
+    print 'density 1e+05 gauss : var/theory %s, channel corr %.3f' % (
+        ' '.join(['%.2f' % v for v in data.var(axis=0) /
+                  N.diag(bgen.sigma)]), N.corrcoef(data.T)[0, 1])
+
+    # zero mean, and the same population at other sample rates: the variance
+    # of the output does not depend on the sample rate. the amplitudes of the
+    # moments are drawn with the same seed, so only the waveform differs.
+    print 'sample rate  mean/std  var/var at 16 kHz'
+    NR.seed(0)
+    bgen = BackgroundNoiseGen.from_neuron_data(points, ndata, density=1e5)
+    var_ref = N.diag(bgen.sigma)
+    for sample_rate in [16000.0, 32000.0, 44100.0, 16000.0]:
+        NR.seed(0)
+        bgen = bgen.resampled(sample_rate)
+        data = N.concatenate([bgen.query(frame_size)
+                              for i in xrange(nframes)])
+        mean_z = data.mean(axis=0) / data.std(axis=0)
+        var_ratio = N.diag(bgen.sigma) / var_ref
+        print '%8.0f Hz  %s  %s' % (
+            sample_rate, ' '.join(['%+.3f' % v for v in mean_z]),
+            ' '.join(['%.3f' % v for v in var_ratio]))
+        assert (abs(mean_z) < 0.05).all(), 'background has a DC offset'
+        assert (abs(var_ratio - 1.0) < 0.01).all(), \
+            'background variance depends on the sample rate'
+    assert bgen._source is None, 'resampling back does not return the source'
+
@@ -0,0 +1,301 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/noise/bank.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-14
+#
+
+"""noise texture bank, pre-generated noise shared by many recorders"""
+__docformat__ = "restructuredtext"
+
+
+##---IMPORTS
+
+# builtins
+import os
+import os.path as osp
+# packages
+import scipy as N
+from scipy import random as NR
+from noise_gen import NoiseGen
+from ar_model import _ar_model_hash
+
+
+##---FUNCTIONS
+
+def bank_key(noise_model, noise_params, length):
+    """key for the noise bank of a noise model and its parameters
+
+    :Parameters:
+        noise_model : str
+            Name of the noise model.
+        noise_params : list
+            Parameters of the noise model (ndarrays).
+        length : int
+            Length of the tile in samples.
+    """
+
+    return _ar_model_hash(noise_model, length, *noise_params)
+
+
+##---CLASSES
+
+class NoiseBank(object):
+    """a long, seamlessly looping tile of multichanneled noise
+
+    The tile is generated once per noise model and shared by all readers. To
+    loop without a discontinuity, the tile is generated with an overhang that
+    is crossfaded into its beginning with power complementary windows. Tiles
+    can be stored in a directory and are memory-mapped from there, so the
+    tile is generated only once and costs no memory beyond the page cache.
+    """
+
+    ## class members
+
+    _registry = {}
+
+    ## constructor
+
+    def __init__(self, noise_gen, length, fade=1024, path=None):
+        """
+        :Parameters:
+            noise_gen : NoiseGen or callable
+                The noise generator to build the tile with, or a callable
+                returning one. The generator is only used if the tile is not
+                found at path.
+            length : int
+                Length of the tile in samples.
+            fade : int
+                Length of the crossfade at the loop point in samples.
+                Default=1024
+            path : str
+                Path to the .npy file the tile is stored in. If None, the tile
+                is kept in memory.
+                Default=None
+        """
+
+        # checks
+        length = int(length)
+        fade = int(min(fade, length))
+
+        # members
+        self.tile = None
+        self.length = length
+        self.path = path
+
+        # load from disk
+        if path is not None and osp.exists(path):
+            try:
+                tile = N.load(path, mmap_mode='r')
+                if tile.ndim == 2 and tile.shape[0] == length:
+                    self.tile = tile
+            except:
+                self.tile = None
+
+        # generate
+        if self.tile is None:
+            if not isinstance(noise_gen, NoiseGen):
+                noise_gen = noise_gen()
+            tile = N.asarray(noise_gen.query(length + fade), dtype=N.float64)
+            phi = 0.5 * N.pi * (N.arange(fade) + 0.5) / fade
+            tile[:fade] = (
+                tile[:fade] * N.sin(phi)[:, N.newaxis] +
+                tile[length:] * N.cos(phi)[:, N.newaxis]
+            )
+            tile = tile[:length]
+            if path is not None:
+                try:
+                    if not osp.isdir(osp.dirname(path)):
+                        os.makedirs(osp.dirname(path))
+                    tmp_path = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+                    N.save(tmp_path, tile)
+                    os.rename(tmp_path, path)
+                    tile = N.load(path, mmap_mode='r')
+                except:
+                    pass
+            self.tile = tile
+        self.nvar = self.tile.shape[1]
+
+    ## class methods
+
+    @classmethod
+    def get(cls, key, noise_gen, length, fade=1024, bank_dir=None):
+        """return the shared noise bank for key
+
+        :Parameters:
+            key : str
+                Identifier of the noise model, see bank_key.
+            noise_gen : NoiseGen or callable
+                see NoiseBank
+            length : int
+                see NoiseBank
+            fade : int
+                see NoiseBank
+            bank_dir : str
+                Directory to store the tile in, as <key>.npy. If None, the
+                tile is kept in memory.
+                Default=None
+        """
+
+        if key not in cls._registry:
+            path = None
+            if bank_dir is not None:
+                path = osp.join(bank_dir, '%s.npy' % key)
+            cls._registry[key] = cls(noise_gen, length, fade, path)
+        return cls._registry[key]
+
+
+class BankNoiseGen(NoiseGen):
+    """noise generator reading from a shared NoiseBank
+
+    Each reader starts at an independent random offset into the tile and
+    applies a random sign, so readers of the same bank are decorrelated. The
+    cost per frame is a copy from the tile.
+    """
+
+    # constructor
+    def __init__(self, bank, flip_channels=False):
+        """
+        :Parameters:
+            bank : NoiseBank
+                The bank to read from.
+            flip_channels : bool
+                If True, draw the random sign per channel instead of one sign
+                for all channels. This decorrelates readers further, but flips
+                the sign of cross-channel covariances of the model.
+                Default=False
+        """
+
+        # super
+        super(BankNoiseGen, self).__init__(mu=N.zeros(bank.nvar))
+
+        # members
+        self.bank = bank
+        self.pos = NR.randint(bank.length)
+        if flip_channels is True:
+            self.sign = NR.randint(2, size=bank.nvar) * 2.0 - 1.0
+        else:
+            self.sign = N.ones(bank.nvar) * (NR.randint(2) * 2.0 - 1.0)
+
+    ## methods public
+
+    def query(self, size=1, dtype=None, out=None):
+        """return noise samples
+
+        :Parameters:
+            size : int
+                Number of samples to produce.
+                Default=1
+            dtype : dtype
+                see NoiseGen.query
+            out : ndarray
+                see NoiseGen.query
+        """
+
+        # copy with wrap around
+        rval = N.empty((size, self.nvar))
+        done = 0
+        while done < size:
+            n = min(size - done, self.bank.length - self.pos)
+            rval[done:done + n] = self.bank.tile[self.pos:self.pos + n]
+            done += n
+            self.pos = (self.pos + n) % self.bank.length
+        rval *= self.sign
+        return self._output(rval, dtype, out)
+
+
+##---MAIN
+
+__all__ = ['bank_key', 'BankNoiseGen', 'NoiseBank']
+
+if __name__ == '__main__':
+
+    from ar_model import ArNoiseGen
+    from nsim.scene.recorder import TETRODE_NOISE_PARAMS
+
+    # thresholds of the checks below
+    Z_WRAP_RANGE = (0.7, 1.3)
+    VAR_RATIO_RANGE = (0.85, 1.15)
+    RHO_MAX = 0.05
+    RHO_MEDIAN_FACTOR = 2.0
+
+    # inits
+    length = 2 ** 16
+    nsmpl = 4 * length
+    bank = NoiseBank(ArNoiseGen(TETRODE_NOISE_PARAMS), length)
+    ref = ArNoiseGen(TETRODE_NOISE_PARAMS).query(nsmpl)
+    print
+    print '## NOISE BANK ## tile of %d samples' % length
+
+    # wrap-around artifacts, the lag-1 step across the loop point against the
+    # distribution of lag-1 steps of the reference process, over many tiles.
+    # a rms z-score near 1 means the loop point is indistinguishable.
+    tiles = [NoiseBank(ArNoiseGen(TETRODE_NOISE_PARAMS), 2048, 512).tile
+             for i in xrange(50)]
+    step_std = N.diff(ref, axis=0).std(axis=0)
+    z_wrap = N.asarray([(t[0] - t[-1]) / step_std for t in tiles])
+    z_rms = N.sqrt((z_wrap ** 2).mean(axis=0))
+    print 'rms z-score of wrap steps  :', z_rms
+    assert ((z_rms > Z_WRAP_RANGE[0]) & (z_rms < Z_WRAP_RANGE[1])).all(), \
+        'wrap steps are out of %s' % str(Z_WRAP_RANGE)
+
+    # the crossfade must keep the variance of the process
+    var_fade = N.concatenate([t[:512] for t in tiles]).var(axis=0)
+    var_rest = N.concatenate([t[512:] for t in tiles]).var(axis=0)
+    var_ratio = var_fade / ref.var(axis=0)
+    print 'variance in crossfade zone :', var_fade
+    print 'variance elsewhere         :', var_rest
+    print 'variance stationary        :', ref.var(axis=0)
+    assert ((var_ratio > VAR_RATIO_RANGE[0]) &
+            (var_ratio < VAR_RATIO_RANGE[1])).all(), \
+        'crossfade variance ratio is out of %s' % str(VAR_RATIO_RANGE)
+
+    # cross-recorder correlation for pairs of readers, max over lags -10..10,
+    # against the same statistic for independent segments of the tile length
+    def xcorr(a, b, l):
+        if l < 0:
+            return xcorr(b, a, -l)
+        return (a[:a.size - l] * b[l:]).mean()
+    def max_xcorr(a, b):
+        a = (a - a.mean()) / a.std()
+        b = (b - b.mean()) / b.std()
+        return max([abs(xcorr(a, b, l)) for l in xrange(-10, 11)])
+    rho = N.asarray([
+        max_xcorr(
+            BankNoiseGen(bank).query(nsmpl)[:, 0],
+            BankNoiseGen(bank).query(nsmpl)[:, 0])
+        for i in xrange(20)
+    ])
+    rho_ref = N.median([
+        max_xcorr(
+            ref[i * length:(i + 1) * length, 0],
+            ref[(i + 1) * length:(i + 2) * length, 0])
+        for i in xrange(3)
+    ])
+    print 'cross-reader |corr|, max over lags: median %.4f max %.4f' % (
+        N.median(rho), rho.max())
+    print 'independent segments, same length : %.4f' % rho_ref
+    assert rho.max() < RHO_MAX, \
+        'readers are correlated above %.2f' % RHO_MAX
+    assert N.median(rho) < RHO_MEDIAN_FACTOR * rho_ref, \
+        'readers are more correlated than independent segments'
+    print 'all checks passed'
@@ -0,0 +1,334 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/noise/library.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-14
+#
+
+"""noise from a library of recorded background noise"""
+__docformat__ = "restructuredtext"
+
+
+##---IMPORTS
+
+# builtins
+import os
+import os.path as osp
+# packages
+import scipy as N
+from scipy import random as NR
+from tables import openFile
+from noise_gen import NoiseGen
+
+
+##---CONSTANTS
+
+EXT_NPY = ['.npy']
+EXT_HDF5 = ['.h5', '.hdf5']
+EXT_RAW = ['.raw', '.dat']
+
+
+##---CLASSES
+
+class NoiseLibrary(object):
+    """a directory of recorded background noise
+
+    The library holds all recordings found in a directory, with samples on
+    the rows and channels on the columns:
+        .npy : numpy arrays, memory-mapped
+        .h5/.hdf5 : HDF5 archives with the noise in the array node data_node,
+            read slice by slice
+        .raw/.dat : headerless binary files of raw_dtype with raw_nchan
+            interleaved channels, memory-mapped
+    Recordings are never loaded as a whole, only the queried slices are read.
+    """
+
+    ## class members
+
+    _registry = {}
+
+    ## constructor
+
+    def __init__(self, path, data_node='/noise', raw_dtype='int16',
+                 raw_nchan=None):
+        """
+        :Parameters:
+            path : str
+                Path to the library directory.
+            data_node : str
+                Path to the noise node in HDF5 archives.
+                Default='/noise'
+            raw_dtype : str
+                Sample type of raw files.
+                Default='int16'
+            raw_nchan : int
+                Channel count of raw files. Raw files are skipped if None.
+                Default=None
+        :Exceptions:
+            IOError:
+                Error if the library does not contain any recording.
+        """
+
+        # members
+        self.path = path
+        self.sources = []
+        self._arcs = []
+
+        # scan the directory
+        for fname in sorted(os.listdir(path)):
+            fpath = osp.join(path, fname)
+            ext = osp.splitext(fname)[1].lower()
+            try:
+                if ext in EXT_NPY:
+                    src = N.load(fpath, mmap_mode='r')
+                elif ext in EXT_HDF5:
+                    arc = openFile(fpath, 'r')
+                    self._arcs.append(arc)
+                    src = arc.getNode(data_node)
+                elif ext in EXT_RAW and raw_nchan is not None:
+                    src = N.memmap(fpath, dtype=raw_dtype, mode='r')
+                    src = src[:src.size - src.size % raw_nchan]
+                    src.shape = (src.size / raw_nchan, raw_nchan)
+                else:
+                    continue
+            except:
+                continue
+            if len(src.shape) == 2 and src.shape[0] > 0:
+                self.sources.append(src)
+        if len(self.sources) == 0:
+            raise IOError('no noise recordings found in %s' % path)
+
+    ## class methods
+
+    @classmethod
+    def get(cls, path, **kwargs):
+        """return the shared library for path, see NoiseLibrary"""
+
+        key = osp.realpath(path)
+        if key not in cls._registry:
+            cls._registry[key] = cls(path, **kwargs)
+        return cls._registry[key]
+
+    ## methods public
+
+    def get_sources(self, nchan, min_length=1):
+        """return the indices of all sources with enough channels and samples"""
+
+        return [i for i in xrange(len(self.sources))
+                if self.sources[i].shape[1] >= nchan and
+                self.sources[i].shape[0] >= min_length]
+
+    def read(self, idx, start, stop, channels):
+        """read a slice of a recording as float64
+
+        :Parameters:
+            idx : int
+                Index of the source.
+            start : int
+                First sample.
+            stop : int
+                Sample after the last sample.
+            channels : ndarray
+                Channel indices to read.
+        """
+
+        return N.asarray(self.sources[idx][start:stop], dtype=N.float64)[:, channels]
+
+    def close(self):
+        """close all HDF5 archives"""
+
+        for arc in self._arcs:
+            try:
+                arc.close()
+            except:
+                pass
+        self._arcs = []
+
+
+class LibraryNoiseGen(NoiseGen):
+    """noise generator streaming recorded noise from a NoiseLibrary
+
+    The noise is streamed as a sequence of segments. Each segment is a random
+    stretch of a random recording. The subset of channels matching the channel
+    count is drawn once per recording and generator, so the spatial covariance
+    of a recording stays the same across segments. Consecutive segments are
+    joined with a crossfade using power complementary windows.
+    """
+
+    # constructor
+    def __init__(self, noise_params, segment=2 ** 18, fade=1024, scale=1.0):
+        """
+        :Parameters:
+            noise_params : tuple
+                A tuple of length 1 or 2:
+                len 1: path to the library directory, all channels of the
+                    first recording are used.
+                len 2: path to the library directory and the channel count.
+            segment : int
+                Maximal length of a segment in samples.
+                Default=2**18
+            fade : int
+                Length of the crossfade between segments in samples.
+                Default=1024
+            scale : float
+                Factor to scale the recorded samples with.
+                Default=1.0
+        """
+
+        # check parameters
+        if len(noise_params) not in [1, 2]:
+            raise ValueError('noise_params not tuple/list of len 1 or 2')
+        library = noise_params[0]
+        if not isinstance(library, NoiseLibrary):
+            library = NoiseLibrary.get(str(library))
+        if len(noise_params) == 2:
+            nchan = int(noise_params[1])
+        else:
+            nchan = library.sources[0].shape[1]
+        fade = int(fade)
+        sources = library.get_sources(nchan, 2 * fade + 1)
+        if len(sources) == 0:
+            raise ValueError('no recording with %d channels and %d samples' %
+                             (nchan, 2 * fade + 1))
+
+        # super
+        super(LibraryNoiseGen, self).__init__(mu=N.zeros(nchan))
+
+        # members
+        self.library = library
+        self.segment = int(max(segment, 2 * fade + 1))
+        self.fade = fade
+        self.scale = float(scale)
+        self._sources = sources
+        self._channels = {}
+        self._cur = self._new_segment()
+        self._nxt = None
+        self._fade_pos = 0
+
+    ## methods private
+
+    def _new_segment(self):
+        """draw a segment as [source, channels, position, end]"""
+
+        idx = self._sources[NR.randint(len(self._sources))]
+        nsmpl, nchan = self.library.sources[idx].shape
+        seg_len = min(self.segment, nsmpl)
+        start = NR.randint(nsmpl - seg_len + 1)
+        if idx not in self._channels:
+            self._channels[idx] = N.sort(NR.permutation(nchan)[:self.nvar])
+        return [idx, self._channels[idx], start, start + seg_len]
+
+    def _read(self, seg, n):
+        """read n samples from a segment and advance it"""
+
+        rval = self.library.read(seg[0], seg[2], seg[2] + n, seg[1])
+        seg[2] += n
+        return rval
+
+    ## methods public
+
+    def query(self, size=1, dtype=None, out=None):
+        """return noise samples
+
+        :Parameters:
+            size : int
+                Number of samples to produce.
+                Default=1
+            dtype : dtype
+                see NoiseGen.query
+            out : ndarray
+                see NoiseGen.query
+        """
+
+        rval = N.empty((size, self.nvar))
+        done = 0
+        while done < size:
+            remaining = self._cur[3] - self._cur[2]
+
+            # plain segment
+            if remaining > self.fade:
+                n = min(size - done, remaining - self.fade)
+                rval[done:done + n] = self._read(self._cur, n)
+                done += n
+                continue
+
+            # crossfade into the next segment
+            if self._nxt is None:
+                self._nxt = self._new_segment()
+                self._fade_pos = 0
+            n = min(size - done, remaining)
+            phi = 0.5 * N.pi * (self._fade_pos + N.arange(n) + 0.5) / self.fade
+            rval[done:done + n] = (
+                self._read(self._cur, n) * N.cos(phi)[:, N.newaxis] +
+                self._read(self._nxt, n) * N.sin(phi)[:, N.newaxis]
+            )
+            self._fade_pos += n
+            done += n
+            if self._cur[2] == self._cur[3]:
+                self._cur = self._nxt
+                self._nxt = None
+
+        # return
+        if self.scale != 1.0:
+            rval *= self.scale
+        return self._output(rval, dtype, out)
+
+
+##---MAIN
+
+__all__ = ['LibraryNoiseGen', 'NoiseLibrary']
+
+if __name__ == '__main__':
+
+    import shutil, tempfile, time
+    from ar_model import ArNoiseGen
+
+    # inits, a library of three recordings of an 8 channel AR process
+    lib_dir = tempfile.mkdtemp()
+    A = N.zeros((8, 16))
+    A[:, :8] = 0.6 * N.eye(8)
+    A[:, 8:] = -0.2 * N.eye(8)
+    C = 0.5 * N.eye(8) + 0.5
+    for i in xrange(3):
+        rec = ArNoiseGen([A, C]).query(2 ** 17)
+        N.save(osp.join(lib_dir, 'rec%d.npy' % i), rec)
+    ref_var = N.diag(ArNoiseGen([A, C]).model.state_cov)[:4]
+    print
+    print '## NOISE LIBRARY ## %d recordings in %s' % (3, lib_dir)
+
+    # variance per channel inside and outside of the crossfade zones
+    ngen = LibraryNoiseGen([lib_dir, 4], segment=4096, fade=512)
+    data = ngen.query(2 ** 18)
+    in_fade = N.zeros(data.shape[0], dtype=bool)
+    for i in xrange(4096 - 512, data.shape[0], 4096 - 512):
+        in_fade[i:i + 512] = True
+    print 'stationary variance         :', ref_var
+    print 'variance in crossfade zones :', data[in_fade].var(axis=0)
+    print 'variance elsewhere          :', data[~in_fade].var(axis=0)
+
+    # throughput
+    ngen = LibraryNoiseGen([lib_dir, 4])
+    tic = time.time()
+    for i in xrange(1000):
+        ngen.query(1024)
+    print '1000 frames of 1024 samples : %.3f s' % (time.time() - tic)
+    shutil.rmtree(lib_dir)
@@ -0,0 +1,259 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/noise/lowrank.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-14
+#
+
+"""noise generation with a low-rank spatial model for many channels"""
+__docformat__ = "restructuredtext"
+
+
+##---IMPORTS
+
+# packages
+import scipy as N
+from scipy import linalg as NL, random as NR
+from scipy.signal import lfilter, lfiltic
+from numpy.linalg import qr
+from noise_gen import NoiseGen
+from ar_model import ar_fit, ar_model_stationary_cov
+
+
+##---FUNCTIONS
+
+def lowrank_fit(p_data, nsrc=4, p_or_plist=range(1, 11), selector='sbc',
+                niter=4):
+    """fits a low-rank spatial noise model to multichanneled data
+
+    The model is x(t) = W * s(t) + u(t), where s(t) are nsrc latent sources
+    mixed into the channels by the loading matrix W, and u(t) are independent
+    per-channel components. The latent sources and the per-channel components
+    are modeled as univariate AR processes. The loading matrix is found by
+    subspace iteration on the data, so no channel covariance matrix is formed
+    and the cost of the fit grows linearly with the number of channels.
+
+    :Parameters:
+        p_data : ndarray
+            Data with observations on the rows and variables on the columns
+        nsrc : int
+            Number of latent sources.
+            Default=4
+        p_or_plist : list
+            List of model orders to select from for the univariate AR models,
+            see ar_fit.
+            Default=range(1, 11)
+        selector : str
+            see ar_fit
+            Default='sbc'
+        niter : int
+            Number of subspace iterations.
+            Default=4
+    :Returns:
+        tuple : W, src_coeffs, src_var, chn_coeffs, chn_var with
+            W : (m, nsrc) loading matrix with orthonormal columns
+            src_coeffs : (nsrc, p) AR coefficients of the sources
+            src_var : (nsrc,) innovation variances of the sources
+            chn_coeffs : (m, p) AR coefficients of the channel components
+            chn_var : (m,) innovation variances of the channel components
+    """
+
+    # checks and inits
+    if not isinstance(p_data, N.ndarray):
+        raise ValueError('p_data is not an ndarray')
+    data = p_data - p_data.mean(axis=0)
+    n, m = data.shape
+    nsrc = int(min(nsrc, m))
+    if nsrc < 1:
+        raise ValueError('need at least one latent source')
+
+    # loading matrix by subspace iteration and rayleigh-ritz rotation
+    W = qr(NR.randn(m, nsrc))[0]
+    for _ in xrange(niter):
+        W = qr(N.dot(data.T, N.dot(data, W)))[0]
+    src = N.dot(data, W)
+    lam, V = NL.eigh(N.dot(src.T, src))
+    V = V[:, lam.argsort()[::-1]]
+    W = N.dot(W, V)
+    src = N.dot(src, V)
+
+    # univariate models for sources and channel residuals
+    src_coeffs, src_var = _univariate_fit(src, p_or_plist, selector)
+    chn_coeffs, chn_var = _univariate_fit(
+        data - N.dot(src, W.T),
+        p_or_plist,
+        selector
+    )
+
+    # return
+    return W, src_coeffs, src_var, chn_coeffs, chn_var
+
+
+def _univariate_fit(data, p_or_plist, selector):
+    """fit one univariate AR model per column, padded to the maximal order"""
+
+    # inits
+    if not isinstance(p_or_plist, list):
+        p_or_plist = [p_or_plist]
+    coeffs = N.zeros((data.shape[1], max(p_or_plist)))
+    var = N.zeros(data.shape[1])
+
+    # fit per column
+    for i in xrange(data.shape[1]):
+        A, C = ar_fit(data[:, i:i + 1], p_or_plist, selector)[:2]
+        coeffs[i, :A.shape[1]] = A[0]
+        var[i] = C[0, 0]
+
+    # return
+    return coeffs, var
+
+
+def _univariate_stationary_cov(coeffs, var):
+    """stationary covariance of the state vector of a univariate AR model"""
+
+    return ar_model_stationary_cov(
+        N.atleast_2d(coeffs),
+        N.atleast_2d(var)
+    )
+
+
+##---CLASSES
+
+class LowRankNoiseGen(NoiseGen):
+    """multivariate noise process from a low-rank spatial model
+
+    The process is the sum of a few latent AR sources, mixed into the channels
+    by a loading matrix, and independent AR components per channel (see
+    lowrank_fit). All AR components are univariate and are simulated as all
+    pole filters, so the cost per sample grows linearly with the number of
+    channels. The covariance is held as its factors loading, src_cov and
+    chn_cov, sigma builds the dense matrix on demand.
+    """
+
+    # constructor
+    def __init__(self, noise_params):
+        """
+        :Parameters:
+            noise_params : tuple
+                A tuple of length 1 or 5:
+                len 1: A strip of data to estimate the model parameters from.
+                len 5: The model parameters as returned by lowrank_fit.
+        """
+
+        # check parameters
+        if len(noise_params) == 1:
+            if not issubclass(noise_params[0].__class__, N.ndarray):
+                raise ValueError('noise strip should be ndarray')
+            params = lowrank_fit(noise_params[0])
+        elif len(noise_params) == 5:
+            params = map(N.asarray, noise_params)
+        else:
+            raise ValueError('noise_params not tuple/list of len 1 or 5')
+        W, src_coeffs, src_var, chn_coeffs, chn_var = params
+        if not (W.shape[1] == src_coeffs.shape[0] == src_var.size and
+                W.shape[0] == chn_coeffs.shape[0] == chn_var.size):
+            raise ValueError('low-rank model parameters dont fit each other')
+
+        # super [zeros mean, covariance of the process]
+        src_cov = N.asarray([
+            _univariate_stationary_cov(src_coeffs[i], src_var[i])[0, 0]
+            for i in xrange(src_var.size)
+        ])
+        chn_cov = N.asarray([
+            _univariate_stationary_cov(chn_coeffs[i], chn_var[i])[0, 0]
+            for i in xrange(chn_var.size)
+        ])
+        super(LowRankNoiseGen, self).__init__(mu=N.zeros(W.shape[0]))
+
+        # members
+        self.loading = W
+        self.src_cov = src_cov
+        self.chn_cov = chn_cov
+        self.nsrc = W.shape[1]
+        self._src = _UnivariateArBank(src_coeffs, src_var)
+        self._chn = _UnivariateArBank(chn_coeffs, chn_var)
+
+    ## properties
+
+    def get_sigma(self):
+        return (N.dot(self.loading * self.src_cov, self.loading.T) +
+                N.diag(self.chn_cov))
+    sigma = property(get_sigma)
+
+    ## methods public
+
+    def query(self, size=1, dtype=None, out=None):
+        """return noise samples
+
+        :Parameters:
+            size : int
+                Number of samples to produce.
+                Default=1
+            dtype : dtype
+                see NoiseGen.query
+            out : ndarray
+                see NoiseGen.query
+        """
+
+        rval = self._chn.query(size)
+        rval += N.dot(self._src.query(size), self.loading.T)
+        return self._output(rval, dtype, out)
+
+
+class _UnivariateArBank(object):
+    """a set of independent univariate AR processes, simulated as filters"""
+
+    def __init__(self, coeffs, var):
+
+        self.coeffs = coeffs
+        self.std = N.sqrt(var)
+        self.den = [N.concatenate(([1.0], -c)) for c in coeffs]
+        self.zi = []
+
+        # start from the stationary distribution
+        for i in xrange(coeffs.shape[0]):
+            P = _univariate_stationary_cov(coeffs[i], var[i])
+            y_past = NR.multivariate_normal(N.zeros(P.shape[0]), P)
+            self.zi.append(lfiltic([1.0], self.den[i], y_past))
+
+    def query(self, size):
+
+        rval = NR.randn(size, self.std.size) * self.std
+        for i in xrange(self.std.size):
+            rval[:, i], self.zi[i] = lfilter(
+                [1.0],
+                self.den[i],
+                rval[:, i],
+                zi=self.zi[i]
+            )
+        return rval
+
+
+##---MAIN
+
+__all__ = [
+    'lowrank_fit',
+    'LowRankNoiseGen',
+]
+
+if __name__ == '__main__':
+    pass
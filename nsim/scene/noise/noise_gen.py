@@ -32,7 +32,34 @@ __docformat__ = "restructuredtext"
 
 # packages
 import scipy as N
-from scipy import random as NR
+from scipy import linalg as NL, random as NR
+
+
+##---FUNCTIONS
+
+def _noise_gen_factor(sigma):
+    """factor L with L * L.T == sigma, None for the identity
+
+    The cholesky factor is used, for singular (positive semi-definite)
+    covariance matrices the factor is computed from the eigen decomposition.
+    """
+
+    if (sigma == N.eye(sigma.shape[0])).all():
+        return None
+    try:
+        return NL.cholesky(sigma, lower=True)
+    except NL.LinAlgError:
+        lam, V = NL.eigh(0.5 * (sigma + sigma.T))
+        return V * N.sqrt(N.maximum(lam, 0.0))
+
+
+def _noise_gen_direct(out, size, nvar):
+    """True if samples can be computed into the buffer out directly"""
+
+    return (isinstance(out, N.ndarray) and
+            out.dtype == N.float64 and
+            out.shape == (size, nvar) and
+            out.flags.c_contiguous)
 
 
 ##---CLASSES
@@ -41,7 +68,9 @@ class NoiseGen(object):
     """generic noise generator
 
     This noise generator will yield multivariate noise samples from a Gaussian
-    with a given mean and covariance matrix.
+    with a given mean and covariance matrix. The covariance matrix is factored
+    once, when it is set, and samples are drawn as a block of standard normal
+    samples times that factor.
     """
 
     # constructor
@@ -53,7 +82,8 @@ class NoiseGen(object):
                 Default=None
             sigma : ndarray
                 2d-array, square matrix with same dims as mu. The covariance
-                matrix of the distribution.
+                matrix of the distribution. The identity if None, which is not
+                stored as a matrix.
                 Default=None
         """
 
@@ -62,35 +92,83 @@ class NoiseGen(object):
                 mu = N.zeros(1)
             else:
                 mu = N.zeros(sigma.shape[0])
-        if sigma is None:
-            sigma = N.eye(mu.size)
 
         # parameter checks
-        if mu.ndim != 1 or sigma.ndim != 2:
+        if mu.ndim != 1 or (sigma is not None and sigma.ndim != 2):
             ValueError('expect mu 1dim and sigma 2dim square')
-        if mu.size != sigma.shape[0] != sigma.shape[1]:
+        if sigma is not None and mu.size != sigma.shape[0] != sigma.shape[1]:
             ValueError('mu does not match sigma shape')
 
         # memebers
         self.nvar = mu.size
         self.mu = mu
-        self.sigma = sigma
+        self._sigma = None
+        self._factor = None
+        if sigma is not None:
+            self.sigma = sigma
+
+    ## properties
+
+    def get_sigma(self):
+        if self._sigma is None:
+            return N.eye(self.nvar)
+        return self._sigma
+    def set_sigma(self, value):
+        self._sigma = value
+        self._factor = _noise_gen_factor(value)
+    sigma = property(get_sigma, set_sigma)
+
+    ## methods private
+
+    def _draw(self, size, out=None):
+        """size samples of zero mean noise with covariance sigma, as float64
+
+        If out is a C-contiguous float64 buffer of shape (size, nvar), the
+        product with the factor is computed into out and out is returned.
+        """
+
+        rval = NR.randn(size, self.nvar)
+        if self._factor is not None:
+            if _noise_gen_direct(out, size, self.nvar):
+                return N.dot(rval, self._factor.T, out=out)
+            rval = N.dot(rval, self._factor.T)
+        return rval
+
+    def _output(self, rval, dtype=None, out=None):
+        """deliver float64 samples as dtype or into the buffer out"""
+
+        if out is not None:
+            if rval is not out:
+                out[:] = rval
+            return out
+        if dtype is not None and rval.dtype != dtype:
+            return rval.astype(dtype)
+        return rval
 
     # methods public
-    def query(self, size=1):
+    def query(self, size=1, dtype=None, out=None):
         """return noise samples
 
         :Parameters:
             size : int
                 Number of samples to produce.
                 Default=1
+            dtype : dtype
+                Type of the samples, float64 if None. The samples are computed
+                in float64 and cast.
+                Default=None
+            out : ndarray
+                Buffer of shape (size, nvar) to write the samples to. If
+                given, dtype is ignored and out is returned. A C-contiguous
+                float64 buffer receives the samples without an intermediate
+                array, other buffers receive a copy.
+                Default=None
         """
 
-        return NR.multivariate_normal(
-            self.mu,
-            self.sigma,
-            size
-        )
+        rval = self._draw(size, out)
+        if self.mu.any():
+            rval += self.mu
+        return self._output(rval, dtype, out)
 
 
 ##---MAIN
@@ -98,4 +176,43 @@ class NoiseGen(object):
 __all__ = ['NoiseGen']
 
 if __name__ == '__main__':
-    pass
+
+    import time
+
+    # inits
+    nvar, size, nframes = 16, 1024, 500
+    X = NR.randn(4 * nvar, nvar)
+    sigma = N.dot(X.T, X) / X.shape[0]
+    ngen = NoiseGen(sigma=sigma)
+    print
+    print '## NOISE GEN ## %d channels, %d frames of %d samples' % (
+        nvar, nframes, size)
+
+    # per frame factorization against the cached factor
+    tic = time.time()
+    for i in xrange(nframes):
+        NR.multivariate_normal(ngen.mu, ngen.sigma, size)
+    t_mvn = time.time() - tic
+    tic = time.time()
+    for i in xrange(nframes):
+        ngen.query(size)
+    t_cached = time.time() - tic
+    buf = N.empty((size, nvar), dtype=N.float64)
+    tic = time.time()
+    for i in xrange(nframes):
+        ngen.query(size, out=buf)
+    t_out = time.time() - tic
+    buf32 = N.empty((size, nvar), dtype=N.float32)
+    tic = time.time()
+    for i in xrange(nframes):
+        ngen.query(size, out=buf32)
+    t_out32 = time.time() - tic
+    print 'multivariate_normal per frame : %.3f s' % t_mvn
+    print 'cached factor                 : %.3f s' % t_cached
+    print 'cached factor, float64 out=   : %.3f s' % t_out
+    print 'cached factor, float32 out=   : %.3f s' % t_out32
+
+    # covariance of the samples
+    data = ngen.query(200000)
+    print 'max abs covariance error      : %.4f' % abs(
+        N.cov(data.T) - sigma).max()
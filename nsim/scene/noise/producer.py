@@ -0,0 +1,213 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/noise/producer.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-14
+#
+
+"""noise generation ahead of time in a producer process"""
+__docformat__ = "restructuredtext"
+
+
+##---IMPORTS
+
+# builtins
+import time
+from ctypes import c_double, c_ulonglong
+from multiprocessing import Event, Process, RawArray, RawValue
+# packages
+import scipy as N
+from scipy import random as NR
+from noise_gen import NoiseGen
+
+
+##---CLASSES
+
+class NoiseProducer(NoiseGen):
+    """noise generator proxy, producing noise in a separate process
+
+    A producer process runs the wrapped noise generator and writes its samples
+    into a ring buffer in shared memory, ahead of time. query returns views
+    into the ring, so taking a frame of noise does not copy. A view is valid
+    until the next call to query, the ring space is released to the producer
+    only then. If the ring does not hold enough samples, query waits for the
+    producer, so the noise stays one continuous stream. Only frames too large
+    for the ring, or frames after the producer died, are generated inline with
+    the wrapped generator of the calling process. Both count as underruns.
+    """
+
+    # constructor
+    def __init__(self, noise_gen, capacity=16384, block_size=1024):
+        """
+        :Parameters:
+            noise_gen : NoiseGen
+                The noise generator to run in the producer process.
+            capacity : int
+                Size of the ring buffer in samples. Choose a multiple of the
+                frame size, else frames at the wrap point are copied.
+                Default=16384
+            block_size : int
+                Number of samples the producer generates per step.
+                Default=1024
+        """
+
+        # checks
+        if not isinstance(noise_gen, NoiseGen):
+            raise ValueError('noise_gen is not a NoiseGen')
+        if block_size > capacity:
+            raise ValueError('block_size is larger than capacity')
+
+        # super
+        super(NoiseProducer, self).__init__(mu=noise_gen.mu)
+
+        # members
+        self.noise_gen = noise_gen
+        self.capacity = int(capacity)
+        self.block_size = int(block_size)
+        self.underruns = 0
+        self._taken = 0
+        self._buf = RawArray(c_double, self.capacity * self.nvar)
+        self._head = RawValue(c_ulonglong, 0)
+        self._tail = RawValue(c_ulonglong, 0)
+        self._stop = Event()
+        self._ring = N.frombuffer(self._buf, dtype=N.float64)
+        self._ring.shape = (self.capacity, self.nvar)
+
+        # start the producer
+        self._proc = Process(
+            target=_producer_run,
+            args=(
+                self.noise_gen,
+                self._buf,
+                self._head,
+                self._tail,
+                self._stop,
+                self.capacity,
+                self.block_size
+            ),
+            name='NoiseProducer'
+        )
+        self._proc.daemon = True
+        self._proc.start()
+
+    ## properties
+
+    def get_sigma(self):
+        return self.noise_gen.sigma
+    sigma = property(get_sigma)
+
+    def get_fill_level(self):
+        return (self._head.value - self._tail.value) / float(self.capacity)
+    fill_level = property(get_fill_level)
+
+    ## methods public
+
+    def query(self, size=1, dtype=None, out=None):
+        """return noise samples
+
+        :Parameters:
+            size : int
+                Number of samples to produce.
+                Default=1
+            dtype : dtype
+                see NoiseGen.query, types other than float64 are copied.
+            out : ndarray
+                see NoiseGen.query
+        :Returns:
+            ndarray : view into the ring buffer, valid until the next query
+        """
+
+        # release the previous frame
+        self._tail.value += self._taken
+        self._taken = 0
+
+        # wait for a dry ring, the fallback for frames that never fit
+        if self._head.value - self._tail.value < size:
+            self.underruns += 1
+            if size > self.capacity - self.block_size:
+                return self.noise_gen.query(size, dtype, out)
+            while self._head.value - self._tail.value < size:
+                if not self._proc.is_alive():
+                    return self.noise_gen.query(size, dtype, out)
+                time.sleep(0.0001)
+
+        # take from the ring
+        idx = self._tail.value % self.capacity
+        if idx + size <= self.capacity:
+            rval = self._ring[idx:idx + size]
+        else:
+            rval = N.concatenate((
+                self._ring[idx:],
+                self._ring[:idx + size - self.capacity]
+            ))
+        self._taken = size
+        return self._output(rval, dtype, out)
+
+    def stop(self):
+        """stop the producer process"""
+
+        self._stop.set()
+        if self._proc.is_alive():
+            self._proc.join(1.0)
+
+    ## special methods
+
+    def __del__(self):
+        try:
+            self.stop()
+        except:
+            pass
+
+
+##---FUNCTIONS
+
+def _producer_run(noise_gen, buf, head, tail, stop, capacity, block_size):
+    """producer process main loop, fills the ring buffer"""
+
+    # the process inherits the random state, so reseed
+    NR.seed()
+    ring = N.frombuffer(buf, dtype=N.float64)
+    ring.shape = (capacity, noise_gen.nvar)
+
+    while not stop.is_set():
+
+        # wait for space
+        if capacity - (head.value - tail.value) < block_size:
+            stop.wait(0.001)
+            continue
+
+        # produce one block
+        data = noise_gen.query(block_size)
+        idx = head.value % capacity
+        n1 = min(block_size, capacity - idx)
+        ring[idx:idx + n1] = data[:n1]
+        if n1 < block_size:
+            ring[:block_size - n1] = data[n1:]
+        head.value += block_size
+
+
+##---MAIN
+
+__all__ = ['NoiseProducer']
+
+if __name__ == '__main__':
+    pass
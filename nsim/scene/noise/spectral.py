@@ -0,0 +1,254 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene/noise/spectral.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-14
+#
+
+"""noise generation from a cross-spectral density matrix"""
+__docformat__ = "restructuredtext"
+
+
+##---IMPORTS
+
+# packages
+import scipy as N
+from scipy import linalg as NL, random as NR
+from numpy.fft import irfft, rfft
+from noise_gen import NoiseGen
+
+
+##---FUNCTIONS
+
+def csd_fit(p_data, nfft=1024):
+    """estimates the cross-spectral density matrix of multichanneled data
+
+    Welch estimate with a Hann window and segments overlapping by one half. The
+    density is scaled per frequency bin, such that the mean over all nfft bins
+    equals the channel covariance matrix.
+
+    :Parameters:
+        p_data : ndarray
+            Data with observations on the rows and variables on the columns
+        nfft : int
+            Segment length, has to be even.
+            Default=1024
+    :Returns:
+        ndarray : complex array of shape (nfft / 2 + 1, m, m)
+    """
+
+    # checks and inits
+    if not isinstance(p_data, N.ndarray):
+        raise ValueError('p_data is not an ndarray')
+    n, m = p_data.shape
+    if nfft % 2 != 0:
+        raise ValueError('nfft has to be even')
+    if n < nfft:
+        raise ValueError('time series to short!')
+    data = p_data - p_data.mean(axis=0)
+    win = N.hanning(nfft)
+    win /= N.sqrt((win ** 2).mean())
+    hop = nfft / 2
+
+    # average the periodograms
+    rval = N.zeros((hop + 1, m, m), dtype=N.complex128)
+    nseg = 0
+    for i in xrange(0, n - nfft + 1, hop):
+        X = rfft(data[i:i + nfft] * win[:, N.newaxis], axis=0)
+        rval += X[:, :, N.newaxis] * X[:, N.newaxis, :].conj()
+        nseg += 1
+
+    # return
+    return rval / (nseg * nfft)
+
+
+def csd_from_ar(A, C, nfft=1024):
+    """cross-spectral density matrix of a (multivariate) AR model
+
+    :Parameters:
+        A : ndarray
+            AR coefficient matrix
+        C : ndarray
+            Noise covariance matrix
+        nfft : int
+            Number of frequency bins for the full circle, has to be even.
+            Default=1024
+    :Returns:
+        ndarray : complex array of shape (nfft / 2 + 1, m, m), scaled like
+            csd_fit
+    """
+
+    # inits
+    m = C.shape[0]
+    p = A.shape[1] / m
+    omega = 2.0 * N.pi * N.arange(nfft / 2 + 1) / nfft
+    rval = N.zeros((omega.size, m, m), dtype=N.complex128)
+
+    # transfer function per frequency
+    for k in xrange(omega.size):
+        Hinv = N.eye(m, dtype=N.complex128)
+        for j in xrange(p):
+            Hinv -= A[:, j * m:(j + 1) * m] * N.exp(-1j * omega[k] * (j + 1))
+        H = NL.inv(Hinv)
+        rval[k] = N.dot(N.dot(H, C), H.conj().T)
+
+    # return
+    return rval
+
+
+def csd_factor(S):
+    """factor a cross-spectral density matrix per frequency bin
+
+    Returns L such that L[k] * L[k].H equals S[k]. The factor is computed from
+    the eigen decomposition, so positive semi-definite bins are supported.
+
+    :Parameters:
+        S : ndarray
+            complex array of shape (nfreq, m, m)
+    """
+
+    rval = N.zeros_like(S)
+    for k in xrange(S.shape[0]):
+        Sk = 0.5 * (S[k] + S[k].conj().T)
+        lam, V = NL.eigh(Sk)
+        rval[k] = V * N.sqrt(N.maximum(lam, 0.0))
+    return rval
+
+
+##---CLASSES
+
+class SpectralNoiseGen(NoiseGen):
+    """multivariate noise process from a cross-spectral density matrix
+
+    Noise is synthesised in the frequency domain, block by block: complex white
+    noise is colored with a factor of the cross-spectral density matrix and
+    transformed back with an inverse FFT. Consecutive blocks overlap by one
+    half and are crossfaded with a power complementary sine window, so the
+    variance is preserved across block joins. The cost per block is
+    O(nfft log nfft) per channel plus O(nfft m**2) for the coloring.
+    """
+
+    # constructor
+    def __init__(self, noise_params, nfft=1024):
+        """
+        :Parameters:
+            noise_params : tuple
+                A tuple of length 1 or 2:
+                len 1: A strip of data to estimate the density from.
+                len 2: A and C, the matching AR coefficient and channel
+                    covariance matrices, the density of that AR model is used.
+            nfft : int
+                Block length of the synthesis, has to be even.
+                Default=1024
+        """
+
+        # check parameters
+        if nfft % 2 != 0:
+            raise ValueError('nfft has to be even')
+        if len(noise_params) == 1:
+            if not issubclass(noise_params[0].__class__, N.ndarray):
+                raise ValueError('noise strip should be ndarray')
+            S = csd_fit(noise_params[0], nfft)
+        elif len(noise_params) == 2:
+            if not issubclass(noise_params[0].__class__, N.ndarray) or \
+            not issubclass(noise_params[1].__class__, N.ndarray):
+                raise ValueError('A and C matrix should be ndarrays')
+            S = csd_from_ar(noise_params[0], noise_params[1], nfft)
+        else:
+            raise ValueError('noise_params not tuple/list of len 1 or 2')
+
+        # super [zeros mean, covariance of the process]
+        sigma = (2.0 * S[1:-1].sum(axis=0) + S[0] + S[-1]).real / nfft
+        super(SpectralNoiseGen, self).__init__(
+            mu=N.zeros(S.shape[1]),
+            sigma=sigma
+        )
+
+        # members
+        self.nfft = int(nfft)
+        self.hop = self.nfft / 2
+        self.csd = S
+        self.csd_factor = csd_factor(S)
+        self.window = N.sin(N.pi * (N.arange(self.nfft) + 0.5) / self.nfft)
+        self._buf = N.zeros((0, self.nvar))
+        self._pending = self._synthesize()[self.hop:]
+
+    ## methods private
+
+    def _synthesize(self):
+        """one windowed block of noise"""
+
+        # complex white noise, real valued for dc and nyquist
+        nfreq = self.hop + 1
+        Z = NR.randn(nfreq, self.nvar) + 1j * NR.randn(nfreq, self.nvar)
+        Z *= N.sqrt(0.5)
+        Z[0] = NR.randn(self.nvar)
+        Z[-1] = NR.randn(self.nvar)
+
+        # color and transform
+        X = (self.csd_factor * Z[:, N.newaxis, :]).sum(axis=2)
+        X *= N.sqrt(self.nfft)
+        rval = irfft(X, n=self.nfft, axis=0)
+        rval *= self.window[:, N.newaxis]
+        return rval
+
+    def _next_block(self):
+        """overlap-add the next block to the sample buffer"""
+
+        block = self._synthesize()
+        ready = self._pending + block[:self.hop]
+        self._pending = block[self.hop:]
+        self._buf = N.concatenate((self._buf, ready))
+
+    ## methods public
+
+    def query(self, size=1, dtype=None, out=None):
+        """return noise samples
+
+        :Parameters:
+            size : int
+                Number of samples to produce.
+                Default=1
+            dtype : dtype
+                see NoiseGen.query
+            out : ndarray
+                see NoiseGen.query
+        """
+
+        while self._buf.shape[0] < size:
+            self._next_block()
+        rval = self._buf[:size]
+        self._buf = self._buf[size:]
+        return self._output(rval, dtype, out)
+
+
+##---MAIN
+
+__all__ = [
+    'csd_factor',
+    'csd_fit',
+    'csd_from_ar',
+    'SpectralNoiseGen',
+]
+
+if __name__ == '__main__':
+    pass
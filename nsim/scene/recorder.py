@@ -34,11 +34,57 @@ __doctype__ = 'restructuredtext'
 import scipy as N
 # own packages
 from sim_object import SimObject
-from neuron import BadNeuronQuery, Neuron
-from noise import NoiseGen, ArNoiseGen
+from neuron import BadNeuronQuery, Neuron, LOD_CULLED
+from noise import (
+    NoiseGen,
+    ArNoiseGen,
+    BackgroundNoiseGen,
+    BankNoiseGen,
+    LibraryNoiseGen,
+    LowRankNoiseGen,
+    NoiseBank,
+    NoiseProducer,
+    SpectralNoiseGen,
+    bank_key
+)
 from nsim.math import unit_vector
 
 
+##---CONSTANTS
+
+# noise AR model from munk data, shared by all Tetrode instances
+TETRODE_NOISE_PARAMS = [
+    N.array([
+        [ 0.71442494, 0.20257086, -0.00850916, 0.2368369 ,
+         - 0.24215925, -0.17167059, 0.0125938 , -0.23022224,
+          0.12538984, 0.04433236, -0.00631453, 0.1004515 ],
+        [-0.03496567, 0.87848262, 0.00826437, 0.07128014,
+          0.03575446, -0.33148169, 0.03356261, -0.03429215,
+         - 0.02584761, 0.15418811, -0.00396265, 0.01696292],
+        [-0.00501744, 0.15455094, 0.74612578, 0.15237156,
+          0.02853695, -0.10804699, -0.2478788 , -0.12939667,
+         - 0.03661882, 0.04972772, 0.14696973, 0.04525116],
+        [-0.02562255, 0.08109374, -0.01441578, 0.81397469,
+          0.03561313, -0.04552583, 0.03256103, -0.31543032,
+         - 0.01135552, 0.01822465, -0.01507197, 0.13653283]
+    ]),
+    N.array([
+        [ 0.02120132, 0.0046539 , 0.00629694, 0.00614801],
+        [ 0.0046539 , 0.02226795, 0.00402148, 0.00663766],
+        [ 0.00629694, 0.00402148, 0.01920582, 0.00401457],
+        [ 0.00614801, 0.00663766, 0.00401457, 0.02340445]
+    ])
+]
+
+# noise generators by name, see Tetrode
+NOISE_MODELS = {
+    'ar'        : ArNoiseGen,
+    'library'   : LibraryNoiseGen,
+    'lowrank'   : LowRankNoiseGen,
+    'spectral'  : SpectralNoiseGen,
+}
+
+
 ##---CLASSES
 
 class Recorder(SimObject):
@@ -58,6 +104,51 @@ class Recorder(SimObject):
             noise : bool
                 If False, do not setup noise generator. For setup in subclass
                 Default=True
+            noise_params : list
+                Parameters for the noise generator. If None, the noise is white
+                with unit variance per channel.
+                Default=None
+            noise_model : str
+                Name of the noise generator in NOISE_MODELS.
+                Default='ar'
+            noise_scale : float
+                Factor to scale recorded noise with, 'library' model only.
+                Use it to convert ADC counts of integer recordings to the
+                units of the simulation.
+                Default=1.0
+            noise_producer : bool
+                If True, the noise generator runs ahead of time in a producer
+                process (see NoiseProducer).
+                Default=False
+            noise_bank : int
+                If > 0, read the noise from a shared, pre-generated tile of
+                that many samples (see NoiseBank), instead of running a noise
+                generator per recorder.
+                Default=0
+            noise_bank_dir : str
+                Directory to store and memory-map noise bank tiles from. If
+                None, tiles are kept in memory.
+                Default=None
+            background : BackgroundNoiseGen or dict
+                Background activity of a distant neuron population, added to
+                the noise. A dict holds the keywords of BackgroundNoiseGen
+                without points, or of BackgroundNoiseGen.from_neuron_data
+                if it has a 'neuron_data' entry.
+                Default=None
+            lod : tuple
+                Levels of detail for the waveforms, as fractions of the noise
+                standard deviation: a channel is culled if the peak voltage it
+                can see from a neuron is below lod[0], and gets the radial
+                approximation of the waveform below lod[1] (see
+                Neuron.query_for_recorder). The noise standard deviation is
+                estimated from the noise frames. If None, all channels get the
+                full waveform.
+                Default=None
+            cull : float
+                Fraction of the noise standard deviation below which channels
+                are culled, without radial approximation. Same as
+                lod=(cull, 0.0), ignored if lod is given.
+                Default=None
         """
 
         # super
@@ -70,7 +161,16 @@ class Recorder(SimObject):
         else:
             self.nchan = self.points.shape[0]
         self._noise_gen = None
+        self._noise_producer = bool(kwargs.get('noise_producer', False))
+        self._noise_bank = int(kwargs.get('noise_bank', 0))
+        self._noise_bank_dir = kwargs.get('noise_bank_dir', None)
+        self._noise_scale = float(kwargs.get('noise_scale', 1.0))
         self._snr = None
+        self._background = None
+        self._noise_var = None
+        self._noise_frames = 0
+        self._lod = None
+        self._lod_stats = N.zeros(LOD_CULLED + 1, dtype=int)
         traj = kwargs.get('orientation', N.asarray([0.0, 0.0, 1.0]))
         if traj is True or traj is False:
             traj = [0.0, 0.0, 1.0]
@@ -82,7 +182,18 @@ class Recorder(SimObject):
         self.trajectory_pos = 0.0
         noise = kwargs.get('noise', True)
         if noise is True:
-            self._noise_gen = NoiseGen(mu=N.zeros(self.nchan))
+            noise_params = kwargs.get('noise_params', None)
+            if noise_params is None:
+                self._noise_gen = NoiseGen(mu=N.zeros(self.nchan))
+            else:
+                self._noise_gen = self._build_noise_gen(
+                    noise_params,
+                    kwargs.get('noise_model', 'ar')
+                )
+        self.background = kwargs.get('background', None)
+        self.lod = kwargs.get('lod', None)
+        if self.lod is None and kwargs.get('cull', None) is not None:
+            self.lod = (kwargs['cull'], 0.0)
 
     ## properties
 
@@ -98,6 +209,50 @@ class Recorder(SimObject):
         self._snr = float(value)
     snr = property(get_snr, set_snr)
 
+    def get_noise_fill_level(self):
+        if isinstance(self._noise_gen, NoiseProducer):
+            return self._noise_gen.fill_level
+        return None
+    noise_fill_level = property(get_noise_fill_level)
+
+    def get_background(self):
+        return self._background
+    def set_background(self, value):
+        if isinstance(value, dict):
+            value = dict(value)
+            points = (self.points - self.position).reshape(-1, 3)
+            if 'neuron_data' in value:
+                value = BackgroundNoiseGen.from_neuron_data(
+                    points,
+                    value.pop('neuron_data'),
+                    **value
+                )
+            else:
+                value = BackgroundNoiseGen(points, **value)
+        if value is not None and not isinstance(value, BackgroundNoiseGen):
+            raise ValueError('background is not a BackgroundNoiseGen')
+        self._background = value
+    background = property(get_background, set_background)
+
+    def get_lod(self):
+        return self._lod
+    def set_lod(self, value):
+        if value is not None:
+            value = (float(value[0]), float(value[1]))
+        self._lod = value
+    lod = property(get_lod, set_lod)
+
+    # channel queries per level of detail in the last frame
+    def get_lod_stats(self):
+        return self._lod_stats
+    lod_stats = property(get_lod_stats)
+
+    def get_noise_std(self):
+        if self._noise_var is None:
+            return None
+        return N.sqrt(self._noise_var)
+    noise_std = property(get_noise_std)
+
     def get_trajectory(self):
         return self._trajectory
     def set_trajectory(self, value):
@@ -111,9 +266,44 @@ class Recorder(SimObject):
         self.position = self.origin + self._trajectory_pos * self.trajectory
     trajectory_pos = property(get_trajectory_pos, set_trajectory_pos)
 
+    ## methods private
+
+    def _build_noise_gen(self, noise_params, noise_model):
+        """build the noise generator named noise_model from noise_params"""
+
+        if noise_model not in NOISE_MODELS:
+            raise ValueError('unknown noise_model: %s' % noise_model)
+        noise_kwargs = {}
+        key_params = noise_params
+        if noise_model == 'library':
+            # pick as many channels from the recordings as we have
+            if isinstance(noise_params, basestring):
+                noise_params = [noise_params]
+            noise_params = [noise_params[0], self.nchan]
+            noise_kwargs.update(scale=self._noise_scale)
+            key_params = noise_params + [self._noise_scale]
+        if self._noise_bank > 0:
+            bank = NoiseBank.get(
+                bank_key(noise_model, key_params, self._noise_bank),
+                lambda: NOISE_MODELS[noise_model](noise_params, **noise_kwargs),
+                self._noise_bank,
+                bank_dir=self._noise_bank_dir
+            )
+            return BankNoiseGen(bank)
+        rval = NOISE_MODELS[noise_model](noise_params, **noise_kwargs)
+        if self._noise_producer is True:
+            rval = NoiseProducer(rval)
+        return rval
+
     ## methods public
 
-    def simulate(self, nlist=[], frame_size=1):
+    def close(self):
+        """release the noise generator, this stops a noise producer process"""
+
+        if isinstance(self._noise_gen, NoiseProducer):
+            self._noise_gen.stop()
+
+    def simulate(self, nlist=[], frame_size=1, dtype=None):
         """record a multichanneled frame from neurons in range
 
         :Parameters:
@@ -123,6 +313,9 @@ class Recorder(SimObject):
             frame_size : int
                 Size of the frame in samples.
                 Default=1
+            dtype : dtype
+                Type of the noise and waveform data, float64 if None.
+                Default=None
         :Returns:
             list : A list of items for this frame. The first item is the noise
             for this frame. Subsequent items are tuples of waveform and interval
@@ -133,16 +326,41 @@ class Recorder(SimObject):
         # init
         rval = None
         if self._noise_gen is None:
-            rval = [N.zeros((frame_size, self.nchan))]
+            rval = [N.zeros((frame_size, self.nchan), dtype=dtype or N.float64)]
         else:
-            rval = [self._noise_gen.query(size=frame_size) / self.snr]
+            # scale in place, the noise may be a view into a producer ring
+            rval = [self._noise_gen.query(size=frame_size, dtype=dtype)]
+            rval[0] *= 1.0 / self.snr
+        if self._background is not None:
+            rval[0] += self._background.query(size=frame_size)
+
+        # levels of detail from the noise level, averaged over the frames
+        lod = None
+        self._lod_stats[:] = 0
+        if self._lod is not None:
+            self._noise_frames += 1
+            alpha = max(1.0 / self._noise_frames, 1.0 / 64)
+            if self._noise_var is None:
+                self._noise_var = rval[0].var(axis=0)
+            else:
+                self._noise_var += alpha * (rval[0].var(axis=0) -
+                                            self._noise_var)
+            noise_std = N.sqrt(self._noise_var)
+            lod = (self._lod[0] * noise_std, self._lod[1] * noise_std)
 
         # for each neuron query waveform and firing data
+        points = self.points[:self.nchan]
         for nrn in nlist:
             try:
-                rval.extend(nrn.query_for_recorder(self.points[:self.nchan]))
+                rval.extend(nrn.query_for_recorder(points, dtype, lod))
             except BadNeuronQuery:
                 continue
+            finally:
+                if lod is not None and nrn.lod_levels is not None:
+                    self._lod_stats += N.bincount(
+                        nrn.lod_levels,
+                        minlength=LOD_CULLED + 1
+                    )
 
         # return
         return tuple(rval)
@@ -157,8 +375,20 @@ class Tetrode(Recorder):
         :Keywords:
             noise_params : list
                 List with 2 matricies, [ar parameters, channel covariance] with
-                consistant shapes.
+                consistant shapes, or a list with a noise strip to estimate the
+                noise model from. For the 'library' model, a list with the path
+                to the noise library directory.
                 Default=None
+            noise_model : str
+                Name of the noise generator in NOISE_MODELS, 'ar' for the time
+                domain AR recursion, 'spectral' for FFT based synthesis,
+                'lowrank' for the low-rank spatial model, 'library' for
+                recorded noise from a noise library. Without noise_params,
+                'lowrank' and 'library' fall back to 'ar'.
+                Default='ar'
+            noise_scale : float
+                see Recorder
+                Default=1.0
         """
 
         # tetrode points
@@ -178,40 +408,31 @@ class Tetrode(Recorder):
 
         # noise AR model from munk data
         noise_params = kwargs.get('noise_params', None)
-        if noise_params is not None:
+        noise_model = kwargs.get('noise_model', 'ar')
+        if noise_params is not None and noise_model != 'library':
+            # the library model picks its channels itself
             try:
-                # list of len 2
-                assert len(noise_params) == 2
-                # ar parameters consistent with points
-                assert noise_params[0].shape[0] == self.nchan
-                # channel covariance
-                assert noise_params[1].shape[0] == noise_params[1].shape[1] == self.nchan
+                if len(noise_params) == 1:
+                    # noise strip consistent with points
+                    assert noise_params[0].shape[1] == self.nchan
+                elif len(noise_params) == 5:
+                    # low-rank model loading consistent with points
+                    assert noise_params[0].shape[0] == self.nchan
+                else:
+                    # list of len 2
+                    assert len(noise_params) == 2
+                    # ar parameters consistent with points
+                    assert noise_params[0].shape[0] == self.nchan
+                    # channel covariance
+                    assert noise_params[1].shape[0] == noise_params[1].shape[1] == self.nchan
             except:
                 noise_params = None
         if noise_params is None:
-            noise_params = [
-                N.array([
-                    [ 0.71442494, 0.20257086, -0.00850916, 0.2368369 ,
-                     - 0.24215925, -0.17167059, 0.0125938 , -0.23022224,
-                      0.12538984, 0.04433236, -0.00631453, 0.1004515 ],
-                    [-0.03496567, 0.87848262, 0.00826437, 0.07128014,
-                      0.03575446, -0.33148169, 0.03356261, -0.03429215,
-                     - 0.02584761, 0.15418811, -0.00396265, 0.01696292],
-                    [-0.00501744, 0.15455094, 0.74612578, 0.15237156,
-                      0.02853695, -0.10804699, -0.2478788 , -0.12939667,
-                     - 0.03661882, 0.04972772, 0.14696973, 0.04525116],
-                    [-0.02562255, 0.08109374, -0.01441578, 0.81397469,
-                      0.03561313, -0.04552583, 0.03256103, -0.31543032,
-                     - 0.01135552, 0.01822465, -0.01507197, 0.13653283]
-                ]),
-                N.array([
-                    [ 0.02120132, 0.0046539 , 0.00629694, 0.00614801],
-                    [ 0.0046539 , 0.02226795, 0.00402148, 0.00663766],
-                    [ 0.00629694, 0.00402148, 0.01920582, 0.00401457],
-                    [ 0.00614801, 0.00663766, 0.00401457, 0.02340445]
-                ])
-            ]
-        self._noise_gen = ArNoiseGen(noise_params)
+            # the default parameters are for the ar model
+            noise_params = TETRODE_NOISE_PARAMS
+            if noise_model in ['library', 'lowrank']:
+                noise_model = 'ar'
+        self._noise_gen = self._build_noise_gen(noise_params, noise_model)
 
 
 ##---PACKAGE
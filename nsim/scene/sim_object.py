@@ -59,8 +59,10 @@ class SimObject(object):
                 An identifier for the SimObject. This should be castable to str.
             orientation : ndarray or bool
                 Orientation of the object. ndarray is interpreted as direction
-                of orientation relative to the scene's positive z-axis. If True
-                a random rotation is created. If False, no orientation.
+                of orientation relative to the scene's positive z-axis, or as
+                the rotation quaternion if it has 4 elements (as returned by
+                the orientation property). If True a random rotation is
+                created. If False, no orientation.
                 Default=False
             points : arraylike
                 Coordinates forming this object, expressed in the local
@@ -107,7 +109,10 @@ class SimObject(object):
     def get_orientation(self):
         return self._orientation
     def set_orientation(self, value):
-        if isinstance(value, (list, N.ndarray)):
+        if isinstance(value, (list, N.ndarray)) and len(value) == 4:
+            # quaternion, as returned by get_orientation
+            self._orientation = N.asarray(value, dtype=float)
+        elif isinstance(value, (list, N.ndarray)):
             value = N.asarray(value)
             # find quaternion for rotation
             n = N.cross([0, 0, 1], unit_vector(value[:3]))
@@ -0,0 +1,424 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene_archive.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-17
+#
+
+"""single-file scene archive (.sca) for the Neural Simulation
+
+A scene archive holds a complete scene: the simulation config, all neuron data
+referenced by the scene (each dataset once) and the objects of the scene. The
+archives are HDF5 containers with a predefined structure, as explained here:
+
+SCENE ARCHIVE (.sca) - HDF5 container
+    #TYPE : string node
+        all groups must contain a '#TYPE' identifying its purpose as a string.
+        available #TYPE identifiers are:
+            SCENE_ARCHIVE : for the root node
+            CONFIG        : for the NS config group
+            NEURON_DATA   : for the neuron data group
+            NeuronData    : for NeuronData nodes
+            SCENE         : for the scene group
+            SimObject     : SimObject nodes
+    #CLASS : string node
+        various groups define a parameter set to instantiate a class. this
+        string holds the name of the class as given by class.__class__.
+    
+    The basic structure for a scene archive is:
+        
+        ROOT
+         |- #TYPE = 'SCENE_ARCHIVE'
+         |- CONFIG
+         |   |- #TYPE = 'CONFIG'
+         |   |- frame_size = 1024
+         |   |- sample_rate = 16000.0
+         |   |- [...]
+         |- NEURON_DATA
+         |   |- #TYPE = 'NEURON_DATA'
+         |   |- NDATA00
+         |   |   |- #TYPE = 'NeuronData'
+         |   |   |- #CLASS = '<neurondata subclass name>'
+         |   |   |- #DESCRIPTION = '<neurondata description>'
+         |   |   |- [...]
+         |   |- NDATA01
+         |   |   |- #TYPE = 'NeuronData'
+         |   |   |- #CLASS = '<neurondata subclass name>'
+         |   |   |- #DESCRIPTION = '<neurondata description>'
+         |   |   |- [...]
+         |   |- [...]
+         |- SCENE
+             |- #TYPE = 'SCENE'
+             |- SIMOBJ00
+             |   |- #TYPE = 'SimObject'
+             |   |- #CLASS = '<simobject subclass name>'
+             |   |- [...]
+             |- SIMOBJ01
+             |   |- #TYPE = 'SimObject'
+             |   |- #CLASS = '<simobject subclass name>'
+             |   |- [...]
+             |- [...]
+    
+    All nodes are tagged with at #TYPE tag and when a node specifies a parameter
+    set for a class, a #CLASS tag is additionally given.
+
+    A NeuronData group holds the nodes of the archive the data was loaded
+    from, the data is loaded with the from_file factory of the class using the
+    group as the root (rootUEP).
+
+    A SimObject group holds a set of objects of one class, with one node per
+    parameter and one row per object. Each parameter is a keyword of the
+    register method of BaseSimulation for that class, neuron_data holds the key
+    of a NeuronData group. Missing values are encoded per parameter:
+        cluster     : -1 for no cluster
+        orientation : rows padded with NaN, a row of NaN for False and a row
+            of inf for True (random orientation)
+"""
+__docformat__ = 'restructuredtext'
+
+
+##---IMPORTS
+
+import scipy as N
+from tables import openFile, NoSuchNodeError
+from scene import neuron_data
+
+
+##---CONSTANTS
+
+SCA_GROUPS = ['CONFIG', 'NEURON_DATA', 'SCENE']
+
+
+##---CLASSES
+
+class SceneArchiveContainer(object):
+    """scene archive container (.sca) class
+        
+    defining the structure inside an hdf5 container to hold the entire scene
+    """
+
+    ## constructor
+
+    def __init__(self, path_to_arc, mode='r'):
+        """
+        :Parameters:
+            path_to_arc : str
+                Path to the hdf5 archive in the local file system.
+            mode : str
+                'r' to read an archive, 'w' to create a new archive and 'a' to
+                append to an archive.
+                Default='r'
+        :Exceptions:
+            IOError:
+                Error opening the archive, or the archive is not a scene
+                archive.
+        """
+
+        # get handle to archive
+        self.path = path_to_arc
+        self._arc = openFile(path_to_arc, mode)
+        self._grp = {}
+
+        # establish main structure
+        try:
+            arc_type = self._get_tag(self._arc.root, 'TYPE')
+            if arc_type is None and mode != 'r':
+                self._set_tag(self._arc.root, 'TYPE', 'SCENE_ARCHIVE')
+            elif arc_type != 'SCENE_ARCHIVE':
+                raise IOError('not a scene archive: %s' % path_to_arc)
+            for grp_type in SCA_GROUPS:
+                grp = self._get_main_grp(grp_type)
+                if grp is None:
+                    if mode == 'r':
+                        raise IOError('no %s group in scene archive: %s' %
+                                      (grp_type, path_to_arc))
+                    grp = self._arc.createGroup(self._arc.root, grp_type)
+                    self._set_tag(grp, 'TYPE', grp_type)
+                self._grp[grp_type] = grp
+        except:
+            self._arc.close()
+            raise
+
+    ## internal helper functions
+
+    def _has_main_grp(self, grp_type):
+        """return True if the main group of grp_type is present, False else"""
+
+        return self._get_main_grp(grp_type) is not None
+
+    def _get_main_grp(self, grp_type):
+        """returns the main group of grp_type if present, None else"""
+
+        for grp in self._arc.iterNodes(self._arc.root, classname='Group'):
+            if self._get_tag(grp, 'TYPE') == grp_type:
+                return grp
+        return None
+
+    def _get_tag(self, grp, tag_name):
+        """returns the value of a tag of grp if present, None else"""
+
+        try:
+            return str(self._arc.getNode(grp, self.make_tag(tag_name)).read())
+        except NoSuchNodeError:
+            return None
+
+    def _set_tag(self, grp, tag_name, val):
+        """set a tag of grp"""
+
+        self._set_node(grp, self.make_tag(tag_name), str(val))
+
+    def _set_node(self, grp, name, val):
+        """create or replace the array node name in grp"""
+
+        try:
+            self._arc.removeNode(grp, name)
+        except NoSuchNodeError:
+            pass
+        self._arc.createArray(grp, name, val)
+
+    def _get_children(self, grp, grp_type):
+        """returns the sub groups of grp tagged grp_type, sorted by name"""
+
+        return sorted([
+            item for item in self._arc.iterNodes(grp, classname='Group')
+            if self._get_tag(item, 'TYPE') == grp_type
+        ], key=lambda item: item._v_name)
+
+    @staticmethod
+    def make_tag(tag_name):
+        return '#%s' % tag_name
+
+    ## data interface - CONFIG
+
+    def get_config(self):
+        """get CONFIG section as dict"""
+
+        rval = {}
+        for item in self._arc.iterNodes(self._grp['CONFIG'], classname='Array'):
+            if item.name.startswith('#'):
+                continue
+            rval[item.name] = N.asarray(item.read()).tolist()
+        return rval
+
+    def set_config(self, config):
+        """set CONFIG section from dict, None values are skipped"""
+
+        assert isinstance(config, dict)
+
+        for k, v in config.items():
+            if v is not None:
+                self.set_config_item(k, v)
+
+    def get_config_item(self, key):
+        """get single config item"""
+
+        try:
+            return N.asarray(
+                self._arc.getNode(self._grp['CONFIG'], key).read()
+            ).tolist()
+        except NoSuchNodeError:
+            return None
+
+    def set_config_item(self, key, val):
+        """set single config item"""
+
+        self._set_node(self._grp['CONFIG'], key, val)
+
+    ## data interface - NEURON_DATA
+
+    def get_ndata_keys(self):
+        """return the keys of all NeuronData groups"""
+
+        return [grp._v_name for grp in
+                self._get_children(self._grp['NEURON_DATA'], 'NeuronData')]
+
+    def add_ndata(self, ndata):
+        """add a NeuronData object to the archive
+
+        The nodes of the archive the NeuronData object was loaded from are
+        copied. NeuronData objects are compared by their description, so each
+        dataset is added once.
+
+        :Parameters:
+            ndata : NeuronData
+                A NeuronData object loaded from an archive, its filename member
+                (and its rootUEP member, if present) locate the archive.
+        :Returns:
+            str : the key of the NeuronData group
+        :Exceptions:
+            ValueError:
+                Error if ndata was not loaded from an archive.
+        """
+
+        # checks
+        grps = self._get_children(self._grp['NEURON_DATA'], 'NeuronData')
+        for grp in grps:
+            if self._get_tag(grp, 'DESCRIPTION') == ndata.description:
+                return grp._v_name
+        filename = getattr(ndata, 'filename', None)
+        if filename is None:
+            raise ValueError('%s was not loaded from an archive' % ndata)
+
+        # copy
+        key = 'NDATA%02d' % len(grps)
+        grp = self._arc.createGroup(self._grp['NEURON_DATA'], key)
+        src = openFile(filename, 'r',
+                       rootUEP=getattr(ndata, 'rootUEP', '/'))
+        try:
+            for item in src.iterNodes(src.root):
+                if not item._v_name.startswith('#'):
+                    item._f_copy(grp, recursive=True)
+        finally:
+            src.close()
+        self._set_tag(grp, 'TYPE', 'NeuronData')
+        self._set_tag(grp, 'CLASS', ndata.__class__.__name__)
+        self._set_tag(grp, 'DESCRIPTION', ndata.description)
+        return key
+
+    def load_ndata(self, key, **kwargs):
+        """load a neuron data from the archive
+
+        :Parameters:
+            key : str
+                The key of the NeuronData group.
+        :Keywords:
+            Load options, passed to the from_file factory of the class.
+        :Returns:
+            NeuronData : the NeuronData object with the description it was
+                added with, its filename and rootUEP members locate the group.
+            None : on any error
+        """
+
+        try:
+            grp = self._arc.getNode(self._grp['NEURON_DATA'], key)
+            cls = getattr(neuron_data, self._get_tag(grp, 'CLASS'))
+            assert issubclass(cls, neuron_data.NeuronData)
+            rval = cls.from_file(self.path, rootUEP=grp._v_pathname, **kwargs)
+        except:
+            return None
+        if rval is not None:
+            rval.description = self._get_tag(grp, 'DESCRIPTION')
+            rval.filename = self.path
+            rval.rootUEP = grp._v_pathname
+        return rval
+
+    ## data interface - SCENE
+
+    def add_simobjs(self, cls_name, items):
+        """add a set of SimObjects of one class to the archive
+
+        :Parameters:
+            cls_name : str
+                The class name of the SimObjects.
+            items : list
+                A list of dicts, the keywords to register each SimObject with.
+                All dicts should have the same keys, missing values are
+                allowed for cluster and orientation only.
+        :Returns:
+            str : the key of the SimObject group, None if items is empty
+        """
+
+        # checks
+        if len(items) == 0:
+            return None
+        keys = set()
+        for item in items:
+            keys.update(item.keys())
+
+        # columns
+        key = 'SIMOBJ%02d' % len(
+            self._get_children(self._grp['SCENE'], 'SimObject'))
+        grp = self._arc.createGroup(self._grp['SCENE'], key)
+        self._set_tag(grp, 'TYPE', 'SimObject')
+        self._set_tag(grp, 'CLASS', cls_name)
+        for k in sorted(keys):
+            values = [item.get(k, None) for item in items]
+            if k == 'cluster':
+                col = N.asarray([-1 if v is None else int(v) for v in values])
+            elif k == 'orientation':
+                vecs = [
+                    None if v is None or v is True or v is False
+                    else N.atleast_1d(N.asarray(v, dtype=float))
+                    for v in values
+                ]
+                col = N.empty((len(values), max(
+                    [3] + [v.size for v in vecs if v is not None])))
+                col.fill(N.nan)
+                for i in xrange(len(values)):
+                    if values[i] is True:
+                        col[i] = N.inf
+                    elif vecs[i] is not None:
+                        col[i, :vecs[i].size] = vecs[i]
+            else:
+                col = N.asarray(values)
+            self._arc.createArray(grp, k, col)
+        return key
+
+    def get_simobjs(self):
+        """return all SimObjects in the archive
+
+        :Returns:
+            list : (class name, keywords) for all SimObjects, keywords is a
+                dict as for the register methods of BaseSimulation.
+        """
+
+        rval = []
+        for grp in self._get_children(self._grp['SCENE'], 'SimObject'):
+            cls_name = self._get_tag(grp, 'CLASS')
+            cols = {}
+            for item in self._arc.iterNodes(grp, classname='Array'):
+                if not item.name.startswith('#'):
+                    cols[item.name] = item.read()
+            nitems = min([len(col) for col in cols.values()] or [0])
+            for i in xrange(nitems):
+                kwargs = {}
+                for k, col in cols.items():
+                    if k == 'cluster':
+                        if col[i] >= 0:
+                            kwargs[k] = int(col[i])
+                    elif k == 'orientation':
+                        v = col[i][~N.isnan(col[i])]
+                        if v.size == 0:
+                            kwargs[k] = False
+                        elif N.isinf(v).all():
+                            kwargs[k] = True
+                        else:
+                            kwargs[k] = v.tolist()
+                    else:
+                        kwargs[k] = col[i].tolist()
+                rval.append((cls_name, kwargs))
+        return rval
+
+    ## methods public
+
+    def close(self):
+        """close the archive"""
+
+        self._arc.close()
+
+
+##---MAIN
+
+__all__ = ['SCA_GROUPS', 'SceneArchiveContainer']
+
+if __name__ == '__main__':
+    pass
@@ -30,58 +30,7 @@ from __future__ import division
 
 This module provides a GUI based approach to scene building. A initial scene can
 be configured and saved as a loadable archive. The loadable archives are HDF5
-containers with a predefined structure, as explained here:
-
-SCENE ARCHIVE (.sca) - HDF5 container
-    #TYPE : string node
-        all groups must contain a '#TYPE' identifying its purpose as a string.
-        available #TYPE identifiers are:
-            SCENE_ARCHIVE : for the root node
-            CONFIG        : for the NS config group
-            NEURON_DATA   : for the neuron data group
-            NeuronData    : for NeuronData nodes
-            SCENE         : for the scene group
-            SimObject     : SimObject nodes
-    #CLASS : string node
-        various groups define a parameter set to instantiate a class. this
-        string holds the name of the class as given by class.__class__.
-    
-    The basic structure for a scene archive is:
-        
-        ROOT
-         |- #TYPE = 'SCENE_ARCHIVE'
-         |- CONFIG
-         |   |- #TYPE = 'CONFIG'
-         |   |- frame_size = 1024
-         |   |- sample_rate = 16000.0
-         |   |- [...]
-         |- NEURON_DATA
-         |   |- #TYPE = 'NEURON_DATA'
-         |   |- NDATA00
-         |   |   |- #TYPE = 'NeuronData'
-         |   |   |- #CLASS = '<neurondata subclass name>'
-         |   |   |- [...]
-         |   |- NDATA01
-         |   |   |- #TYPE = 'NeuronData'
-         |   |   |- #CLASS = '<neurondata subclass name>'
-         |   |   |- [...]
-         |   |- [...]
-         |- SCENE
-             |- #TYPE = 'SCENE'
-             |- SIMOBJ00
-             |   |- #TYPE = 'SimObject'
-             |   |- #CLASS = '<simobject subclass name>'
-             |   |- [...]
-             |- SIMOBJ01
-             |   |- #TYPE = 'SimObject'
-             |   |- #CLASS = '<simobject subclass name>'
-             |   |- [...]
-             |- [...]
-    
-    All nodes are tagged with at #TYPE tag and when a node specifies a parameter
-    set for a class, a #CLASS tag is additionally given.
-    
-    [t.b.c]  
+containers with a predefined structure, see nsim.scene_archive.
 """
 __docformat__ = 'restructuredtext'
 
@@ -91,7 +40,7 @@ __docformat__ = 'restructuredtext'
 import scipy as N
 from gui.Ui_scene_gen import Ui_SceneGenerator
 from PyQt4 import QtCore, QtGui
-from tables import openFile
+from scene_archive import SceneArchiveContainer
 
 
 ##---CONSTANTS
@@ -359,115 +308,6 @@ class WFWidget(QtGui.QWidget):
         return factor * mywf
 
 
-class SceneArchiveContainer(object):
-    """scene archive container (.sca) class
-        
-    defining the structure inside an hdf5 container to hold the entire scene
-    """
-
-    def _init__(self, path_to_arc):
-        """
-        :Parameters:
-            path_to_arc : str
-                Path to the hdf5 archive in the local file system.
-        """
-
-        # get handle to archive
-        try:
-            self._arc = openFile(path_to_arc, 'r')
-        except:
-            self._arc = openFile(path_to_arc, 'w')
-        self._grp_config = None
-        self._grp_ndata = None
-        self._grp_scene = None
-
-        # establish main structure
-        if '/__TYPE__' not in self._arc:
-            self._arc.createArray(self._arc.root, '__TYPE__', 'SCENE_ARCHIVE')
-        if self._has_main_grp('CONFIG'):
-            self._grp_config = self._get_main_grp('CONFIG')
-        else:
-            self._grp_config = self._arc.createGroup(self._arc.root, 'CONFIG')
-            self._arc.createArray(self._grp_config, '__TYPE__', 'CONFIG')
-        if self._has_main_grp('NEURON_DATA'):
-            self._grp_ndata = self._get_main_grp('NEURON_DATA')
-        else:
-            self._grp_ndata = self._arc.createGroup(self._arc.root, 'NEURON_DATA')
-            self._arc.createArray(self._grp_ndata, '__TYPE__', 'NEURON_DATA')
-        if self._has_main_grp('SCENE'):
-            self._grp_scene = self._get_main_grp('SCENE')
-        else:
-            self._grp_scene = self._arc.createGroup(self._arc.root, 'SCENE')
-            self._arc.createArray(self._grp_scene, '__TYPE__', 'SCENE')
-
-    ## internal helper functions
-
-    def _has_main_grp(self, grp_type):
-        """return True if the main group of grp_type is present, False else"""
-
-        return self._get_main_grp(grp_type) is not None
-
-    def _get_main_grp(self, grp_type):
-        """returns the main group of grp_type if present, None else"""
-
-        rval = None
-        for grp in self._arc.walkGroups():
-            if '__TYPE__' in grp:
-                if grp.__TYPE__.read() == grp_type:
-                    rval = grp
-                    break
-        return rval
-
-    @staticmethod
-    def make_tag(tag_name):
-        return '#%s' % tag_name
-
-    ## data interface - CONFIG
-
-    def get_config(self):
-        """get CONFIG section as dict"""
-
-        rval = {}
-        for item in self._arc.walkNodes(self._grp_config):
-            if item.name.startswith('#'):
-                continue
-            rval[item.name] = item.read()
-        return rval
-
-    def set_config(self, config):
-        """set CONFIG section from dict"""
-
-        assert isinstance(config, dict)
-
-        for k, v in config:
-            try:
-                node = getattr(self._grp_config, k)
-                setattr(self._grp_config, k, v)
-            except:
-                self._arc.createArray(self._grp_config, k, v)
-
-    def get_config_item(self, key):
-        """get single config item"""
-
-        rval = None
-        try:
-            return getattr(self._grp_config, key)
-        except:
-            return None
-
-    def set_config_item(self, key, val):
-        """set single config item"""
-
-        setattr(self._grp_config, key, val)
-
-    ## data interface - NEURON_DATA
-
-    def load_ndata(self, key):
-        """load a neuron data from the archive"""
-
-
-
-
 ##---MAIN
 
 def main(args):
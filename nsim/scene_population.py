@@ -0,0 +1,441 @@
+#﻿# -*- coding: utf-8 -*-
+################################################################################
+##
+##  Copyright 2010 Philipp Meier <pmeier82@googlemail.com>
+##
+##  Licensed under the EUPL, Version 1.1 or – as soon they will be approved by
+##  the European Commission - subsequent versions of the EUPL (the "Licence");
+##  You may not use this work except in compliance with the Licence.
+##  You may obtain a copy of the Licence at:
+##
+##  http://ec.europa.eu/idabc/eupl
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the Licence is distributed on an "AS IS" basis,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the Licence for the specific language governing permissions and
+##  limitations under the Licence.
+##
+################################################################################
+#
+# nsim - scene_population.py
+#
+# Philipp Meier - <pmeier82 at googlemail dot com>
+# 2010-09-17
+#
+
+"""procedural generation of large neuron populations for the Neural Simulation
+
+A population is a dict of arrays with one row per neuron, holding the keywords
+of BaseSimulation.register_neuron: position, orientation, rate_of_fire,
+amplitude, cluster (-1 for singletons) and neuron_data. Positions are drawn
+from a density profile (see layer_density and column_density) with a minimal
+distance between somata, enforced with a spatial hash grid. All other
+parameters are drawn vectorized. Populations are registered with
+BaseSimulation.register_many (see population_items) or saved as scene config
+files (see population_save).
+"""
+__docformat__ = 'restructuredtext'
+
+
+##---IMPORTS
+
+import scipy as N
+from scipy import random as NR
+
+
+##---CONSTANTS
+
+# maximal number of cells of the spacing grid
+POP_GRID_MAX = 2 ** 27
+
+
+##---FUNCTIONS
+
+def layer_density(layers, axis=2):
+    """density profile of horizontal layers
+
+    :Parameters:
+        layers : list
+            A list of tuples (lower bound, upper bound, density) along axis.
+            The density is 0.0 outside of all layers.
+        axis : int
+            The axis across the layers, the z-axis by default.
+            Default=2
+    :Returns:
+        callable : the density for an array of positions
+    """
+
+    layers = [(float(lo), float(hi), float(w)) for lo, hi, w in layers]
+
+    def density(pos):
+        rval = N.zeros(pos.shape[0])
+        for lo, hi, w in layers:
+            rval[(pos[:, axis] >= lo) & (pos[:, axis] < hi)] = w
+        return rval
+    return density
+
+
+def column_density(columns, background=0.0, axis=2):
+    """density profile of vertical columns
+
+    :Parameters:
+        columns : list
+            A list of tuples (x, y, radius, density), the centre and radius of
+            the column in the plane normal to axis.
+        background : float
+            The density outside of all columns.
+            Default=0.0
+        axis : int
+            The axis along the columns, the z-axis by default.
+            Default=2
+    :Returns:
+        callable : the density for an array of positions
+    """
+
+    plane = [i for i in xrange(3) if i != axis]
+    columns = [(N.asarray([x, y], dtype=float), float(r) ** 2, float(w))
+               for x, y, r, w in columns]
+
+    def density(pos):
+        rval = N.empty(pos.shape[0])
+        rval.fill(background)
+        for centre, r2, w in columns:
+            d2 = ((pos[:, plane] - centre) ** 2).sum(axis=1)
+            rval[d2 < r2] = N.maximum(rval[d2 < r2], w)
+        return rval
+    return density
+
+
+def population_positions(nneurons, bounds, density=None, min_dist=10.0,
+                         max_rounds=100):
+    """draw soma positions from a density profile with a minimal distance
+
+    Candidates are drawn uniformly in the bounds in batches and accepted with
+    a probability proportional to the density. A candidate is rejected if an
+    accepted position or an earlier candidate of the same batch lies within
+    min_dist. Accepted positions are kept in a grid hash with a cell
+    diagonal of min_dist, so each cell holds at most one position and a test
+    reads the cells of a fixed neighbourhood only.
+
+    :Parameters:
+        nneurons : int
+            Number of positions.
+        bounds : arraylike
+            Lower and upper corner of the box to fill, shape (2, 3).
+        density : callable
+            The density for an array of positions (relative values), uniform
+            if None. See layer_density and column_density.
+            Default=None
+        min_dist : float
+            Minimal distance between positions, 0.0 for no spacing.
+            Default=10.0
+        max_rounds : int
+            Maximal number of candidate batches.
+            Default=100
+    :Returns:
+        ndarray : positions, shape (n, 3)
+    :Exceptions:
+        ValueError:
+            Error if the spacing grid is too large, or the box cannot hold
+            nneurons positions with this density and spacing.
+    """
+
+    # checks and inits
+    nneurons = int(nneurons)
+    bounds = N.asarray(bounds, dtype=float)
+    lo, extent = bounds[0], bounds[1] - bounds[0]
+    if (extent <= 0.0).any():
+        raise ValueError('empty bounds: %s' % bounds.tolist())
+    dmax = 1.0
+    if density is not None:
+        dmax = density(lo + NR.random_sample((65536, 3)) * extent).max()
+        if dmax <= 0.0:
+            raise ValueError('density is zero in the bounds')
+
+    # spacing grid, padded by two cells to spare the bounds checks
+    if min_dist > 0.0:
+        cell = min_dist / N.sqrt(3.0)
+        shape = N.ceil(extent / cell).astype(int) + 4
+        if shape.prod() > POP_GRID_MAX:
+            raise ValueError('spacing grid too large: %s cells' % shape.prod())
+        grid = N.empty(shape.prod(), dtype=N.int32)
+        grid.fill(-1)
+        stride = N.asarray([shape[1] * shape[2], shape[2], 1])
+        offsets = N.asarray([
+            (i, j, k)
+            for i in xrange(-2, 3) for j in xrange(-2, 3) for k in xrange(-2, 3)
+            if (N.maximum(N.abs([i, j, k]) - 1, 0) ** 2).sum() < 3
+        ])
+        offsets = N.dot(offsets, stride)
+        min_d2 = min_dist ** 2
+
+    # dart throwing in batches
+    rval = N.empty((nneurons, 3))
+    count = 0
+    for _ in xrange(max_rounds):
+        if count == nneurons:
+            break
+
+        # candidates from the density
+        batch = max(1024, int(1.5 * (nneurons - count)))
+        cand = lo + NR.random_sample((batch, 3)) * extent
+        if density is not None:
+            cand = cand[NR.random_sample(batch) * dmax < density(cand)]
+        if min_dist <= 0.0:
+            cand = cand[:nneurons - count]
+            rval[count:count + cand.shape[0]] = cand
+            count += cand.shape[0]
+            continue
+
+        # reject by accepted positions
+        cells = N.dot(((cand - lo) / cell).astype(int) + 2, stride)
+        nbrs = grid[cells[:, N.newaxis] + offsets]
+        rows, cols = N.nonzero(nbrs >= 0)
+        d2 = ((rval[nbrs[rows, cols]] - cand[rows]) ** 2).sum(axis=1)
+        keep = N.ones(cand.shape[0], dtype=bool)
+        keep[rows[d2 < min_d2]] = False
+        cand, cells = cand[keep], cells[keep]
+
+        # reject by earlier candidates of the batch, one candidate per cell
+        first = N.unique(cells, return_index=True)[1]
+        first.sort()
+        cand, cells = cand[first], cells[first]
+        grid[cells] = N.arange(cand.shape[0]) + nneurons
+        nbrs = grid[cells[:, N.newaxis] + offsets] - nneurons
+        rows, cols = N.nonzero(nbrs >= 0)
+        nbrs = nbrs[rows, cols]
+        early = nbrs < rows
+        rows, nbrs = rows[early], nbrs[early]
+        d2 = ((cand[nbrs] - cand[rows]) ** 2).sum(axis=1)
+        keep = N.ones(cand.shape[0], dtype=bool)
+        keep[rows[d2 < min_d2]] = False
+        grid[cells] = -1
+
+        # accept
+        cand, cells = cand[keep][:nneurons - count], cells[keep]
+        cells = cells[:cand.shape[0]]
+        rval[count:count + cand.shape[0]] = cand
+        grid[cells] = N.arange(count, count + cand.shape[0])
+        count += cand.shape[0]
+
+    # return
+    if count < nneurons:
+        raise ValueError('could only place %d of %d neurons' %
+                         (count, nneurons))
+    return rval
+
+
+def population_generate(nneurons, bounds, neuron_data, density=None,
+                        min_dist=10.0, orientation=None, jitter=0.0,
+                        rate_of_fire=(10.0, 0.5), amplitude=(1.0, 0.25),
+                        nclusters=0, cluster_fraction=1.0,
+                        neuron_data_weights=None):
+    """generate a population of neurons
+
+    :Parameters:
+        nneurons : int
+            Number of neurons.
+        bounds : arraylike
+            see population_positions
+        neuron_data : list
+            The neuron data to draw from, descriptions of NeuronData objects or
+            archive names as for register_neuron.
+        density : callable
+            see population_positions
+            Default=None
+        min_dist : float
+            see population_positions
+            Default=10.0
+        orientation : arraylike
+            Common direction of the neurons, random directions if None.
+            Default=None
+        jitter : float
+            Standard deviation of the angle between the direction of a neuron
+            and orientation in degrees.
+            Default=0.0
+        rate_of_fire : tuple
+            Median and log standard deviation of the log-normal distribution
+            of the rates of fire in Hz.
+            Default=(10.0, 0.5)
+        amplitude : tuple
+            Median and log standard deviation of the log-normal distribution
+            of the amplitudes.
+            Default=(1.0, 0.25)
+        nclusters : int
+            Number of clusters. Clustered neurons are assigned to the nearest
+            of nclusters cluster centres, drawn from the population.
+            Default=0
+        cluster_fraction : float
+            Fraction of neurons in clusters, the rest are singletons.
+            Default=1.0
+        neuron_data_weights : arraylike
+            Relative frequencies of the neuron data, uniform if None.
+            Default=None
+    :Returns:
+        dict : the population, see module docstring
+    """
+
+    # positions
+    nneurons = int(nneurons)
+    pos = population_positions(nneurons, bounds, density, min_dist)
+
+    # orientations, random or jittered around a common direction
+    ori = NR.standard_normal((nneurons, 3))
+    if orientation is not None:
+        axis = N.asarray(orientation, dtype=float)
+        axis /= N.sqrt((axis ** 2).sum())
+        ori -= N.outer(N.dot(ori, axis), axis)
+        ori /= N.sqrt((ori ** 2).sum(axis=1))[:, N.newaxis]
+        phi = N.abs(NR.standard_normal(nneurons)) * N.radians(jitter)
+        ori = N.outer(N.cos(phi), axis) + ori * N.sin(phi)[:, N.newaxis]
+    ori /= N.sqrt((ori ** 2).sum(axis=1))[:, N.newaxis]
+
+    # clusters
+    cls = N.empty(nneurons, dtype=int)
+    cls.fill(-1)
+    if nclusters > 0:
+        clustered = N.nonzero(NR.random_sample(nneurons) < cluster_fraction)[0]
+        if clustered.size > 0:
+            centres = pos[clustered[NR.permutation(clustered.size)[:nclusters]]]
+            d2 = N.zeros((clustered.size, centres.shape[0]))
+            for i in xrange(3):
+                d2 += (pos[clustered, i][:, N.newaxis] - centres[:, i]) ** 2
+            cls[clustered] = d2.argmin(axis=1)
+
+    # neuron data
+    if neuron_data_weights is None:
+        neuron_data_weights = N.ones(len(neuron_data))
+    cdf = N.cumsum(neuron_data_weights, dtype=float)
+    ndata = N.asarray(neuron_data, dtype=object)[
+        N.searchsorted(cdf / cdf[-1], NR.random_sample(nneurons), 'right')]
+
+    # return
+    return {
+        'position': pos,
+        'orientation': ori,
+        'rate_of_fire': rate_of_fire[0] * N.exp(
+            rate_of_fire[1] * NR.standard_normal(nneurons)),
+        'amplitude': amplitude[0] * N.exp(
+            amplitude[1] * NR.standard_normal(nneurons)),
+        'cluster': cls,
+        'neuron_data': ndata,
+    }
+
+
+def population_items(pop, name='pop'):
+    """registration items of a population, see BaseSimulation.register_many
+
+    :Parameters:
+        pop : dict
+            The population, see population_generate.
+        name : str
+            Prefix of the neuron names, the names are <name><index>.
+            Default='pop'
+    :Returns:
+        list : tuples ('Neuron', keywords)
+    """
+
+    rval = []
+    pos = pop['position'].tolist()
+    ori = pop['orientation'].tolist()
+    rate = pop['rate_of_fire'].tolist()
+    amp = pop['amplitude'].tolist()
+    cls = pop['cluster'].tolist()
+    ndata = pop['neuron_data'].tolist()
+    for i in xrange(len(pos)):
+        kwargs = {
+            'name': '%s%06d' % (name, i),
+            'position': pos[i],
+            'orientation': ori[i],
+            'rate_of_fire': rate[i],
+            'amplitude': amp[i],
+            'neuron_data': ndata[i],
+        }
+        if cls[i] >= 0:
+            kwargs['cluster'] = cls[i]
+        rval.append(('Neuron', kwargs))
+    return rval
+
+
+def population_save(pop, fname, neuron_data_dir=None, name='pop'):
+    """save a population as a scene config file, see scene_config_load
+
+    :Parameters:
+        pop : dict
+            The population, see population_generate.
+        fname : str
+            Path to save the scene config to.
+        neuron_data_dir : list
+            Directories of the neuron data archives.
+            Default=None
+        name : str
+            Prefix of the neuron names, see population_items.
+            Default='pop'
+    """
+
+    npy2cfg = lambda x: ' '.join(['%.3f' % v for v in x])
+    save_file = open(fname, 'w')
+    try:
+        save_file.write('[CONFIG]\nneuron_data_dir = %s\n\n' %
+                        '\n\t'.join(neuron_data_dir or []))
+        for _, kwargs in population_items(pop, name):
+            save_file.write('[Neuron %s]\n' % kwargs['name'])
+            if 'cluster' in kwargs:
+                save_file.write('cluster = %d\n' % kwargs['cluster'])
+            save_file.write('position = %s\n' % npy2cfg(kwargs['position']))
+            save_file.write('orientation = %s\n' %
+                            npy2cfg(kwargs['orientation']))
+            save_file.write('rate_of_fire = %.3f\n' % kwargs['rate_of_fire'])
+            save_file.write('amplitude = %.3f\n' % kwargs['amplitude'])
+            save_file.write('neuron_data = %s\n\n' % kwargs['neuron_data'])
+    finally:
+        save_file.close()
+
+
+##---MAIN
+
+__all__ = [
+    'POP_GRID_MAX',
+    'column_density',
+    'layer_density',
+    'population_generate',
+    'population_items',
+    'population_positions',
+    'population_save',
+]
+
+if __name__ == '__main__':
+
+    import time
+
+    # a cortical slab of 1mm x 1mm x 0.5mm with three layers and two columns
+    bounds = [[-500.0, -500.0, -250.0], [500.0, 500.0, 250.0]]
+    layers = layer_density([(-250, -100, 1.0), (-100, 50, 0.3),
+                            (50, 250, 0.6)])
+    columns = column_density([(-200, 0, 150, 1.0), (250, 100, 100, 1.0)], 0.3)
+    density = lambda pos: layers(pos) * columns(pos)
+    print
+    print '## SCENE POPULATION ## slab %s' % bounds
+
+    for nneurons in [1000, 10000, 100000]:
+        tic = time.time()
+        pop = population_generate(nneurons, bounds, ['a.h5', 'b.h5'],
+                                  density=density, min_dist=10.0,
+                                  orientation=[0, 0, 1], jitter=15.0,
+                                  nclusters=5, cluster_fraction=0.1)
+        t_gen = time.time() - tic
+        tic = time.time()
+        items = population_items(pop)
+        t_items = time.time() - tic
+
+        # check the spacing by brute force on a sample
+        pos = pop['position']
+        idx = NR.permutation(nneurons)[:1000]
+        d2 = ((pos[idx, N.newaxis, :] - pos[N.newaxis, :, :]) ** 2).sum(2)
+        d2[N.arange(idx.size), idx] = N.inf
+        print '%6d neurons: generate %.3f s, items %.3f s, min dist %.2f' % (
+            nneurons, t_gen, t_items, N.sqrt(d2.min()))
+    print 'clustered:', (pop['cluster'] >= 0).mean(), \
+        'per layer:', [((pos[:, 2] >= lo) & (pos[:, 2] < hi)).sum()
+                       for lo, hi in [(-250, -100), (-100, 50), (50, 250)]]
@@ -75,10 +75,17 @@ __docformat__ = 'restructuredtext'
 ##---IMPORTS
 
 from ConfigParser import ConfigParser
+from contextlib import contextmanager
 import os.path as osp
+import time
+import scipy as N
 from cluster_dynamics import ClusterDynamics
 from data_io import SimIOManager, SimPkg
+from scene_archive import SceneArchiveContainer
 from scene import (
+    ND_CACHE_DIR,
+    ND_PRECISION,
+    NeuronData,
     NeuronDataContainer,
     Neuron,
     Recorder,
@@ -193,20 +200,46 @@ class BaseSimulation(dict):
                 Frame size.
             cfg : str
                 Path to a config file, readable by a ConfigParser instance.
+                See load_config.
+            lazy_neuron_data : bool
+                If True, voxel data of neuron data archives is read on demand
+                instead of at load time.
+                Default=False
+            shared_neuron_data : bool
+                If True, neuron data loaded from archives is placed in shared
+                memory, so simulations on one host hold one copy. The segments
+                are removed at finalize by the last simulation holding them.
+                Default=False
+            neuron_data_cache : str or bool
+                Directory for preprocessed sidecars of neuron data archives,
+                ND_CACHE_DIR if True. No sidecars are used if None or False.
+                Default=None
         """
 
         # private property members
+        self._batch = 0
+        self._batch_created = []
         self._cfg = None
         self._externals = []
         self._frame = None
         self._frame_size = None
+        self._frame_dtype = N.dtype(N.float64)
         self._sample_rate = None
         self._status = None
 
         # public members
         self.cls_dyn = ClusterDynamics()
         self.io_man = SimIOManager()
-        self.neuron_data = NeuronDataContainer()
+        self.neuron_data = NeuronDataContainer(
+            shared=kwargs.get('shared_neuron_data', False),
+            lazy=kwargs.get('lazy_neuron_data', False)
+        )
+        nd_cache = kwargs.get('neuron_data_cache', None)
+        if nd_cache is True:
+            nd_cache = ND_CACHE_DIR
+        if nd_cache:
+            self.neuron_data.load_kwargs['cache_dir'] = nd_cache
+        self.load_config(kwargs.get('cfg', None))
         self.debug = kwargs.get('debug', False)
 
         # externals
@@ -231,6 +264,10 @@ class BaseSimulation(dict):
             sample_rate : float
                 Sample rate to operate.
                 Default=16000.0
+            frame_dtype : dtype
+                Type of the noise and waveform data of the frames, float32 or
+                float64. If not given, the type from the config is kept.
+                Default=float64
         """
 
         self.clear()
@@ -239,6 +276,7 @@ class BaseSimulation(dict):
         self.sample_rate = kwargs.get('sample_rate', 16000.0)
         self.frame = kwargs.get('frame', 0)
         self.frame_size = kwargs.get('frame_size', 1024)
+        self.frame_dtype = kwargs.get('frame_dtype', self.frame_dtype)
         self.status
 
         # reset pubic members
@@ -251,10 +289,10 @@ class BaseSimulation(dict):
 
         self.clear()
 
-        # reset pubic members
+        # reset pubic members, shared neuron data segments are released
         self.cls_dyn.clear()
         self.io_man.finalize()
-        self.neuron_data.clear()
+        self.neuron_data.close()
 
     ## properties
 
@@ -275,11 +313,29 @@ class BaseSimulation(dict):
         self.status
     frame_size = property(get_frame_size, set_frame_size)
 
+    def get_frame_dtype(self):
+        return self._frame_dtype
+    def set_frame_dtype(self, value):
+        value = N.dtype(value)
+        if value not in [N.float32, N.float64]:
+            raise ValueError('frame_dtype has to be float32 or float64')
+        self._frame_dtype = value
+        self.status
+    frame_dtype = property(get_frame_dtype, set_frame_dtype)
+
     def get_sample_rate(self):
         return self._sample_rate
     def set_sample_rate(self, value):
         self._sample_rate = float(value)
         self.cls_dyn.sample_rate = self._sample_rate
+        self.neuron_data.sample_rate = self._sample_rate
+        for nrn_k in self.neuron_keys:
+            self[nrn_k].neuron_data = self.neuron_data.resampled(
+                self[nrn_k].neuron_data)
+        for rec_k in self.recorder_keys:
+            if self[rec_k].background is not None:
+                self[rec_k].background = self[rec_k].background.resampled(
+                    self._sample_rate)
         for ext in self._externals:
             ext.sample_rate(self._sample_rate)
         self.status
@@ -288,6 +344,7 @@ class BaseSimulation(dict):
     def get_status(self):
         self._status = {
             'frame_size'    : self.frame_size,
+            'frame_dtype'   : self.frame_dtype,
             'sample_rate'   : self.sample_rate,
             'neurons'       : self.neuron_keys,
             'recorders'     : self.recorder_keys,
@@ -425,7 +482,8 @@ class BaseSimulation(dict):
                 self._frame,
                 self[rec_k].simulate(
                     nlist=nlist,
-                    frame_size=self.frame_size
+                    frame_size=self.frame_size,
+                    dtype=self.frame_dtype
                 )
             )
 
@@ -446,6 +504,78 @@ class BaseSimulation(dict):
 
     ## methods object management
 
+    @contextmanager
+    def batch(self):
+        """context to register many objects at once
+
+        Within the context, the status is not rebuilt and the delegates are not
+        notified per registered object. Both happens once, when the outermost
+        context is left. Contexts can be nested.
+
+            with sim.batch():
+                for kwargs in neuron_kwargs:
+                    sim.register_neuron(**kwargs)
+        """
+
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if self._batch == 0:
+                self._batch_commit()
+
+    def _batch_commit(self):
+        """log the objects created in a batch and rebuild the status"""
+
+        created = self._batch_created
+        self._batch_created = []
+        if len(created) == 0:
+            return
+        if len(created) <= 10:
+            for item in created:
+                self.log('>> %s created!' % item)
+        else:
+            self.log('>> %d objects created!' % len(created))
+            for item in created:
+                self.log_d('>> %s created!' % item)
+        self.status
+
+    def _created(self, item):
+        """log the creation of item and rebuild the status, unless batched"""
+
+        if self._batch > 0:
+            self._batch_created.append(str(item))
+        else:
+            self.log('>> %s created!' % item)
+            self.status
+
+    def register_many(self, items):
+        """register a list of objects in one batch, see batch
+
+        :Parameters:
+            items : list
+                A list of tuples (class name, keywords), where the class name
+                is 'Neuron' or 'Tetrode' and keywords are passed to
+                register_neuron or register_recorder.
+        :Raises:
+            ValueError for unknown class names, else see register_neuron and
+            register_recorder.
+        :Returns:
+            list : the string representations of the registered objects.
+        """
+
+        rval = []
+        with self.batch():
+            for cls, kwargs in items:
+                if cls == 'Neuron':
+                    rval.append(self.register_neuron(**kwargs))
+                elif cls in ['Tetrode', 'Recorder']:
+                    rval.append(self.register_recorder(**kwargs))
+                else:
+                    raise ValueError('unknown object class: %s' % cls)
+        return rval
+
     def register_neuron(self, **kwargs):
         """register a neuron to the simulation
 
@@ -461,8 +591,9 @@ class BaseSimulation(dict):
                 Orientation of the object. If ndarray it is interpreted as
                 direction of orientation relative to the scene's positive
                 z-axis. If its a list or tuple, it is interpreted as a triple of
-                euler angles relative to the scene's positive z-axis. If it is
-                True a random rotation is created.
+                euler angles relative to the scene's positive z-axis. If it has
+                4 elements, it is the rotation quaternion as returned by
+                Neuron.orientation. If it is True a random rotation is created.
                 Default=False
             rate_of_fire : float
                 Rate of fire in Hz.
@@ -486,11 +617,10 @@ class BaseSimulation(dict):
         if neuron_data in self.neuron_data:
             ndata = self.neuron_data[neuron_data]
         else:
-            if not self.neuron_data.insert(neuron_data):
+            ndata = self.neuron_data.resolve(neuron_data)
+            if ndata is None:
                 raise ValueError('Unknown neuron_data: %s' % str(neuron_data))
-            else:
-                ndata = self.neuron_data[neuron_data]
-        kwargs.update(neuron_data=ndata)
+        kwargs.update(neuron_data=self.neuron_data.resampled(ndata))
 
         # build neuron
         neuron = Neuron(**kwargs)
@@ -503,8 +633,7 @@ class BaseSimulation(dict):
         self.cls_dyn.add_neuron(neuron, cls_idx=cls_idx)
 
         # log and return
-        self.log('>> %s created!' % neuron)
-        self.status
+        self._created(neuron)
         return str(neuron)
 
     def register_recorder(self, **kwargs):
@@ -533,7 +662,32 @@ class BaseSimulation(dict):
                 Default=1.0
                 TODO: fix this value to be congruent with the neuron amplitudes.
             noise_params : list
-                The noise generator parameters.
+                The noise generator parameters, or the path to the noise
+                library directory for the 'library' model.
+                Default=None
+            noise_model : str
+                The noise generator, one of 'ar', 'spectral', 'lowrank' or
+                'library'.
+                Default='ar'
+            noise_scale : float
+                Factor to scale the recorded noise of the 'library' model
+                with, e.g. from ADC counts.
+                Default=1.0
+            noise_producer : bool
+                Generate the noise ahead of time in a producer process.
+                Default=False
+            noise_bank : int
+                Length of a shared noise tile in samples, 0 for no noise bank.
+                Default=0
+            lod : tuple
+                Levels of detail of the waveforms relative to the noise, see
+                Recorder.
+                Default=None
+            background : dict
+                Keywords of the background activity of a distant population,
+                see Recorder. The 'neuron_data' entry may be given like for
+                register_neuron. The background is resampled to the sample
+                rate of the simulation, see BackgroundNoiseGen.resampled.
                 Default=None
         :Raises:
             some error ..mostly ValueError for invalid parameters.
@@ -541,13 +695,29 @@ class BaseSimulation(dict):
             The string representation of the registered Recorder.
         """
 
+        # resolve the neuron data of the background
+        background = kwargs.get('background', None)
+        if isinstance(background, dict) and 'neuron_data' in background:
+            neuron_data = background['neuron_data']
+            if not isinstance(neuron_data, NeuronData):
+                if neuron_data in self.neuron_data:
+                    ndata = self.neuron_data[neuron_data]
+                else:
+                    ndata = self.neuron_data.resolve(neuron_data)
+                    if ndata is None:
+                        raise ValueError('Unknown neuron_data: %s' %
+                                         str(neuron_data))
+                kwargs['background'] = dict(background, neuron_data=ndata)
+
         # build tetrode
         tetrode = Tetrode(**kwargs)
+        if tetrode.background is not None and self._sample_rate is not None:
+            tetrode.background = tetrode.background.resampled(
+                self._sample_rate)
         self[id(tetrode)] = tetrode
 
         # connect and return
-        self.log('>> %s created!' % tetrode)
-        self.status
+        self._created(tetrode)
         return str(tetrode)
 
     def remove_object(self, key):
@@ -577,6 +747,8 @@ class BaseSimulation(dict):
         # remove item
         try:
             item = self.pop(lookup)
+            if isinstance(item, Recorder):
+                item.close()
             self.log('>> %s destroyed!' % item)
             self.status
             return True
@@ -601,7 +773,28 @@ class BaseSimulation(dict):
         ndata_paths = cfg.get('CONFIG', 'neuron_data_dir')
         ndata_paths = ndata_paths.strip().split('\n')
 
+        # load all referenced neuron data before building the scene
+        ndata_refs = []
+        for sec in cfg.sections():
+            if cfg.has_option(sec, 'neuron_data'):
+                v = cfg.get(sec, 'neuron_data')
+                if v and v not in ndata_refs:
+                    ndata_refs.append(v)
+        tic = time.time()
+        loaded = self.neuron_data.preload([
+            [osp.join(path, v) for path in ndata_paths] for v in ndata_refs
+        ])
+        for ndata_path, dt in loaded:
+            if dt is None:
+                self.log('>> failed to load %s' % ndata_path)
+            else:
+                self.log('>> loaded %s in %.3f s' % (ndata_path, dt))
+        if len(loaded) > 0:
+            self.log('>> loaded %d neuron data archives in %.3f s' %
+                     (len(loaded), time.time() - tic))
+
         # read per section
+        items = []
         for sec in cfg.sections():
 
             # check section
@@ -628,22 +821,20 @@ class BaseSimulation(dict):
                     else:
                         kwargs[k] = map(float, v.split())
                 elif k in ['neuron_data']:
-                    kwargs[k] = v
                     ndata_path_list = [osp.join(path, v)
                                        for path in ndata_paths]
-                    added_ndata = self.neuron_data.insert(ndata_path_list)
-                    if added_ndata == 0:
+                    ndata = self.neuron_data.resolve(ndata_path_list)
+                    if ndata is None:
                         bad_ndata = True
+                    else:
+                        kwargs[k] = ndata.description
                 else:
                     kwargs[k] = v
 
             # delegate action
-            if bad_ndata:
-                continue
-            elif cls == 'Neuron':
-                self.register_neuron(**kwargs)
-            elif cls == 'Tetrode':
-                self.register_recorder(**kwargs)
+            if not bad_ndata:
+                items.append((cls, kwargs))
+        self.register_many(items)
 
     def scene_config_save(self, fname):
         """save the current scene configuration to a file
@@ -696,20 +887,146 @@ class BaseSimulation(dict):
         cfg.write(save_file)
         save_file.close()
 
+    def scene_archive_load(self, fname):
+        """load a scene archive (.sca)
+
+        The scene archive holds the scene and all neuron data it references,
+        so no neuron data directories are searched, see SceneArchiveContainer.
+
+        :Parameters:
+            fname : str
+                Path to the scene archive.
+        :Exceptions:
+            IOError:
+                Error opening the scene archive.
+        """
+
+        sca = SceneArchiveContainer(fname, 'r')
+        try:
+
+            # neuron data
+            ndata = {}
+            for key in sca.get_ndata_keys():
+                tic = time.time()
+                item = sca.load_ndata(key, **self.neuron_data.load_kwargs)
+                if item is None:
+                    self.log('>> failed to load %s from %s' % (key, fname))
+                    continue
+                self.neuron_data.insert(item)
+                ndata[key] = item.description
+                self.log('>> loaded %s in %.3f s' % (item, time.time() - tic))
+
+            # scene objects
+            items = []
+            for cls, kwargs in sca.get_simobjs():
+                if cls == 'Neuron':
+                    if kwargs.get('neuron_data', None) not in ndata:
+                        continue
+                    kwargs['neuron_data'] = ndata[kwargs['neuron_data']]
+                    items.append((cls, kwargs))
+                elif cls == 'Tetrode':
+                    items.append((cls, kwargs))
+            self.register_many(items)
+        finally:
+            sca.close()
+
+    def scene_archive_save(self, fname):
+        """save the current scene and its neuron data to a scene archive
+
+        :Parameters:
+            fname : str
+                Path to save the scene archive to.
+        """
+
+        sca = SceneArchiveContainer(fname, 'w')
+        try:
+            sca.set_config({
+                'frame_size': self.frame_size,
+                'sample_rate': self.sample_rate,
+            })
+            neurons = []
+            recorders = []
+            for obj in self.values():
+                if isinstance(obj, Neuron):
+                    neurons.append({
+                        'name': obj.name,
+                        'neuron_data': sca.add_ndata(obj._neuron_data),
+                        'cluster': self.cls_dyn.get_cls_for_nrn(obj),
+                        'position': obj.position,
+                        'orientation': obj.orientation,
+                        'rate_of_fire': obj.rate_of_fire,
+                        'amplitude': obj.amplitude,
+                    })
+                elif isinstance(obj, Recorder):
+                    recorders.append({
+                        'name': obj.name,
+                        'position': obj.position,
+                        'orientation': obj._trajectory,
+                        'snr': obj.snr,
+                    })
+            sca.add_simobjs('Neuron', neurons)
+            sca.add_simobjs('Tetrode', recorders)
+        finally:
+            sca.close()
+
     ## methods config loading
 
     def load_config(self, cfg_path=None):
         """loads initialization values from file
 
+        The NUMERICS section sets the precision of neuron data loaded from
+        archives: 'precision' is the storage type in bits (64, 32 or 16) and
+        'accumulate' the type in bits to compute with (64 or 32). 'frame' is
+        the type in bits of the noise and waveform data of the frames (64 or
+        32), see frame_dtype.
+
         :Parameters:
             cfg_file : str
                 Path to the config file. Should be readable by a ConfigParser.
+        :Exceptions:
+            IOError:
+                Error reading the config file.
+            ValueError:
+                Error for unknown precision values.
         """
 
-        # TODO: implement config file handling
+        # checks and inits
+        if cfg_path is None:
+            return
+        cfg = ConfigParser()
+        if cfg_path not in cfg.read(cfg_path):
+            raise IOError('could not load config from %s' % cfg_path)
+        self._cfg = cfg_path
+
+        # numerics, 'precisition' is the key of older config files
+        if cfg.has_section('NUMERICS'):
+            for key, load_key, valid in [
+                ('precisition', 'dtype', ND_PRECISION),
+                ('precision', 'dtype', ND_PRECISION),
+                ('accumulate', 'acc_dtype', [32, 64])
+            ]:
+                if not cfg.has_option('NUMERICS', key):
+                    continue
+                bits = cfg.getint('NUMERICS', key)
+                if bits not in valid:
+                    raise ValueError('unknown precision for %s: %s' % (key, bits))
+                self.neuron_data.load_kwargs[load_key] = ND_PRECISION[bits]
+            if cfg.has_option('NUMERICS', 'frame'):
+                bits = cfg.getint('NUMERICS', 'frame')
+                if bits not in [32, 64]:
+                    raise ValueError('unknown frame precision: %s' % bits)
+                self._frame_dtype = N.dtype(ND_PRECISION[bits])
 
     ## special methods
 
+    def clear(self):
+        """remove all objects, recorders are closed"""
+
+        for item in self.values():
+            if isinstance(item, Recorder):
+                item.close()
+        super(BaseSimulation, self).clear()
+
     def __len__(self):
         return len(filter(lambda x: isinstance(x, Neuron), self.values()))
     def __str__(self):
@@ -718,6 +1035,65 @@ class BaseSimulation(dict):
 
 if __name__ == '__main__':
 
+    import shutil, tempfile
+    from tables import openFile
+    from scene.neuron_data import SampledND
+
     print
     print 'creating BaseSimulation'
     sim = BaseSimulation()
+
+    # a synthetic neuron data archive, a field decaying from the soma
+    tmp_dir = tempfile.mkdtemp()
+    nd_path = osp.join(tmp_dir, 'synthetic.h5')
+    gs, step, nsmpl = 11, 10.0, 64
+    grid = (N.arange(gs) - (gs - 1) / 2) * step
+    X, Y, Z = N.meshgrid(grid, grid, grid, indexing='ij')
+    dist = N.sqrt(X ** 2 + Y ** 2 + Z ** 2).ravel() + step
+    wf = N.sin(N.linspace(0, 2 * N.pi, nsmpl))
+    arc = openFile(nd_path, 'w')
+    arc.createArray('/', 'soma_v', wf)
+    arc.createArray('/', 'LFP', N.outer(1000.0 / dist ** 2, wf))
+    arc.createArray('/', 'el_pos_x', grid)
+    arc.createArray('/', 'el_pos_y', grid)
+    arc.createArray('/', 'el_pos_z', grid)
+    arc.createGroup('/', 'parameters')
+    arc.createArray('/parameters', 'timeres_python', 1000.0 / 16000.0)
+    arc.close()
+    ndata = SampledND(nd_path)
+    ndata.filename = nd_path
+    sim.neuron_data.insert(ndata)
+
+    # scene archive round trip, the orientation of the neurons must survive
+    # as the full rotation, not only as the direction of the z-axis
+    print 'scene archive round trip'
+    sim.register_many([
+        ('Neuron', {'name': 'random', 'neuron_data': ndata.description,
+                    'position': [10, 0, 0], 'orientation': True}),
+        ('Neuron', {'name': 'tilted', 'neuron_data': ndata.description,
+                    'position': [0, 10, 0], 'orientation': [1, 1, 0]}),
+        ('Neuron', {'name': 'plain', 'neuron_data': ndata.description,
+                    'position': [0, 0, 10], 'orientation': False}),
+        ('Tetrode', {'name': 'tt', 'position': [0, 0, 0],
+                     'orientation': [0, 1, 1]}),
+    ])
+    sca_path = osp.join(tmp_dir, 'scene.sca')
+    sim.scene_archive_save(sca_path)
+    sim_load = BaseSimulation()
+    sim_load.scene_archive_load(sca_path)
+    objs = dict([(obj.name, obj) for obj in sim.values()])
+    objs_load = dict([(obj.name, obj) for obj in sim_load.values()])
+    assert sorted(objs) == sorted(objs_load), 'objects are missing'
+    for name in sorted(objs):
+        obj, obj_load = objs[name], objs_load[name]
+        if obj.orientation is False:
+            assert obj_load.orientation is False, '%s gained a rotation' % name
+        else:
+            assert N.allclose(obj.orientation, obj_load.orientation), \
+                'orientation of %s changed' % name
+        assert N.allclose(obj.points, obj_load.points), \
+            'points of %s changed' % name
+        print '  %-8s %s' % (name, obj_load.orientation)
+    sim.finalize()
+    sim_load.finalize()
+    shutil.rmtree(tmp_dir)
@@ -467,7 +467,10 @@ class SimulationGui(QtGui.QMainWindow, Ui_SimGui):
             rval = str(QtGui.QFileDialog.getOpenFileName(self))
             if rval == '' or rval == 'None' or rval is None:
                 return
-            self._sim.scene_config_load(rval)
+            if rval.endswith('.sca'):
+                self._sim.scene_archive_load(rval)
+            else:
+                self._sim.scene_config_load(rval)
             self.scene_build_model()
 
         except:
@@ -481,7 +484,10 @@ class SimulationGui(QtGui.QMainWindow, Ui_SimGui):
             rval = str(QtGui.QFileDialog.getSaveFileName(self))
             if rval == '' or rval == 'None' or rval is None:
                 return
-            self._sim.scene_config_save(rval)
+            if rval.endswith('.sca'):
+                self._sim.scene_archive_save(rval)
+            else:
+                self._sim.scene_config_save(rval)
 
         except:
             self.error_dialog()